@@ -0,0 +1,123 @@
+# !/usr/bin/env python
+# Окружение для бенчмарков без сети и MySQL: участники чатов собираются в памяти,
+# модели переключаются на sqlite в памяти
+
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Конфиг требует переменные подключения, хотя к MySQL бенчмарки не обращаются
+for env_name in ('DB_HOST', 'DB_NAME', 'DB_USER', 'DB_PASSWORD'):
+    os.environ.setdefault(env_name, 'benchmark')
+
+from peewee import SqliteDatabase  # noqa: E402
+
+from fsb.db.models import User, Chat, Member, Rating, RatingMember  # noqa: E402
+
+PAGE_SIZE = 200
+MODELS = [User, Chat, Member, Rating, RatingMember]
+FIRST_NAMES = ['Иван', 'Пётр', 'Анна', 'Мария', 'Alex', 'Kate', None]
+LAST_NAMES = ['Иванов', 'Петрова', 'Smith', None, None]
+
+
+class FakeParticipantInfo:
+    def __init__(self, rank: str = None):
+        self.rank = rank
+
+
+class FakeParticipant:
+    def __init__(self, id: int):
+        self.id = id
+        self.first_name = FIRST_NAMES[id % len(FIRST_NAMES)]
+        self.last_name = LAST_NAMES[id % len(LAST_NAMES)]
+        self.username = f'user{id}' if id % 4 else None
+        self.bot = False
+        self.participant = FakeParticipantInfo(f'rank {id}' if id % 3 == 0 else None)
+
+
+class FakeDbMember:
+    def __init__(self, telegram_id: int):
+        self.telegram_id = telegram_id
+
+    def get_telegram_id(self):
+        return self.telegram_id
+
+
+class FakeClient:
+    def __init__(self, participants: list):
+        self.participants = participants
+
+    async def iter_dialog_members(self, entity, with_bot: bool = None, chunk_size: int = None):
+        chunk_size = chunk_size or PAGE_SIZE
+
+        for offset in range(0, len(self.participants), chunk_size):
+            yield self.participants[offset:offset + chunk_size]
+
+
+class AsyncCursor:
+    def __init__(self, cursor):
+        self._cursor = cursor
+        self.description = cursor.description
+        self.lastrowid = cursor.lastrowid
+        self.rowcount = cursor.rowcount
+
+    async def fetchone(self):
+        return self._cursor.fetchone()
+
+    async def fetchmany(self, size: int):
+        return self._cursor.fetchmany(size)
+
+    async def fetchall(self):
+        return self._cursor.fetchall()
+
+
+class BenchmarkDatabase(SqliteDatabase):
+    # peewee-async не работает с sqlite, поэтому aio-запросы моделей выполняются синхронно
+    async def aio_execute(self, query, fetch_results=None):
+        fetch_results = fetch_results or getattr(query, 'fetch_results', None)
+        cursor = self.execute(query)
+
+        return await fetch_results(AsyncCursor(cursor)) if fetch_results else None
+
+    def create_models_tables(self, models: list):
+        for model in models:
+            sql, params = model._schema._create_table(safe=True).query()
+            # ON UPDATE есть только в MySQL
+            self.execute_sql(sql.replace(' ON UPDATE CURRENT_TIMESTAMP', ''), params)
+            model._schema.create_indexes(safe=True)
+
+
+def make_participants(count: int) -> list:
+    return [FakeParticipant(id) for id in range(1, count + 1)]
+
+
+def make_db_members(participants: list, share: float = 0.5) -> list:
+    count = max(int(len(participants) * share), 1)
+    return [FakeDbMember(participant.id) for participant in random.sample(participants, count)]
+
+
+def make_database(participants: list) -> tuple:
+    database = BenchmarkDatabase(':memory:')
+    database.bind(MODELS, bind_refs=False, bind_backrefs=False)
+    database.create_models_tables(MODELS)
+
+    chat = Chat.create(telegram_id=-100, name='Benchmark', type=Chat.CHAT_TYPE)
+    rating = Rating.create(name='пидор', chat=chat, command='pidor')
+
+    with database.atomic():
+        User.insert_many(
+            [{'telegram_id': participant.id, 'name': participant.first_name, 'nickname': participant.username}
+             for participant in participants]
+        ).execute()
+        users_ids = [user.id for user in User.select(User.id).order_by(User.id)]
+        Member.insert_many([{'chat': chat.id, 'user': user_id} for user_id in users_ids]).execute()
+        members_ids = [member.id for member in Member.select(Member.id).order_by(Member.id)]
+        RatingMember.insert_many([
+            {'member': member_id, 'rating': rating.id, 'total_count': random.randint(0, 300),
+             'month_count': random.randint(0, 12), 'current_month_count': random.randint(0, 31)}
+            for member_id in members_ids
+        ]).execute()
+
+    return database, chat, rating
@@ -0,0 +1,265 @@
+# !/usr/bin/env python
+# Микробенчмарки горячих путей хелперов и рейтингов, работают без сети и MySQL:
+# python -m benchmarks.hotpaths run --output benchmarks/baselines/master.json
+# python -m benchmarks.hotpaths compare benchmarks/baselines/master.json benchmarks/baselines/current.json
+# python -m benchmarks.hotpaths check-logs - один раз собрать каждое ленивое сообщение лога
+
+import argparse
+import asyncio
+import inspect
+import json
+import os
+import platform
+import random
+import sys
+from datetime import datetime
+from statistics import median
+from time import perf_counter
+from types import SimpleNamespace
+
+from telethon.tl import types
+
+# fixtures готовят окружение конфига, поэтому импортируются раньше модулей бота
+from benchmarks.fixtures import FakeClient, make_database, make_db_members, make_participants
+from fsb.db.models import QueryEvent
+from fsb.events.common import CallbackQueryEventDTO, ChatActionEventDTO, MessageEventDTO
+from fsb.handlers import MentionHandler
+from fsb.helpers import Helper, InfoBuilder
+from fsb.services import RatingService
+
+SIZES = [10, 200, 10000]
+REPEAT = 5
+MIN_BATCH_TIME = 0.05
+THRESHOLD = 0.2
+BASELINES_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines')
+RATING_NAMES = ['пидор', 'красавчик', 'котик', 'зайка', 'молодец', 'герой', 'соня', 'умница']
+
+
+def make_cases(size: int) -> dict:
+    participants = make_participants(size)
+    db_members = make_db_members(participants)
+    usernames = [participant.username or str(participant.id) for participant in participants]
+    words = [RATING_NAMES[i % len(RATING_NAMES)] for i in range(size)]
+    mention_handler = MentionHandler.__new__(MentionHandler)
+    rating = make_database(participants)[2]
+    rating_service = RatingService(FakeClient(participants))
+
+    return {
+        'collect_members': lambda: Helper.collect_members(participants, db_members),
+        'make_member_name': lambda: [Helper.make_member_name(participant) for participant in participants],
+        'get_members_mentions': lambda: mention_handler.get_members_mentions(participants),
+        'split_chunks': lambda: Helper.split_chunks(usernames, MentionHandler.MESSAGE_MENTION_LIMIT),
+        'inflect_word': lambda: [Helper.inflect_word(word, {'gent', 'plur'}) for word in words],
+        'get_non_winners': lambda: rating.aio_get_non_winners(),
+        'get_stat_message': lambda: rating_service.get_stat_message(rating, True),
+    }
+
+
+def make_common_cases() -> dict:
+    def get_words_lexeme_cold():
+        # Без кеша лексем, как при первом обращении к слову
+        Helper._get_lexeme.cache_clear()
+        return Helper.get_words_lexeme(rating_name=random.choice(RATING_NAMES))
+
+    return {
+        'get_words_lexeme': lambda: Helper.get_words_lexeme(rating_name='Пидор'),
+        'get_words_lexeme_cold': get_words_lexeme_cold,
+        **make_log_cases(),
+    }
+
+
+def make_log_cases() -> dict:
+    # Ленивые сообщения собираются уже в хендлере лога, поэтому ошибка построителя видна только при записи.
+    # Каждый кейс собирает сообщение целиком, как при записи в файл
+    chat = types.Chat(id=1, title='Чат', photo=types.ChatPhotoEmpty(), participants_count=2, date=None, version=1)
+    sender = types.User(id=2, username='user2', first_name='Иван')
+    telegram_event = SimpleNamespace(input_chat=types.InputPeerChat(chat.id))
+
+    message_event = MessageEventDTO.__new__(MessageEventDTO)
+    message_event.chat, message_event.chat_type, message_event.sender = chat, 'Chat', sender
+    message_event.telegram_event = telegram_event
+    message_event.message = SimpleNamespace(text='@all привет')
+
+    query_event = CallbackQueryEventDTO.__new__(CallbackQueryEventDTO)
+    query_event.chat, query_event.chat_type, query_event.sender = chat, 'Chat', sender
+    query_event.telegram_event = telegram_event
+    query_event.query_event = QueryEvent(sender.id, {'page': 1})
+
+    chat_action = ChatActionEventDTO.__new__(ChatActionEventDTO)
+    chat_action.user_ids, chat_action.is_self, chat_action.new_title = [sender.id], False, None
+    chat_action.user_added, chat_action.user_joined, chat_action.user_kicked, chat_action.user_left = True, False, False, False
+    chat_action.added_by, chat_action.kicked_by = sender, None
+
+    reply_to = SimpleNamespace(id=3, message='ответ', sender=sender)
+
+    return {
+        'log_message_event': lambda: str(InfoBuilder.build_message_info_by_message_event(
+            message_event, title='Message event', view_type=InfoBuilder.LAZY
+        )),
+        'log_query_event': lambda: str(InfoBuilder.build_message_info_by_query_event(
+            query_event, title='Callback Query event', view_type=InfoBuilder.LAZY
+        )),
+        'log_chat_action': lambda: str(InfoBuilder.build_message_info_by_chat_action(
+            chat_action, title='Chat Action event', view_type=InfoBuilder.LAZY
+        )),
+        'log_debug_message': lambda: str(InfoBuilder.build_debug_message_info(
+            chat, 'Привет\nмир', reply_to, view_type=InfoBuilder.LAZY
+        )),
+        'log_build_log': lambda: InfoBuilder.build_log('Stats', {'hits': 1, 'misses': 0}).get_payload(),
+    }
+
+
+def check_logs() -> list:
+    failed = []
+
+    for name, case in make_log_cases().items():
+        try:
+            case()
+            print(f'{name:<32} ok')
+        except Exception as ex:
+            failed.append(name)
+            print(f'{name:<32} {ex!r}')
+
+    return failed
+
+
+async def call(case: callable):
+    result = case()
+
+    if inspect.isawaitable(result):
+        result = await result
+
+    return result
+
+
+async def measure(case: callable, repeat: int) -> dict:
+    await call(case)
+    number = 1
+
+    # Подбирается число вызовов в пачке, чтобы время пачки не терялось в погрешности таймера
+    while True:
+        started = perf_counter()
+
+        for _ in range(number):
+            await call(case)
+
+        if perf_counter() - started >= MIN_BATCH_TIME:
+            break
+
+        number *= 2
+
+    times = []
+
+    for _ in range(repeat):
+        started = perf_counter()
+
+        for _ in range(number):
+            await call(case)
+
+        times.append((perf_counter() - started) / number)
+
+    return {'best': min(times), 'median': median(times), 'number': number}
+
+
+async def run(sizes: list, repeat: int, only: list = None) -> dict:
+    Helper.get_morph_analyzer()
+    results = {}
+
+    # Кейсы размера создаются перед запуском, так как модели привязаны к бд последнего созданного размера
+    for size in [None] + sizes:
+        size_cases = make_common_cases() if size is None else make_cases(size)
+
+        for name, case in size_cases.items():
+            if only and name not in only:
+                continue
+
+            key = name if size is None else f'{name}[{size}]'
+            results[key] = await measure(case, repeat)
+            print(f"{key:<32} best {results[key]['best'] * 1000:10.3f} ms   "
+                  f"median {results[key]['median'] * 1000:10.3f} ms")
+
+    return results
+
+
+def compare(baseline: dict, current: dict, threshold: float) -> list:
+    regressions = []
+
+    for key, result in current['results'].items():
+        base = baseline['results'].get(key)
+
+        if not base:
+            print(f'{key:<32} new')
+            continue
+
+        ratio = result['best'] / base['best'] if base['best'] else 1.0
+        mark = ''
+
+        if ratio > 1 + threshold:
+            mark = 'REGRESSION'
+            regressions.append(key)
+        elif ratio < 1 - threshold:
+            mark = 'faster'
+
+        print(f"{key:<32} {base['best'] * 1000:10.3f} ms -> {result['best'] * 1000:10.3f} ms   x{ratio:5.2f}  {mark}")
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Helpers and ratings hot paths benchmarks')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help='Run benchmarks and save results as json')
+    run_parser.add_argument('--sizes', type=int, nargs='+', default=SIZES, help='Chat sizes')
+    run_parser.add_argument('--repeat', type=int, default=REPEAT)
+    run_parser.add_argument('--only', nargs='+', help='Case names to run')
+    run_parser.add_argument('--output', default=os.path.join(BASELINES_FOLDER, 'current.json'))
+
+    compare_parser = subparsers.add_parser('compare', help='Compare results with a baseline')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('--threshold', type=float, default=THRESHOLD,
+                                help='Allowed slowdown share before a case is flagged')
+
+    subparsers.add_parser('check-logs', help='Build every lazy log message once')
+
+    args = parser.parse_args()
+
+    match args.command:
+        case 'run':
+            random.seed(0)
+            results = asyncio.run(run(args.sizes, args.repeat, args.only))
+            os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+
+            with open(args.output, 'w') as file:
+                json.dump({
+                    'created_at': datetime.now().isoformat(),
+                    'python': platform.python_version(),
+                    'platform': platform.platform(),
+                    'repeat': args.repeat,
+                    'results': results,
+                }, file, indent=2)
+
+            print(f'Saved to {args.output}')
+        case 'compare':
+            with open(args.baseline) as file:
+                baseline = json.load(file)
+
+            with open(args.current) as file:
+                current = json.load(file)
+
+            regressions = compare(baseline, current, args.threshold)
+
+            if regressions:
+                print(f"Regressions: {', '.join(regressions)}")
+                sys.exit(1)
+        case 'check-logs':
+            failed = check_logs()
+
+            if failed:
+                print(f"Failed: {', '.join(failed)}")
+                sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+# !/usr/bin/env python
+# Сравнение полного списка участников и потоковой обработки на больших чатах:
+# python benchmarks/participants.py --members 10000
+
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tracemalloc
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fsb.helpers import Helper  # noqa: E402
+
+PAGE_SIZE = 200
+MENTION_LIMIT = 141
+
+
+class FakeParticipant:
+    def __init__(self, id: int):
+        self.id = id
+        self.username = f'user{id}'
+        self.first_name = f'User {id}'
+        self.bot = id % 50 == 0
+        # Примерный объём полей telethon.tl.types.User
+        self.payload = bytes(600)
+
+
+class FakeDbMember:
+    def __init__(self, telegram_id: int):
+        self.telegram_id = telegram_id
+
+    def get_telegram_id(self):
+        return self.telegram_id
+
+
+async def iter_participants(members_count: int):
+    # Постраничная выдача как у iter_participants: одна страница на запрос к api
+    for offset in range(0, members_count, PAGE_SIZE):
+        await asyncio.sleep(0)
+
+        for id in range(offset, min(offset + PAGE_SIZE, members_count)):
+            yield FakeParticipant(id)
+
+
+async def list_collect(members_count: int, db_members: list):
+    members = [member async for member in iter_participants(members_count)]
+    return Helper.collect_members(members, db_members)
+
+
+async def stream_collect(members_count: int, db_members: list):
+    return await Helper.aio_collect_members(Helper.iter_chunks(iter_participants(members_count), PAGE_SIZE), db_members)
+
+
+async def list_mentions(members_count: int):
+    members = [member async for member in iter_participants(members_count)]
+    return len(Helper.split_chunks([member.username for member in members], MENTION_LIMIT))
+
+
+async def stream_mentions(members_count: int):
+    chunks = 0
+
+    async for chunk in Helper.iter_chunks(iter_participants(members_count), MENTION_LIMIT):
+        ''.join(member.username for member in chunk)
+        chunks += 1
+
+    return chunks
+
+
+async def measure(name: str, coroutine_factory, repeat: int):
+    times = []
+    peak = 0
+
+    for _ in range(repeat):
+        tracemalloc.start()
+        started = perf_counter()
+        await coroutine_factory()
+        times.append(perf_counter() - started)
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+
+    print(f'{name:<20} best {min(times) * 1000:8.1f} ms   peak memory {peak / 1024 / 1024:7.2f} MiB')
+
+
+async def main():
+    parser = argparse.ArgumentParser(description='Participants streaming benchmark')
+    parser.add_argument('--members', type=int, default=10000)
+    parser.add_argument('--db-members', type=int, default=50)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    db_members = [FakeDbMember(id) for id in random.sample(range(args.members), min(args.db_members, args.members))]
+
+    print(f'Chat with {args.members} members, {len(db_members)} rating members')
+    await measure('collect: list', lambda: list_collect(args.members, db_members), args.repeat)
+    await measure('collect: stream', lambda: stream_collect(args.members, db_members), args.repeat)
+    await measure('mentions: list', lambda: list_mentions(args.members), args.repeat)
+    await measure('mentions: stream', lambda: stream_mentions(args.members), args.repeat)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,220 @@
+# !/usr/bin/env python
+# Воспроизведение записанных апдейтов (update_recorder в config.yml) через контроллеры бота.
+# Telegram подменяется клиентом, который только считает исходящие запросы, бд используется настоящая,
+# поэтому запускать против локальной базы (docker-compose.local.yml):
+# python -m benchmarks.replay logs/recordings/updates-20261018-120000.jsonl --speedup 10
+
+import argparse
+import asyncio
+from collections import Counter
+from datetime import datetime
+from itertools import count
+from time import perf_counter
+
+from telethon import TelegramClient, utils
+from telethon.sessions import MemorySession
+from telethon.tl import types
+from telethon.tl.patched import Message
+
+from fsb.db import database
+from fsb.helpers import Metrics
+from fsb.loaders import ControllerLoader
+from fsb.telegram.client import TelegramApiClient
+from fsb.telegram.recorder import UpdateRecorder
+
+
+class ReplayTelegramClient(TelegramClient):
+    # Настоящий TelegramClient без подключения: апдейты проходят через его диспетчер событий,
+    # а исходящие запросы только считаются и отвечают после заданной задержки
+    def __init__(self, self_user: types.User, rpc_latency: float = 0):
+        super().__init__(MemorySession(), 1, 'replay')
+        self.self_user = self_user
+        self.rpc_latency = rpc_latency
+        self.calls = Counter()
+        self.entities = {}
+        self.chats_members = {}
+        self._messages_ids = count(1)
+        self._self_input_peer = utils.get_input_peer(self_user, allow_self=False)
+        self._bot = True
+
+    async def feed(self, update, entities: list):
+        for entity in entities:
+            self.entities[utils.get_peer_id(entity)] = self.entities[entity.id] = entity
+
+        container = types.Updates(
+            updates=[update],
+            users=[entity for entity in entities if isinstance(entity, types.User)],
+            chats=[entity for entity in entities if not isinstance(entity, types.User)],
+            date=datetime.now(),
+            seq=0
+        )
+        self.session.process_entities(container)
+        self._entity_cache.add(container)
+        update._entities = {utils.get_peer_id(entity): entity for entity in entities}
+        self._remember_members(update, entities)
+
+        await self._dispatch_update(update, None, None, None)
+
+    def _remember_members(self, update, entities: list):
+        message = getattr(update, 'message', None)
+
+        if not isinstance(message, (types.Message, types.MessageService)):
+            return
+
+        members = self.chats_members.setdefault(utils.get_peer_id(message.peer_id), {})
+
+        for entity in entities:
+            if isinstance(entity, types.User) and not entity.is_self:
+                members[entity.id] = entity
+
+    async def _rpc(self, name: str):
+        self.calls[name] += 1
+
+        if self.rpc_latency:
+            await asyncio.sleep(self.rpc_latency)
+
+    async def __call__(self, request, ordered=False, flood_sleep_threshold=None):
+        await self._rpc(request.__class__.__name__)
+
+    async def _get_difference(self, update, channel_id, pts_date):
+        # Сущности, которых нет в записи, взять неоткуда: запрос только учитывается
+        await self._rpc('get_difference')
+
+    async def get_me(self, input_peer=False):
+        return self._self_input_peer if input_peer else self.self_user
+
+    async def get_entity(self, entity):
+        if isinstance(entity, int) and entity in self.entities:
+            return self.entities[entity]
+
+        await self._rpc('get_entity')
+        raise ValueError(f'Could not find the entity {entity}')
+
+    async def get_messages(self, *args, **kwargs):
+        await self._rpc('get_messages')
+
+    async def iter_participants(self, entity, *args, **kwargs):
+        await self._rpc('iter_participants')
+
+        for member in list(self.chats_members.get(utils.get_peer_id(entity), {}).values()):
+            member.participant = None
+            yield member
+
+    async def send_message(self, entity, message='', **kwargs):
+        await self._rpc('send_message')
+        return self._make_message(entity, message)
+
+    async def send_file(self, entity, file, **kwargs):
+        await self._rpc('send_file')
+        return self._make_message(entity, '')
+
+    async def edit_message(self, entity, message=None, text=None, **kwargs):
+        await self._rpc('edit_message')
+        return self._make_message(entity, text or '')
+
+    def _make_message(self, entity, text) -> Message:
+        message = Message(
+            id=next(self._messages_ids),
+            peer_id=utils.get_peer(entity),
+            date=datetime.now(),
+            message=text if isinstance(text, str) else '',
+            out=True
+        )
+        message._finish_init(self, self.entities, None)
+
+        return message
+
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+
+    values = sorted(values)
+
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+async def replay(path: str, speedup: float, rpc_latency: float, concurrency: int) -> dict:
+    records = UpdateRecorder.read(path)
+    header = next(records)
+    self_user = types.User(id=header['self_id'], is_self=True, bot=True, access_hash=0,
+                           username=header['bot_username'], first_name='Bot')
+    backend = ReplayTelegramClient(self_user, rpc_latency)
+    client = TelegramApiClient(header['bot_username'], telegram_client=backend)
+    client._current_user = self_user
+    ControllerLoader(client).run_objects()
+
+    latencies = []
+    types_counter = Counter()
+    semaphore = asyncio.Semaphore(concurrency)
+    queries_before = database.stats['queries']
+    tasks = set()
+
+    async def dispatch(update, entities: list):
+        async with semaphore:
+            started = perf_counter()
+            await backend.feed(update, entities)
+            latencies.append(perf_counter() - started)
+
+    started = perf_counter()
+
+    for record in records:
+        # Сохраняется исходный ритм апдейтов, ускоренный в speedup раз; 0 - без пауз
+        if speedup:
+            delay = record['t'] / speedup - (perf_counter() - started)
+
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+        types_counter[record['type']] += 1
+        task = asyncio.create_task(dispatch(record['update'], record['entities']))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    while tasks:
+        await asyncio.gather(*list(tasks))
+
+    elapsed = perf_counter() - started
+
+    return {
+        'updates': len(latencies),
+        'updates_by_type': dict(types_counter),
+        'time': round(elapsed, 3),
+        'updates_per_second': round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        'update_latency_ms': {
+            'p50': round(percentile(latencies, 0.5) * 1000, 2),
+            'p99': round(percentile(latencies, 0.99) * 1000, 2),
+            'max': round(max(latencies, default=0) * 1000, 2),
+        },
+        'handles': Metrics.get_summary().get(Metrics.HANDLE, {}),
+        'db_queries': database.stats['queries'] - queries_before,
+        'telegram_calls': dict(backend.calls),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay recorded updates through the bot controllers')
+    parser.add_argument('path', help='Recording made by update_recorder')
+    parser.add_argument('--speedup', type=float, default=1, help='Replay speed multiplier, 0 - as fast as possible')
+    parser.add_argument('--rpc-latency', type=float, default=0.05, help='Simulated Telegram API latency, seconds')
+    parser.add_argument('--concurrency', type=int, default=100, help='Max updates handled at the same time')
+    args = parser.parse_args()
+
+    backend_loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(backend_loop)
+    report = backend_loop.run_until_complete(replay(args.path, args.speedup, args.rpc_latency, args.concurrency))
+
+    print(f"Updates: {report['updates']} in {report['time']} s ({report['updates_per_second']} per second)")
+    print(f"Update latency: p50 {report['update_latency_ms']['p50']} ms, "
+          f"p99 {report['update_latency_ms']['p99']} ms, max {report['update_latency_ms']['max']} ms")
+    print(f"DB queries: {report['db_queries']}")
+    print(f"Telegram calls: {report['telegram_calls']}")
+    print('Handles:')
+
+    for handle, stats in report['handles'].items():
+        print(f"  {handle:<50} count {stats['count']:6}   p50 {stats['p50'] * 1000:8.1f} ms   "
+              f"p99 {stats['p99'] * 1000:8.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
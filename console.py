@@ -3,8 +3,10 @@
 from fsb.console import cli
 from fsb.console.birthday import birthday
 from fsb.console.common import dude_broadcast, new_year_broadcast
+from fsb.console.content import content
 from fsb.console.message import send_message_command, countdown
 from fsb.console.migrator import migrator_cli
+from fsb.console.query_events import query_events
 from fsb.console.ratings import ratings
 
 cli.add_command(migrator_cli)
@@ -14,6 +16,8 @@ cli.add_command(dude_broadcast)
 cli.add_command(new_year_broadcast)
 cli.add_command(countdown)
 cli.add_command(birthday)
+cli.add_command(query_events)
+cli.add_command(content)
 
 if __name__ == "__main__":
     cli()
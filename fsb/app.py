@@ -3,9 +3,15 @@ import logging
 from time import sleep
 
 from fsb.config import config
+from fsb.db.helpers import CallbackData
+from fsb.helpers import Helper
+from fsb.jobs import SYSTEM_JOBS
 from fsb.loaders import ControllerLoader
-from fsb.services import ChatService, CronService
+from fsb.services import (
+    ChatService, ContentService, CronService, MetricsService, QuantumRandService, QueryEventService
+)
 from fsb.telegram.client import TelegramApiClient
+from fsb.telegram.recorder import UpdateRecorder
 
 
 class FeatureStorageBot:
@@ -13,22 +19,49 @@ class FeatureStorageBot:
     STOP_TIMEOUT = 60
 
     def __init__(self):
+        # Без секрета подписи кнопок бот не запускается
+        CallbackData.get_secret()
         self.client = TelegramApiClient(config.BOT_USERNAME)
         self.loop = self.client.loop
         self.controller_loader = ControllerLoader(self.client)
         self.logger = logging.getLogger('main')
+        self._background_tasks = []
+        self._metrics_server = None
+        self._update_recorder = None
 
     def run(self):
         async def before(client):
             await client.connect(True)
-            await ChatService(client).init_chats()
-            await CronService(client).run()
+            Helper.get_morph_analyzer()
+            ContentService.load_all()
+            self._background_tasks.append(client.loop.create_task(MetricsService.run()))
+
+            if config.metrics.http_enabled:
+                self._metrics_server = await MetricsService.serve(client)
+
+            self._background_tasks.append(client.loop.create_task(QuantumRandService.run()))
+            chat_service = ChatService(client)
+
+            if config.chats_init.background:
+                self._background_tasks.append(client.loop.create_task(chat_service.init_chats()))
+            else:
+                await chat_service.init_chats()
+
+            self._background_tasks.append(client.loop.create_task(chat_service.run_members_reconciliation()))
+            self._background_tasks.append(client.loop.create_task(QueryEventService.run()))
+            cron_service = CronService(client)
+            await cron_service.run()
+            cron_service.enable_system_jobs(SYSTEM_JOBS)
 
         self.loop.run_until_complete(before(self.client))
         self.logger.info(f"Development mode is {'ON' if config.FSB_DEV_MODE else 'OFF'}")
         self.logger.info(f"Fool day mode is {'ON' if config.FOOL_DAY else 'OFF'}")
         self.controller_loader.run_objects()
 
+        if config.update_recorder.enabled:
+            self._update_recorder = UpdateRecorder(self.client, self.controller_loader.get_mention_triggers())
+            self._update_recorder.listen()
+
         try:
             self.client.start()
         except KeyboardInterrupt:
@@ -37,6 +70,9 @@ class FeatureStorageBot:
     def stop(self):
         self.logger.info("Bot stopping ...")
 
+        if self._update_recorder:
+            self._update_recorder.close()
+
         if self.loop.is_running():
             exit_task = self.loop.create_task(self.client.exit())
         else:
@@ -11,3 +11,4 @@ config.set('BUILD', config.get('BUILD_VERSION', default_value='Unknown'))
 config.set('FSB_DEV_MODE', config.get('FSB_DEV_MODE', cast=BoolConverter(), default_value=False))
 config.set('ROOT_FOLDER', os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 config.set('FOOL_DAY', config.get('FOOL_DAY', cast=BoolConverter(), default_value=False))
+config.set('CRON_FALLBACK', config.get('CRON_FALLBACK', cast=BoolConverter(), default_value=False))
@@ -1,12 +1,9 @@
 # !/usr/bin/env python
 
-from time import sleep
-
 import click
 
+from fsb import jobs
 from fsb.console import client, coro
-from fsb.db.models import Chat, Module
-from fsb.services import BirthdayService
 
 
 @click.group('birthday')
@@ -19,12 +16,7 @@ def birthday():
 @coro
 async def congratulation():
     """Sending a birthday message to chats"""
-
-    birthday_service = BirthdayService(client)
-
-    for chat in Chat.with_enabled_module(Module.MODULE_BIRTHDAY):
-        await birthday_service.send_message(chat)
-        sleep(1)
+    await jobs.birthday_congratulation(client)
 
 
 birthday.add_command(congratulation)
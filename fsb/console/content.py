@@ -0,0 +1,51 @@
+# !/usr/bin/env python
+
+import click
+
+from fsb.console import coro
+from fsb.db.models import Chat, ChatContent
+
+
+@click.group('content')
+def content():
+    """Chat custom content commands"""
+    pass
+
+
+@click.command('add')
+@click.argument('chat_id', type=int)
+@click.argument('kind', type=click.Choice(ChatContent.KINDS_LIST))
+@click.argument('text', type=str)
+@click.option('--key', type=str, default='', help='Rating command for rolling scripts and congratulations')
+@coro
+async def add(chat_id, kind, text, key):
+    """Adding a custom message to the chat set (use \\n for lines of a rolling script)"""
+
+    chat = await Chat.aio_get(chat_id)
+    chat_content = await ChatContent.aio_create(chat=chat, kind=kind, key=key, text=text.replace('\\n', '\n'))
+    click.echo(f'Added content {chat_content.id} for chat {chat.name}')
+
+
+@click.command('list')
+@click.argument('chat_id', type=int)
+@coro
+async def list_command(chat_id):
+    """Showing custom messages of the chat"""
+
+    for chat_content in await ChatContent.select().where(ChatContent.chat == chat_id).aio_execute():
+        click.echo(f"[{chat_content.id}] {chat_content.kind} {chat_content.key or '-'}: {chat_content.text}")
+
+
+@click.command('delete')
+@click.argument('content_id', type=int)
+@coro
+async def delete(content_id):
+    """Deleting a custom message"""
+
+    deleted = await ChatContent.delete().where(ChatContent.id == content_id).aio_execute()
+    click.echo(f'Deleted {deleted} content')
+
+
+content.add_command(add)
+content.add_command(list_command, 'list')
+content.add_command(delete)
@@ -2,7 +2,7 @@
 
 import click
 
-from fsb.db import db_manager
+from fsb.db import get_db_manager
 
 
 @click.group('migrator')
@@ -15,6 +15,8 @@ def migrator_cli():
 @click.option('-d', help='Dry run', is_flag=True, default=False)
 @click.option('-y', help='Force confirm', is_flag=True, default=False)
 def action_migrate(count, d: bool, y: bool):
+    db_manager = get_db_manager()
+
     if not db_manager.diff:
         click.echo('No new migrations')
         return
@@ -32,6 +34,8 @@ def action_migrate(count, d: bool, y: bool):
 @click.option('-d', help='Dry run', is_flag=True, default=False)
 @click.option('-y', help='Force confirm', is_flag=True, default=False)
 def action_rollback(count, d: bool, y: bool):
+    db_manager = get_db_manager()
+
     if not db_manager.db_migrations:
         click.echo('No applied migrations')
         return
@@ -46,25 +50,27 @@ def action_rollback(count, d: bool, y: bool):
 
 @click.command('status')
 def action_status():
-    db_manager.status()
+    get_db_manager().status()
 
 
 @click.command('create')
 @click.argument('name', type=str)
 def action_create(name):
-    db_manager.revision(name)
+    get_db_manager().revision(name)
 
 
 @click.command('create-model')
 @click.argument('model', type=str)
 def action_create_model(model):
-    db_manager.create('fsb.db.models.' + model)
+    get_db_manager().create('fsb.db.models.' + model)
 
 
 @click.command('delete')
 @click.argument('name', type=str)
 @click.option('-y', help='Force confirm', is_flag=True, default=False)
 def action_delete(name, y: bool):
+    db_manager = get_db_manager()
+
     if not y:
         click.confirm(f'Delete migration: {db_manager.find_migration(name)}?', abort=True)
     db_manager.delete(name)
@@ -0,0 +1,44 @@
+# !/usr/bin/env python
+
+import click
+
+from fsb.console import coro
+from fsb.events import cron, modules, ratings, roles
+from fsb.services import QueryEventService
+
+# Классы событий регистрируются при импорте, без них ttl по классам не применится
+EVENT_MODULES = (cron, modules, ratings, roles)
+
+
+@click.group('query-events')
+def query_events():
+    """Query events storage commands"""
+    pass
+
+
+@click.command('sweep')
+@coro
+async def sweep():
+    """Deleting expired query events"""
+
+    deleted = await QueryEventService.sweep()
+    click.echo(f'Deleted {deleted} query events')
+
+
+@click.command('partition')
+@click.option('--months-ahead', type=int, default=None, help='Number of future monthly partitions')
+@coro
+async def partition(months_ahead):
+    """Adding missing monthly partitions to the partitioned query events table"""
+
+    partitions = await QueryEventService.partition(months_ahead)
+
+    if partitions is None:
+        click.echo('Query events table is not partitioned: set query_events.partitioning and run the migrations')
+        return
+
+    click.echo(f"Added partitions: {', '.join(partitions) if partitions else 'none'}")
+
+
+query_events.add_command(sweep)
+query_events.add_command(partition)
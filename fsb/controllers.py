@@ -3,16 +3,17 @@
 import inspect
 import logging
 import re
-from asyncio import sleep
 from datetime import datetime
+from time import perf_counter
 from typing import Type
 
 from peewee import DoesNotExist
+from telethon import utils
 from telethon.events import NewMessage, CallbackQuery, ChatAction
 
 from fsb.config import config
 from fsb.db.models import QueryEvent, Role, Chat, Module
-from fsb.errors import ExitControllerException
+from fsb.errors import DuplicateHandlerError, ExitControllerException
 from fsb.events.common import (
     EventDTO, MessageEventDTO, CallbackQueryEventDTO, MenuEventDTO, ChatActionEventDTO, CommandEventDTO,
     MentionEventDTO
@@ -33,14 +34,12 @@ from fsb.handlers.ratings import (
     RatingsSettingsQueryHandler
 )
 from fsb.handlers.roles import RolesSettingsCommandHandler, RolesSettingsQueryHandler
-from fsb.helpers import InfoBuilder, Helper
+from fsb.helpers import InfoBuilder, Helper, ChatLock, Metrics
 from fsb.services import ChatService
 from fsb.telegram.client import TelegramApiClient
 
 
 class Controller:
-    MAX_WAITING = 60
-
     _event_class = EventDTO
     _from_bot = False
     _from_user = True
@@ -49,7 +48,6 @@ class Controller:
         self._client = client
         self._loop = client.loop
         self._controller_name = self.__class__.__name__
-        self._waiting_list = {}
         self.logger = logging.getLogger('main')
 
     def listen(self):
@@ -71,36 +69,30 @@ class Controller:
         return handle_list
 
     async def handle(self, event: EventDTO):
-        if event.chat.id in self._waiting_list:
-            time = 0
-            while self._waiting_list[event.chat.id]:
-                await sleep(1)
-                time += 1
-                if time >= self.MAX_WAITING:
-                    raise TimeoutError
-
         await self._init_filter(event)
 
-        db_chat = await ChatService(self._client).create_chat(event=event, update=True)
+        db_chat = await ChatService(self._client).create_chat(event=event, update=True, sync_members=False)
 
         if not db_chat or db_chat.is_deleted():
             raise ExitControllerException
 
-        self.check_module(event)
+        event.db_chat = db_chat
+        await self.check_module(event)
 
         self.logger.info(f"Start controller {self._controller_name}")
 
     @staticmethod
-    def check_module(event, module_name: str = None, raise_exit_exception: bool = True) -> bool:
+    async def check_module(event, module_name: str = None, raise_exit_exception: bool = True) -> bool:
         module_name = module_name if module_name else event.module_name
-        module = Module.get_by_id(module_name)
+        module = await Module.aio_get_cached(module_name)
+        chat = event.db_chat if event.db_chat else await Chat.aio_get_by_telegram_id(event.telegram_event.chat.id)
         result = False
         exception = None
 
         if not module.active:
             exception = ExitControllerException(sending_message='Модуль "{module_name}" не активен'
                                           .format(module_name=module.get_readable_name()))
-        elif not Chat.get_by_telegram_id(event.telegram_event.chat.id).is_enabled_module(module_name):
+        elif not await chat.aio_is_enabled_module(module_name):
             exception = ExitControllerException(sending_message='В чате не включен модуль "{module_name}"'
                                           .format(module_name=module.get_readable_name()))
         else:
@@ -114,21 +106,32 @@ class Controller:
     @staticmethod
     def handle_decorator(callback: callable):
         async def handle(self, event):
+            started = perf_counter()
+            handle_name = f"{self._controller_name}.{callback.__name__}"
+            result = 'accepted'
+
             try:
-                event = self._event_class(event)
+                if not isinstance(event, EventDTO):
+                    event = self._event_class(event)
                 await callback(self, event)
             except ExitControllerException as ex:
+                result = 'rejected'
+
                 if ex.class_name or ex.reason:
                     self.logger.warning(ex.message)
 
                 if ex.sending_message:
                     await self._client.send_message(event.telegram_event.chat.id, ex.sending_message)
             except DoesNotExist as ex:
+                result = 'not_found'
                 self.logger.warning(ex.__class__.__name__.replace(DoesNotExist.__name__, '') + ' does not exist')
             except Exception as ex:
+                result = 'error'
                 self.logger.exception(ex.args)
             finally:
-                self.stop_wait(event.chat.id)
+                # Отклонённые фильтрами события тоже замеряются, со своей меткой результата
+                Metrics.observe(Metrics.HANDLE, handle_name, perf_counter() - started, result=result)
+                Metrics.inc('controller_events', handle=handle_name, result=result)
         return handle
 
     async def _init_filter(self, event: EventDTO):
@@ -146,16 +149,6 @@ class Controller:
         if not area_check:
             raise ExitControllerException
 
-    def _set_wait(self, chat_id: int, value: bool):
-        self._waiting_list[chat_id] = value
-
-    def start_wait(self, chat_id: int):
-        self._set_wait(chat_id, True)
-
-    def stop_wait(self, chat_id: int):
-        if chat_id in self._waiting_list:
-            self._set_wait(chat_id, False)
-
     async def run_handler(self, event: EventDTO, handler_class: Type[Handler]):
         return await handler_class(event, self._client).run()
 
@@ -163,8 +156,26 @@ class Controller:
 class MessageController(Controller):
     _event_class = MessageEventDTO
 
+    def __init__(self, client: 'TelegramApiClient', dispatcher: 'MessageDispatcher' = None):
+        super().__init__(client)
+        self._dispatcher = dispatcher if dispatcher else MessageDispatcher(client)
+
     def _listen_handle(self, handle: callable):
-        self._client.add_event_handler(handle, NewMessage(forwards=False))
+        self._dispatcher.add_handle(self, handle)
+
+    @staticmethod
+    def command_decorator(*command_names: str):
+        def decorator(callback: callable):
+            callback.command_names = list(command_names)
+            return callback
+        return decorator
+
+    @staticmethod
+    def mention_decorator(*triggers: str):
+        def decorator(callback: callable):
+            callback.mention_triggers = list(triggers)
+            return callback
+        return decorator
 
     async def _init_filter(self, event: MessageEventDTO):
         await super()._init_filter(event)
@@ -175,36 +186,51 @@ class MessageController(Controller):
     async def handle(self, event: MessageEventDTO):
         await super().handle(event)
         self.logger.info(
-            "Message event:\n" +
-            InfoBuilder.build_message_info_by_message_event(event)
+            InfoBuilder.build_message_info_by_message_event(event, title='Message event', view_type=InfoBuilder.LAZY),
+            extra={'sample': True}
         )
 
 
 class CallbackQueryController(Controller):
     _event_class = CallbackQueryEventDTO
 
+    EXPIRED_MESSAGE = 'Меню устарело, откройте его заново'
+
     def _listen_handle(self, handle: callable):
         self._client.add_event_handler(handle, CallbackQuery())
 
     async def _init_filter(self, event: CallbackQueryEventDTO):
         await super()._init_filter(event)
 
-        query_event = QueryEvent.find_and_create(int(event.data))
+        query_event = await self._find_query_event(event)
 
         if not isinstance(query_event, event.query_event_class):
             raise ExitControllerException
 
         event.query_event = query_event
 
+    async def _find_query_event(self, event: CallbackQueryEventDTO):
+        # Telethon передаёт один объект события всем обработчикам кнопок, поэтому ищем и отвечаем один раз
+        telegram_event = event.telegram_event
+
+        if not hasattr(telegram_event, 'fsb_query_event'):
+            telegram_event.fsb_query_event = await QueryEvent.aio_find_by_callback_data(event.data)
+
+            if telegram_event.fsb_query_event is None:
+                await telegram_event.answer(self.EXPIRED_MESSAGE, alert=True)
+
+        return telegram_event.fsb_query_event
+
     async def handle(self, event: CallbackQueryEventDTO):
         await super().handle(event)
 
-        event.query_event.last_usage_date = datetime.now()
-        event.query_event.save()
+        # Подписанные кнопки в бд не хранятся, обновлять нечего
+        if event.query_event.id:
+            await QueryEvent.update(last_usage_date=datetime.now()).where(QueryEvent.id == event.query_event.id).aio_execute()
 
         self.logger.info(
-            "Callback Query event:\n" +
-            InfoBuilder.build_message_info_by_query_event(event)
+            InfoBuilder.build_message_info_by_query_event(event, title='Callback Query event', view_type=InfoBuilder.LAZY),
+            extra={'sample': True}
         )
 
 
@@ -260,8 +286,8 @@ class ChatActionController(Controller):
     async def chat_action_handle(self, event: ChatActionEventDTO):
         await super().handle(event)
         self.logger.info(
-            f"Chat Action event:\n" +
-            InfoBuilder.build_message_info_by_chat_action(event)
+            InfoBuilder.build_message_info_by_chat_action(event, title='Chat Action event', view_type=InfoBuilder.LAZY),
+            extra={'sample': True}
         )
 
 
@@ -273,98 +299,106 @@ class CommandController(MessageController):
     async def _init_filter(self, event: CommandEventDTO):
         await super()._init_filter(event)
 
-        if event.message.text:
-            args = event.message.text.split(' ')
-            command = args[0].replace(f'@{self._client._current_user.username}', '').replace(self.PREFIX, '', 1)
-            if args[0].startswith(self.PREFIX) and command in event.command_names:
-                args.pop(0)
-                event.args = args
-                event.command = command
-                return
+        if event.command is None and event.message.text:
+            event.command, event.args = self.parse_command(event.message.text, self._client._current_user.username)
+
+        if event.command not in event.command_names:
+            raise ExitControllerException
+
+        # Команды чата ждут окончания текущего ролла, чтобы не перемешивать ответы
+        await ChatLock.wait(event.chat.id)
+
+    @classmethod
+    def parse_command(cls, text: str, bot_username: str = None) -> tuple:
+        args = text.split(' ')
+
+        if not args[0].startswith(cls.PREFIX):
+            return None, []
+
+        command = args.pop(0).replace(cls.PREFIX, '', 1)
 
-        raise ExitControllerException
+        if bot_username:
+            command = command.replace(f'@{bot_username}', '')
 
+        return command, args
+
+    @MessageController.command_decorator('start')
     @Controller.handle_decorator
     async def start_handle(self, event: CommandEventDTO):
-        event.command_names = ['start']
-
         await super().handle(event)
         await self.run_handler(event, StartCommandHandler)
 
+    @MessageController.command_decorator('ping')
     @Controller.handle_decorator
     async def ping_handle(self, event: CommandEventDTO):
-        event.command_names = ['ping']
         event.debug = False
 
         await super().handle(event)
         await self.run_handler(event, PingCommandHandler)
 
+    @MessageController.command_decorator('entity')
     @Controller.handle_decorator
     async def entity_info_handle(self, event: CommandEventDTO):
-        event.command_names = ['entity']
         event.debug = True
 
         await super().handle(event)
         await self.run_handler(event, EntityInfoCommandHandler)
 
+    @MessageController.command_decorator('about')
     @Controller.handle_decorator
     async def about_handle(self, event: CommandEventDTO):
-        event.command_names = ['about']
-
         await super().handle(event)
         await self.run_handler(event, AboutInfoCommandHandler)
 
+    @MessageController.command_decorator('roles')
     @Controller.handle_decorator
     async def role_settings_handle(self, event: CommandEventDTO):
-        event.command_names = ['roles']
         event.area = event.ONLY_CHAT
         event.module_name = Module.MODULE_ROLES
 
         await super().handle(event)
         await self.run_handler(event, RolesSettingsCommandHandler)
 
+    @MessageController.command_decorator('ratings')
     @Controller.handle_decorator
     async def ratings_settings_handle(self, event: CommandEventDTO):
-        event.command_names = ['ratings']
         event.area = event.ONLY_CHAT
         event.module_name = Module.MODULE_RATINGS
 
         await super().handle(event)
         await self.run_handler(event, RatingsSettingsCommandHandler)
 
+    @MessageController.command_decorator(
+        RatingCommandHandler.DAY_COMMAND, RatingCommandHandler.MONTH_COMMAND, RatingCommandHandler.YEAR_COMMAND
+    )
     @Controller.handle_decorator
     async def ratings_handle(self, event: CommandEventDTO):
-        event.command_names = [
-            RatingCommandHandler.DAY_COMMAND, RatingCommandHandler.MONTH_COMMAND,
-            RatingCommandHandler.YEAR_COMMAND,
-        ]
         event.area = event.ONLY_CHAT
         event.module_name = Module.MODULE_RATINGS
 
         await super().handle(event)
-        self.start_wait(event.chat.id)
         await self.run_handler(event, RatingCommandHandler)
-        self.stop_wait(event.chat.id)
 
+    @MessageController.command_decorator(
+        StatRatingCommandHandler.STAT_COMMAND, StatRatingCommandHandler.STAT_ALL_COMMAND
+    )
     @Controller.handle_decorator
     async def ratings_stats_handle(self, event: CommandEventDTO):
-        event.command_names = [StatRatingCommandHandler.STAT_COMMAND, StatRatingCommandHandler.STAT_ALL_COMMAND]
         event.area = event.ONLY_CHAT
         event.module_name = Module.MODULE_RATINGS
 
         await super().handle(event)
         await self.run_handler(event, StatRatingCommandHandler)
 
+    @MessageController.command_decorator('modules')
     @Controller.handle_decorator
     async def modules_settings_handle(self, event: CommandEventDTO):
-        event.command_names = ['modules']
-
         await super().handle(event)
         await self.run_handler(event, ModulesSettingsCommandHandler)
 
+    @MessageController.command_decorator('cron')
     @Controller.handle_decorator
     async def cron_settings_handle(self, event: CommandEventDTO):
-        event.command_names = ['cron']
         event.module_name = Module.MODULE_CRON
 
         await super().handle(event)
@@ -373,25 +407,44 @@ class CommandController(MessageController):
 
 class MentionController(MessageController):
     _event_class = MentionEventDTO
+    MENTION_PATTERN = re.compile(r"(?:\s+|^)@([^\s@]+)")
 
     async def _init_filter(self, event: MentionEventDTO):
         await super()._init_filter(event)
-        if event.message.text.startswith(CommandController.PREFIX) \
-                or not re.search(r"(\s+|^)@([^\s]+)", event.message.text):
+
+        if not event.mentions and not event.message.text.startswith(CommandController.PREFIX):
+            event.mentions = self.parse_mentions(event.message.text)
+
+        if not event.mentions:
             raise ExitControllerException
-        event.mentions = [matches[1] for matches in re.findall(r"(\s+|^)@([^\s@]+)", event.message.text)]
 
+    @classmethod
+    def parse_mentions(cls, text: str) -> list:
+        if '@' not in text:
+            return []
+
+        return cls.MENTION_PATTERN.findall(text)
+
+    @MessageController.mention_decorator('all')
     @Controller.handle_decorator
-    async def mention_handle(self, event: MentionEventDTO):
+    async def all_mention_handle(self, event: MentionEventDTO):
         await super().handle(event)
 
-        if self._mention_filter('all', event):
-            members_mentions_chunks = await self._all_mention_handle(event)
-            messages = ['📣' + ''.join(members_mentions) for members_mentions in members_mentions_chunks]
-        else:
-            members_mentions_chunks = await self._custom_mention_handle(event)
-            messages = [', '.join(members_mentions) for members_mentions in members_mentions_chunks]
+        # Сообщения уходят по мере получения участников, не дожидаясь всего списка
+        async for members_mentions in self._all_mention_handle(event):
+            await self._send_mentions(event, ['📣' + ''.join(members_mentions)])
+
+    @MessageController.mention_decorator()
+    @Controller.handle_decorator
+    async def custom_mention_handle(self, event: MentionEventDTO):
+        await super().handle(event)
+        members_mentions_chunks = await self._custom_mention_handle(event)
+        await self._send_mentions(
+            event,
+            [', '.join(members_mentions) for members_mentions in members_mentions_chunks]
+        )
 
+    async def _send_mentions(self, event: MentionEventDTO, messages: list):
         for message in messages:
             await self._client.send_message(
                 event.chat,
@@ -399,29 +452,18 @@ class MentionController(MessageController):
                 event.message
             )
 
-    def _mention_filter(self, mentions: list|str, event: MentionEventDTO):
-        mentions = [mentions] if isinstance(mentions, str) else mentions
-
-        for mention in mentions:
-            if mention in event.mentions:
-                return True
-        return False
-
     async def _all_mention_handle(self, event: MentionEventDTO):
-        mentions = await self.run_handler(event, AllMentionHandler)
-
-        return Helper.split_chunks(mentions, AllMentionHandler.MESSAGE_MENTION_LIMIT)
+        async for mentions in AllMentionHandler(event, self._client).iter_mentions():
+            yield mentions
 
     async def _custom_mention_handle(self, event: MentionEventDTO):
-        if not self.check_module(event, Module.MODULE_ROLES, False):
+        if not await self.check_module(event, Module.MODULE_ROLES, False):
             return []
 
-        chat = Chat.get_by_telegram_id(event.chat.id)
-
         members_mentions = []
-        mention_list = [role.nickname for role in Role.find_by_chat(chat)]
 
-        if self._mention_filter(mention_list, event):
+        # Теги ролей уже найдены диспетчером
+        if event.triggers:
             members_mentions = await self.run_handler(event, CustomMentionHandler)
 
         return Helper.split_chunks(members_mentions, CustomMentionHandler.MESSAGE_MENTION_LIMIT)
@@ -433,11 +475,115 @@ class FoolCommandController(CommandController):
 
 
 class FoolMentionController(MentionController):
+    @MessageController.mention_decorator('all', 'allrank')
+    @Controller.handle_decorator
+    async def all_mention_handle(self, event: MentionEventDTO):
+        await super().handle(event)
+        await FoolHandler(event, self._client).run()
+
+    @MessageController.mention_decorator()
     @Controller.handle_decorator
-    async def mention_handle(self, event: MentionEventDTO):
+    async def custom_mention_handle(self, event: MentionEventDTO):
         await super().handle(event)
-        mention_list = ([role.nickname for role in Role.find_by_chat(Chat.get_by_telegram_id(event.chat.id))]
-                        + ['all', 'allrank'])
 
-        if self._mention_filter(mention_list, event):
+        if event.triggers:
             return await FoolHandler(event, self._client).run()
+
+
+class MessageDispatcher:
+    def __init__(self, client: TelegramApiClient):
+        self._client = client
+        self._commands = {}
+        self._mentions = {}
+        self._wildcard_mentions = []
+        self._listening = False
+        self.logger = logging.getLogger('main')
+
+    def listen(self):
+        if self._listening:
+            return
+
+        self._client.add_event_handler(self.dispatch, NewMessage(forwards=False))
+        self._listening = True
+        self.logger.info(f"Add dispatcher: {self.__class__.__name__} [commands: {', '.join(self._commands)}; "
+                         f"mentions: {', '.join(self._mentions)}]")
+
+    def add_handle(self, controller: MessageController, handle: callable):
+        command_names = getattr(handle, 'command_names', None)
+        mention_triggers = getattr(handle, 'mention_triggers', None)
+
+        if command_names is not None:
+            for command_name in command_names:
+                # Иначе обработчик команды молча зависел бы от порядка загрузки контроллеров
+                if command_name in self._commands:
+                    registered_controller = self._commands[command_name][0]
+                    raise DuplicateHandlerError(
+                        f"/{command_name} of {controller.__class__.__name__}",
+                        f"{self.__class__.__name__} (already handled by {registered_controller.__class__.__name__})"
+                    )
+
+                self._commands[command_name] = (controller, handle)
+        elif mention_triggers is not None:
+            if mention_triggers:
+                for trigger in mention_triggers:
+                    self._mentions.setdefault(trigger, []).append((controller, handle))
+            else:
+                self._wildcard_mentions.append((controller, handle))
+
+    def get_mention_triggers(self) -> set:
+        return set(self._mentions)
+
+    async def dispatch(self, event: NewMessage.Event):
+        text = event.message.text
+
+        if not text:
+            return
+
+        if text.startswith(CommandController.PREFIX):
+            await self._dispatch_command(event, text)
+        else:
+            await self._dispatch_mention(event, text)
+
+    async def _dispatch_command(self, event: NewMessage.Event, text: str):
+        command, args = CommandController.parse_command(text, self._client._current_user.username)
+        route = self._commands.get(command)
+
+        if not route:
+            return
+
+        controller, handle = route
+        dto = controller._event_class(event)
+        dto.command = command
+        dto.args = args
+        dto.command_names = handle.command_names
+        await handle(dto)
+
+    async def _dispatch_mention(self, event: NewMessage.Event, text: str):
+        mentions = MentionController.parse_mentions(text)
+
+        if not mentions:
+            return
+
+        routes = []
+
+        for mention in mentions:
+            for route in self._mentions.get(mention, []):
+                if route not in routes:
+                    routes.append(route)
+
+        triggers = {}
+
+        # Остальные упоминания обрабатываются, только если среди них есть тег роли чата.
+        # Найденные теги передаются в событии, чтобы обработчики не искали их повторно.
+        # В бд хранится id сущности чата, а не id пира с префиксом канала
+        if not routes:
+            triggers = await Role.aio_match_triggers(utils.resolve_id(event.chat_id)[0], mentions)
+
+            if triggers:
+                routes = self._wildcard_mentions
+
+        for controller, handle in routes:
+            dto = controller._event_class(event)
+            dto.mentions = mentions
+            dto.triggers = triggers
+            await handle(dto)
@@ -2,10 +2,11 @@
 
 import os
 from datetime import datetime
+from time import perf_counter
 from zoneinfo import ZoneInfo
 
-from peewee import SQL, Model
-from peewee_async import PooledMySQLDatabase
+from peewee import SQL
+from peewee_async import PooledMySQLDatabase, AioModel
 from peewee_moves import DatabaseManager as BaseDatabaseManager, Migrator as BaseMigrator, LOGGER
 from playhouse.shortcuts import ReconnectMixin
 
@@ -15,7 +16,33 @@ MAX_DB_CONNECTIONS = 10
 
 
 class ReconnectedPooledDatabase(ReconnectMixin, PooledMySQLDatabase):
-    pass
+    stats = {
+        'queries': 0,
+        'errors': 0,
+        'seconds': 0.0,
+    }
+
+    async def aio_execute_sql(self, sql, params=None, fetch_results=None):
+        started = perf_counter()
+        self.stats['queries'] += 1
+
+        try:
+            return await super().aio_execute_sql(sql, params, fetch_results=fetch_results)
+        except Exception:
+            self.stats['errors'] += 1
+            raise
+        finally:
+            self.stats['seconds'] += perf_counter() - started
+
+    def get_pool_stats(self) -> dict:
+        # aiomysql создаёт пул только при первом подключении
+        pool = getattr(self.pool_backend, 'pool', None)
+
+        return {
+            'size': pool.size if pool else 0,
+            'free': pool.freesize if pool else 0,
+            'max': pool.maxsize if pool else MAX_DB_CONNECTIONS,
+        }
 
 
 class Migrator(BaseMigrator):
@@ -111,12 +138,23 @@ database = ReconnectedPooledDatabase(
     charset='utf8mb4'
 )
 
-db_manager = DatabaseManager(
-    database,
-    directory=os.path.abspath(config.ROOT_FOLDER + '/fsb/db/migrations'),
-    table_name='migrations'
-)
+_db_manager = None
+
+
+def get_db_manager() -> DatabaseManager:
+    # Менеджер миграций сразу подключается к бд, поэтому создаётся только когда нужен,
+    # а не при импорте моделей
+    global _db_manager
+
+    if _db_manager is None:
+        _db_manager = DatabaseManager(
+            database,
+            directory=os.path.abspath(config.ROOT_FOLDER + '/fsb/db/migrations'),
+            table_name='migrations'
+        )
+
+    return _db_manager
 
 
-class ModelInterface(Model):
+class ModelInterface(AioModel):
     pass
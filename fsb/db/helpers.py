@@ -1,5 +1,13 @@
 # !/usr/bin/env python
 
+import hmac
+from hashlib import sha256
+from typing import Union
+from zlib import crc32
+
+from fsb.config import config
+from fsb.errors import ConfigurationError
+
 
 class DirtyModel:
     def __init__(self, dirty_state):
@@ -25,3 +33,130 @@ class DirtyModelState:
     def out(self):
         self.active = False
         return self
+
+
+class CallbackData:
+    # Подписанные данные inline-кнопки: префикс, id класса события, значения параметров и HMAC.
+    # Telegram ограничивает callback data 64 байтами
+    MAX_SIZE = 64
+    PREFIX = b'\xfe'
+    CLASS_ID_SIZE = 4
+    SIGNATURE_SIZE = 8
+
+    TYPE_NONE = 0
+    TYPE_INT = 1
+    TYPE_STR = 2
+
+    _secret = None
+
+    @staticmethod
+    def get_secret() -> bytes:
+        if CallbackData._secret is None:
+            secret = config.get('CALLBACK_SECRET') or config.get('BOT_TOKEN')
+
+            # С пустым секретом подпись мог бы подделать кто угодно
+            if not secret:
+                raise ConfigurationError('CALLBACK_SECRET or BOT_TOKEN must be set to sign callback data')
+
+            CallbackData._secret = sha256(str(secret).encode()).digest()
+
+        return CallbackData._secret
+
+    @staticmethod
+    def get_class_id(class_path: str) -> int:
+        return crc32(class_path.encode())
+
+    @staticmethod
+    def sign(body: bytes) -> bytes:
+        return hmac.new(CallbackData.get_secret(), body, sha256).digest()[:CallbackData.SIGNATURE_SIZE]
+
+    @staticmethod
+    def is_packed(data: bytes) -> bool:
+        return isinstance(data, bytes) and data.startswith(CallbackData.PREFIX)
+
+    @staticmethod
+    def pack(class_id: int, values: list) -> Union[bytes, None]:
+        body = bytearray(CallbackData.PREFIX + class_id.to_bytes(CallbackData.CLASS_ID_SIZE, 'big'))
+
+        for value in values:
+            if value is None:
+                body.append(CallbackData.TYPE_NONE)
+            elif isinstance(value, int) and not isinstance(value, bool):
+                body.append(CallbackData.TYPE_INT)
+                body += CallbackData._pack_varint(value * 2 if value >= 0 else -value * 2 - 1)
+            elif isinstance(value, str):
+                raw = value.encode()
+                body.append(CallbackData.TYPE_STR)
+                body += CallbackData._pack_varint(len(raw)) + raw
+            else:
+                return None
+
+            if len(body) + CallbackData.SIGNATURE_SIZE > CallbackData.MAX_SIZE:
+                return None
+
+        return bytes(body) + CallbackData.sign(bytes(body))
+
+    @staticmethod
+    def unpack(data: bytes) -> Union[tuple[int, list], None]:
+        header_size = len(CallbackData.PREFIX) + CallbackData.CLASS_ID_SIZE
+
+        if not CallbackData.is_packed(data) or len(data) < header_size + CallbackData.SIGNATURE_SIZE:
+            return None
+
+        body = data[:-CallbackData.SIGNATURE_SIZE]
+
+        if not hmac.compare_digest(CallbackData.sign(body), data[-CallbackData.SIGNATURE_SIZE:]):
+            return None
+
+        class_id = int.from_bytes(body[len(CallbackData.PREFIX):header_size], 'big')
+        values = []
+        position = header_size
+
+        try:
+            while position < len(body):
+                value_type = body[position]
+                position += 1
+
+                match value_type:
+                    case CallbackData.TYPE_NONE:
+                        values.append(None)
+                    case CallbackData.TYPE_INT:
+                        value, position = CallbackData._unpack_varint(body, position)
+                        values.append(value // 2 if value % 2 == 0 else -(value + 1) // 2)
+                    case CallbackData.TYPE_STR:
+                        size, position = CallbackData._unpack_varint(body, position)
+                        if position + size > len(body):
+                            return None
+                        values.append(body[position:position + size].decode())
+                        position += size
+                    case _:
+                        return None
+        except (IndexError, UnicodeDecodeError):
+            return None
+
+        return class_id, values
+
+    @staticmethod
+    def _pack_varint(value: int) -> bytes:
+        result = bytearray()
+
+        while value > 0x7f:
+            result.append(value & 0x7f | 0x80)
+            value >>= 7
+
+        result.append(value)
+        return bytes(result)
+
+    @staticmethod
+    def _unpack_varint(data: bytes, position: int) -> tuple[int, int]:
+        value = 0
+        shift = 0
+
+        while True:
+            byte = data[position]
+            position += 1
+            value |= (byte & 0x7f) << shift
+            shift += 7
+
+            if not byte & 0x80:
+                return value, position
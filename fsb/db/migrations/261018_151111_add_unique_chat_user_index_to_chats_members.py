@@ -0,0 +1,78 @@
+"""
+add_unique_chat_user_index_to_chats_members
+date created: 2026-10-18 15:11:11.000000
+"""
+
+
+def upgrade(migrator):
+    # Дубли участников переносятся на самую раннюю запись, иначе уникальный индекс не создать
+    migrator.execute_sql("""
+    CREATE TEMPORARY TABLE chats_members_duplicates AS
+    SELECT cm.id AS id, keep.id AS keep_id
+    FROM chats_members cm
+    JOIN (
+        SELECT chat_id, user_id, MIN(id) AS id
+        FROM chats_members
+        GROUP BY chat_id, user_id
+        HAVING COUNT(*) > 1
+    ) keep ON keep.chat_id = cm.chat_id AND keep.user_id = cm.user_id AND keep.id != cm.id;
+    """)
+    migrator.execute_sql("""
+    UPDATE ratings_members rm
+    JOIN chats_members_duplicates d ON d.id = rm.member_id
+    SET rm.member_id = d.keep_id;
+    """)
+    # После переноса участник рейтинга может оказаться в нем дважды, что удвоило бы его шансы и статистику.
+    # Остается запись с наибольшими счетчиками, ссылки победителей и лидеров переносятся на нее
+    migrator.execute_sql("""
+    CREATE TEMPORARY TABLE ratings_members_duplicates AS
+    SELECT id, keep_id
+    FROM (
+        SELECT id, FIRST_VALUE(id) OVER (
+            PARTITION BY rating_id, member_id
+            ORDER BY total_count DESC, current_year_count DESC, month_count DESC, current_month_count DESC, id
+        ) AS keep_id
+        FROM ratings_members
+    ) ranked
+    WHERE id != keep_id;
+    """)
+
+    for column in ('last_winner_id', 'last_month_winner_id', 'last_year_winner_id'):
+        migrator.execute_sql(f"""
+        UPDATE ratings r
+        JOIN ratings_members_duplicates d ON d.id = r.{column}
+        SET r.{column} = d.keep_id;
+        """)
+
+    migrator.execute_sql("""
+    UPDATE ratings_leaders rl
+    JOIN ratings_members_duplicates d ON d.id = rl.rating_member_id
+    SET rl.rating_member_id = d.keep_id;
+    """)
+    migrator.execute_sql("""
+    DELETE rm FROM ratings_members rm JOIN ratings_members_duplicates d ON d.id = rm.id;
+    """)
+    migrator.execute_sql("""
+    DROP TEMPORARY TABLE ratings_members_duplicates;
+    """)
+    # У ролей составной ключ, поэтому повторы после переноса пропускаются и удаляются вместе с дублями
+    migrator.execute_sql("""
+    UPDATE IGNORE chats_members_roles cmr
+    JOIN chats_members_duplicates d ON d.id = cmr.member_id
+    SET cmr.member_id = d.keep_id;
+    """)
+    migrator.execute_sql("""
+    DELETE cmr FROM chats_members_roles cmr JOIN chats_members_duplicates d ON d.id = cmr.member_id;
+    """)
+    migrator.execute_sql("""
+    DELETE cm FROM chats_members cm JOIN chats_members_duplicates d ON d.id = cm.id;
+    """)
+    migrator.execute_sql("""
+    DROP TEMPORARY TABLE chats_members_duplicates;
+    """)
+
+    migrator.add_index('chats_members', ('chat_id', 'user_id'), unique=True)
+
+
+def downgrade(migrator):
+    migrator.drop_index('chats_members', 'chats_members_chat_id_user_id')
@@ -0,0 +1,15 @@
+"""
+add_expiry_indexes_to_query_events
+date created: 2026-10-18 17:15:00.000000
+"""
+
+
+def upgrade(migrator):
+    # Индексы для очистки устаревших событий кнопок
+    migrator.add_index('query_events', ('created_at',), unique=False)
+    migrator.add_index('query_events', ('last_usage_date',), unique=False)
+
+
+def downgrade(migrator):
+    migrator.drop_index('query_events', 'query_events_last_usage_date')
+    migrator.drop_index('query_events', 'query_events_created_at')
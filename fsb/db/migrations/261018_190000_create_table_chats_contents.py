@@ -0,0 +1,21 @@
+"""
+create table chats_contents
+date created: 2026-10-18 19:00:00.000000
+"""
+
+
+def upgrade(migrator):
+    with migrator.create_table('chats_contents') as table:
+        table.primary_key('id')
+        table.foreign_key('AUTO', 'chat_id', on_delete='CASCADE', on_update='CASCADE', references='chats.id')
+        table.char('kind', max_length=255)
+        table.char('key', max_length=255, constraints=["DEFAULT ''"])
+        table.text('text')
+        table.datetime('created_at', constraints=['DEFAULT CURRENT_TIMESTAMP'])
+        table.datetime('updated_at', constraints=['DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP'])
+
+    migrator.add_index('chats_contents', ('chat_id', 'kind', 'key'), unique=False)
+
+
+def downgrade(migrator):
+    migrator.drop_table('chats_contents')
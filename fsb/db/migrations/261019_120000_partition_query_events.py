@@ -0,0 +1,55 @@
+"""
+partition_query_events
+date created: 2026-10-19 12:00:00.000000
+"""
+
+from datetime import datetime
+
+from dateutil.relativedelta import relativedelta as delta
+
+from fsb.config import config
+
+PARTITION_MONTHS_AHEAD = 3
+
+
+def is_partitioned(migrator) -> bool:
+    cursor = migrator.execute_sql(
+        "SELECT COUNT(*) FROM information_schema.PARTITIONS "
+        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'query_events' AND PARTITION_NAME IS NOT NULL"
+    )
+    return bool(cursor.fetchone()[0])
+
+
+def upgrade(migrator):
+    # Перевод на помесячные партиции переписывает первичный ключ всей таблицы, поэтому включается
+    # только явно (query_events.partitioning), иначе миграция ничего не меняет
+    if not config.query_events.partitioning or is_partitioned(migrator):
+        return
+
+    months_ahead = int(config.query_events.partition_months_ahead or PARTITION_MONTHS_AHEAD)
+    month = datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    oldest = migrator.execute_sql('SELECT MIN(created_at) FROM query_events').fetchone()[0]
+
+    if oldest:
+        month = min(month, oldest.replace(day=1, hour=0, minute=0, second=0, microsecond=0))
+
+    definitions = []
+
+    while month <= datetime.now() + delta(months=months_ahead):
+        definitions.append(f"PARTITION {month.strftime('p%Y%m')} "
+                           f"VALUES LESS THAN ('{(month + delta(months=1)).strftime('%Y-%m-%d')}')")
+        month += delta(months=1)
+
+    definitions.append('PARTITION pmax VALUES LESS THAN (MAXVALUE)')
+
+    # Ключ партиционирования должен входить в первичный ключ
+    migrator.execute_sql('ALTER TABLE query_events DROP PRIMARY KEY, ADD PRIMARY KEY (id, created_at)')
+    migrator.execute_sql(f"ALTER TABLE query_events PARTITION BY RANGE COLUMNS(created_at) ({', '.join(definitions)})")
+
+
+def downgrade(migrator):
+    if not is_partitioned(migrator):
+        return
+
+    migrator.execute_sql('ALTER TABLE query_events REMOVE PARTITIONING')
+    migrator.execute_sql('ALTER TABLE query_events DROP PRIMARY KEY, ADD PRIMARY KEY (id)')
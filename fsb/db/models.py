@@ -3,6 +3,7 @@
 import json
 import sys
 from datetime import datetime
+from time import monotonic
 from typing import Union
 
 from peewee import (
@@ -20,11 +21,12 @@ from peewee import (
     ManyToManyField,
     DeferredThroughModel,
     DateField,
+    JOIN,
     SQL,
 )
 
 from fsb.db import database as base_db, ModelInterface
-from fsb.db.helpers import DirtyModel, DirtyModelState
+from fsb.db.helpers import CallbackData, DirtyModel, DirtyModelState
 from fsb.db.traits import CreatedUpdatedAtTrait, CreatedAtTrait, DeletedAtWithReasonTrait, DeletedAtTrait
 from fsb.errors import InputValueError
 
@@ -45,8 +47,8 @@ class BaseModel(ModelInterface):
         table_function = make_table_name
         only_save_dirty = True
 
-    def save_get_id(self, *args, **kwargs):
-        super().save(*args, **kwargs)
+    async def aio_save_get_id(self, *args, **kwargs):
+        await super().aio_save(*args, **kwargs)
         return super().get_id()
 
     def __setattr__(self, key, value):
@@ -60,6 +62,12 @@ class BaseModel(ModelInterface):
         elif not self._real_dirty.is_dirty():
             super().save(*args, **kwargs)
 
+    async def aio_save(self, *args, **kwargs):
+        if self._real_dirty.is_dirty() and self.is_dirty():
+            return await super().aio_save(only=self.dirty_fields, *args, **kwargs)
+        elif not self._real_dirty.is_dirty():
+            return await super().aio_save(*args, **kwargs)
+
     def dirty(self):
         return DirtyModel(self._real_dirty)
 
@@ -89,7 +97,15 @@ class BaseModel(ModelInterface):
 
         return query
 
-    def is_enabled_module(self, module_name: str) -> bool:
+    async def aio_is_enabled_module(self, module_name: str) -> bool:
+        chat_id = self._get_chat_id()
+
+        if not chat_id:
+            return await self.with_enabled_module(module_name, chat_id).aio_exists()
+
+        return module_name in await ChatModule.aio_get_enabled_modules(chat_id)
+
+    def _get_chat_id(self):
         if isinstance(self, Chat):
             chat_id = self.id
         elif hasattr(self, 'chat_id') or hasattr(self, 'chat'):
@@ -97,7 +113,7 @@ class BaseModel(ModelInterface):
         else:
             chat_id = None
 
-        return self.with_enabled_module(module_name, chat_id).exists()
+        return chat_id
 
     @classmethod
     def find_by_chat(cls, chat: 'Chat', only_active: bool = True):
@@ -128,8 +144,8 @@ class TelegramEntity(BaseModel, CreatedUpdatedAtTrait, DeletedAtWithReasonTrait)
         return self.telegram_member
 
     @classmethod
-    def get_by_telegram_id(cls, telegram_id: Union[int, str]):
-        return cls.get_or_none(cls.telegram_id == telegram_id)
+    async def aio_get_by_telegram_id(cls, telegram_id: Union[int, str]):
+        return await cls.aio_get_or_none(cls.telegram_id == telegram_id)
 
 
 class User(TelegramEntity):
@@ -171,29 +187,36 @@ class Chat(TelegramEntity):
 
         return chat_type
 
-    def enable_module(self, module_name):
-        return ChatModule.get_or_create(chat=self, module_id=module_name)
+    async def aio_enable_module(self, module_name):
+        result = await ChatModule.aio_get_or_create(chat=self, module_id=module_name)
+        ChatModule.invalidate_cache(self.id)
+
+        return result
 
-    def disable_module(self, module_name):
-        chat_module = ChatModule.get(ChatModule.chat == self, ChatModule.module_id == module_name)
+    async def aio_disable_module(self, module_name):
+        chat_module = await ChatModule.aio_get(ChatModule.chat == self, ChatModule.module_id == module_name)
 
         if isinstance(chat_module, ChatModule):
-            return chat_module.delete_instance()
+            result = await chat_module.aio_delete_instance()
+            ChatModule.invalidate_cache(self.id)
+
+            return result
 
-    def mark_as_deleted(self, reason = None):
+    async def aio_mark_as_deleted(self, reason = None):
         super().mark_as_deleted(reason)
 
-        CronJob.update(active=False).where(CronJob.chat == self).execute()
-        ChatModule.delete().where(ChatModule.chat == self).execute()
+        await CronJob.update(active=False).where(CronJob.chat == self).aio_execute()
+        await ChatModule.delete().where(ChatModule.chat == self).aio_execute()
+        ChatModule.invalidate_cache(self.id)
 
-        self.save()
+        await self.aio_save()
 
-    def mark_as_undeleted(self):
+    async def aio_mark_as_undeleted(self):
         super().mark_as_undeleted()
 
-        self.enable_module(Module.MODULE_DEFAULT)
+        await self.aio_enable_module(Module.MODULE_DEFAULT)
 
-        self.save()
+        await self.aio_save()
 
 
 class Member(BaseModel, CreatedUpdatedAtTrait, DeletedAtWithReasonTrait):
@@ -204,6 +227,11 @@ class Member(BaseModel, CreatedUpdatedAtTrait, DeletedAtWithReasonTrait):
     user = ForeignKeyField(User, backref='chats_members')
     rang = CharField(null=True)
 
+    class Meta:
+        indexes = (
+            (('chat', 'user'), True),
+        )
+
     def get_telegram_id(self):
         telegram_id = None
         if self.user:
@@ -213,6 +241,10 @@ class Member(BaseModel, CreatedUpdatedAtTrait, DeletedAtWithReasonTrait):
     async def get_telegram_member(self, client):
         return await self.user.get_telegram_member(client)
 
+    @classmethod
+    def select_with_users(cls):
+        return cls.select(cls, User).join(User)
+
 
 MemberDeferred.set_model(Member)
 
@@ -225,6 +257,12 @@ class Role(BaseModel, CreatedUpdatedAtTrait):
     nickname = CharField(null=True)
     chat = ForeignKeyField(Chat, backref='roles')
 
+    TRIGGERS_CACHE_TTL = 300
+    TRIGGERS_CACHE_SIZE = 10000
+
+    # telegram_id чата => (время загрузки, {тег роли: telegram_id участников роли})
+    _triggers_cache = {}
+
     @staticmethod
     def parse_from_message(message: str) -> tuple:
         message = message.split(',')
@@ -242,6 +280,62 @@ class Role(BaseModel, CreatedUpdatedAtTrait):
 
         return name, nickname
 
+    @classmethod
+    async def aio_get_chat_triggers(cls, chat_telegram_id: int) -> dict:
+        cached = cls._triggers_cache.get(chat_telegram_id)
+
+        if cached and monotonic() - cached[0] <= cls.TRIGGERS_CACHE_TTL:
+            return cached[1]
+
+        # Роли чата вместе с участниками одним запросом
+        query = (
+            cls.select(cls.nickname, User.telegram_id)
+            .join(Chat, on=(cls.chat == Chat.id))
+            .switch(cls)
+            .join(MemberRole, JOIN.LEFT_OUTER, on=(MemberRole.role == cls.id))
+            .join(Member, JOIN.LEFT_OUTER, on=(MemberRole.member == Member.id))
+            .join(User, JOIN.LEFT_OUTER, on=(Member.user == User.id))
+            .where(Chat.telegram_id == chat_telegram_id)
+            .tuples()
+        )
+        members_ids = {}
+
+        for nickname, telegram_id in await query.aio_execute():
+            nickname_members_ids = members_ids.setdefault(nickname, set())
+
+            if telegram_id:
+                nickname_members_ids.add(telegram_id)
+
+        triggers = {nickname: frozenset(ids) for nickname, ids in members_ids.items()}
+
+        if len(cls._triggers_cache) >= cls.TRIGGERS_CACHE_SIZE:
+            cls._triggers_cache.clear()
+
+        cls._triggers_cache[chat_telegram_id] = (monotonic(), triggers)
+
+        return triggers
+
+    @classmethod
+    async def aio_match_triggers(cls, chat_telegram_id: int, mentions: list) -> dict:
+        # Упомянутые теги ролей чата с telegram id их участников
+        triggers = await cls.aio_get_chat_triggers(chat_telegram_id)
+
+        if not triggers:
+            return {}
+
+        return {mention: triggers[mention] for mention in dict.fromkeys(mentions) if mention in triggers}
+
+    @classmethod
+    async def aio_find_triggers(cls, chat_telegram_id: int, mentions: list) -> list:
+        return list(await cls.aio_match_triggers(chat_telegram_id, mentions))
+
+    @classmethod
+    def invalidate_triggers(cls, chat_telegram_id: int = None):
+        if chat_telegram_id is None:
+            cls._triggers_cache.clear()
+        else:
+            cls._triggers_cache.pop(chat_telegram_id, None)
+
 
 class MemberRole(BaseModel, CreatedUpdatedAtTrait):
     TABLE_NAME = 'chats_members_roles'
@@ -261,6 +355,10 @@ class MemberRole(BaseModel, CreatedUpdatedAtTrait):
     async def get_telegram_member(self, client):
         return await self.member.user.get_telegram_member(client)
 
+    @classmethod
+    def select_with_users(cls):
+        return cls.select(cls, Member, User).join(Member).join(User)
+
 
 class Rating(BaseModel, CreatedUpdatedAtTrait):
     TABLE_NAME = 'ratings'
@@ -295,9 +393,7 @@ class Rating(BaseModel, CreatedUpdatedAtTrait):
 
         return command, name
 
-    def get_non_winners(self, is_month: bool = False):
-        result = []
-
+    async def aio_get_non_winners(self, is_month: bool = False):
         if is_month:
             rating_winner_attr = Rating.last_month_winner_id
             date_exp = (Rating.last_month_run >= datetime.today().replace(hour=0, minute=0, second=0, microsecond=0, day=1))
@@ -305,16 +401,17 @@ class Rating(BaseModel, CreatedUpdatedAtTrait):
             rating_winner_attr = Rating.last_winner_id
             date_exp = (Rating.last_run >= datetime.today().replace(hour=0, minute=0, second=0, microsecond=0))
 
-        for rating_member in self.members.order_by(RatingMember.id):
-            if (not rating_member
-                    .member
-                    .ratings_members
-                    .join(Rating, on=(rating_winner_attr == RatingMember.id))
-                    .where(date_exp)
-                    .exists()):
-                result.append(rating_member)
+        winner_rating_member = RatingMember.alias()
+        winners = (winner_rating_member
+                   .select(winner_rating_member.member)
+                   .join(Rating, on=(rating_winner_attr == winner_rating_member.id))
+                   .where(date_exp))
 
-        return result
+        return await (RatingMember
+                      .select_with_users()
+                      .where((RatingMember.rating == self) & RatingMember.member.not_in(winners))
+                      .order_by(RatingMember.id)
+                      .aio_execute())
 
 
 class RatingMember(BaseModel, CreatedUpdatedAtTrait):
@@ -337,6 +434,10 @@ class RatingMember(BaseModel, CreatedUpdatedAtTrait):
     async def get_telegram_member(self, client):
         return await self.member.user.get_telegram_member(client)
 
+    @classmethod
+    def select_with_users(cls):
+        return cls.select(cls, Member, User).join(Member).join(User)
+
 
 class QueryEvent(BaseModel, CreatedAtTrait):
     TABLE_NAME = 'query_events'
@@ -347,6 +448,24 @@ class QueryEvent(BaseModel, CreatedAtTrait):
     data = TextField(null=True)
     last_usage_date = DateTimeField(null=True)
 
+    # Сколько дней хранить событие после последнего использования, None - значение из конфига
+    TTL_DAYS = None
+
+    _classes = {}
+    _data_keys = {}
+
+    class Meta:
+        indexes = (
+            (('created_at',), False),
+            (('last_usage_date',), False),
+        )
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        class_id = CallbackData.get_class_id(f'{cls.__module__}.{cls.__name__}')
+        assert class_id not in QueryEvent._classes, f'Callback class id collision: {cls.__name__}'
+        QueryEvent._classes[class_id] = cls
+
     def __init__(self, sender_id: int = None, data_value=None, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.sender_id = sender_id
@@ -383,11 +502,64 @@ class QueryEvent(BaseModel, CreatedAtTrait):
         return cls(data_dict['sender_id'], data_dict['data'])
 
     @classmethod
-    def find_and_create(cls, id: int) -> Union['QueryEvent', None]:
+    def get_data_keys(cls) -> list:
+        if cls not in QueryEvent._data_keys:
+            QueryEvent._data_keys[cls] = list(cls().build_data_dict())
+
+        return QueryEvent._data_keys[cls]
+
+    def to_callback_data(self) -> Union[bytes, None]:
+        class_id = CallbackData.get_class_id(f'{self.__class__.__module__}.{self.__class__.__name__}')
+        data = self._data_value if isinstance(self._data_value, dict) else {}
+
+        if QueryEvent._classes.get(class_id) is not self.__class__ or list(data) != self.get_data_keys():
+            return None
+
+        return CallbackData.pack(class_id, [self.sender_id, *data.values()])
+
+    async def aio_get_callback_data(self) -> Union[bytes, str]:
+        callback_data = self.to_callback_data()
+
+        # Не влезает в 64 байта - храним событие в бд, в кнопку уходит только id
+        if callback_data is None:
+            callback_data = str(await self.aio_save_get_id())
+
+        return callback_data
+
+    @classmethod
+    def from_callback_data(cls, data: bytes) -> Union['QueryEvent', None]:
+        unpacked = CallbackData.unpack(data)
+
+        if not unpacked:
+            return None
+
+        class_id, values = unpacked
+        instance_class = QueryEvent._classes.get(class_id)
+
+        if not instance_class or len(values) != len(instance_class.get_data_keys()) + 1:
+            return None
+
+        return instance_class.from_dict({
+            'sender_id': values[0],
+            'data': dict(zip(instance_class.get_data_keys(), values[1:])),
+        })
+
+    @classmethod
+    async def aio_find_by_callback_data(cls, data: bytes) -> Union['QueryEvent', None]:
+        if CallbackData.is_packed(data):
+            return cls.from_callback_data(data)
+
         try:
-            query_event = cls.get_by_id(id)
+            return await cls.aio_find_and_create(int(data))
+        except ValueError:
+            return None
+
+    @classmethod
+    async def aio_find_and_create(cls, id: int) -> Union['QueryEvent', None]:
+        try:
+            query_event = await cls.aio_get(id)
             assert query_event.module_name and query_event.class_name
-        except DoesNotExist or AssertionError:
+        except (DoesNotExist, AssertionError):
             return None
 
         data_dict = {}
@@ -400,6 +572,7 @@ class QueryEvent(BaseModel, CreatedAtTrait):
 
         if issubclass(instance_class, QueryEvent):
             instance = instance_class.from_dict(data_dict)
+            instance.id = query_event.id
         else:
             instance = None
 
@@ -444,6 +617,12 @@ class Module(BaseModel):
         MODULE_CRON,
     ]
 
+    # Модулей немного и меняются они редко, поэтому держим в памяти всю таблицу
+    CACHE_TTL = 300
+
+    _cache = {}
+    _cache_loaded_at = None
+
     name = CharField(null=False, primary_key=True)
     readable_name = CharField(null=True)
     active = BooleanField(null=False, default=True, constraints=[SQL('DEFAULT 1')])
@@ -461,6 +640,27 @@ class Module(BaseModel):
     def get_readable_name(self):
         return self.readable_name if self.readable_name else self.name
 
+    @classmethod
+    async def aio_get_all_cached(cls) -> dict:
+        if cls._cache_loaded_at is None or monotonic() - cls._cache_loaded_at > cls.CACHE_TTL:
+            cls._cache = {module.name: module for module in await cls.select().aio_execute()}
+            cls._cache_loaded_at = monotonic()
+
+        return cls._cache
+
+    @classmethod
+    async def aio_get_cached(cls, module_name: str) -> 'Module':
+        module = (await cls.aio_get_all_cached()).get(module_name)
+
+        if module is None:
+            raise cls.DoesNotExist(f'Module {module_name} does not exist')
+
+        return module
+
+    @classmethod
+    def invalidate_cache(cls):
+        cls._cache_loaded_at = None
+
 
 class ChatModule(BaseModel, CreatedAtTrait):
     TABLE_NAME = 'chats_modules'
@@ -471,6 +671,45 @@ class ChatModule(BaseModel, CreatedAtTrait):
     chat = ForeignKeyField(Chat, backref='chat_modules', on_delete='CASCADE', on_update='CASCADE')
     module = ForeignKeyField(Module, backref='module_chats', on_delete='CASCADE', on_update='CASCADE')
 
+    CACHE_TTL = 300
+    CACHE_SIZE = 10000
+
+    # chat_id => (время загрузки, включённые в чате модули)
+    _cache = {}
+
+    @classmethod
+    async def aio_get_chat_modules(cls, chat_id: int) -> frozenset:
+        cached = cls._cache.get(chat_id)
+
+        if cached and monotonic() - cached[0] <= cls.CACHE_TTL:
+            return cached[1]
+
+        query = cls.select(cls.module_id).where(cls.chat_id == chat_id)
+        modules_names = frozenset(chat_module.module_id for chat_module in await query.aio_execute())
+
+        if len(cls._cache) >= cls.CACHE_SIZE:
+            cls._cache.clear()
+
+        cls._cache[chat_id] = (monotonic(), modules_names)
+
+        return modules_names
+
+    @classmethod
+    async def aio_get_enabled_modules(cls, chat_id: int) -> frozenset:
+        modules = await Module.aio_get_all_cached()
+
+        return frozenset(
+            module_name for module_name in await cls.aio_get_chat_modules(chat_id)
+            if module_name in modules and modules[module_name].active
+        )
+
+    @classmethod
+    def invalidate_cache(cls, chat_id: int = None):
+        if chat_id is None:
+            cls._cache.clear()
+        else:
+            cls._cache.pop(chat_id, None)
+
 
 class CronJob(BaseModel, CreatedUpdatedAtTrait):
     TABLE_NAME = 'cron_jobs'
@@ -481,3 +720,28 @@ class CronJob(BaseModel, CreatedUpdatedAtTrait):
     message = CharField(null=False)
     schedule = CharField(null=False)
     active = BooleanField(null=False, default=True, constraints=[SQL('DEFAULT 1')])
+
+
+class ChatContent(BaseModel, CreatedUpdatedAtTrait):
+    TABLE_NAME = 'chats_contents'
+
+    KIND_ROLLING = 'rolling'
+    KIND_CONGRATULATION = 'congratulation'
+    KIND_EMOJI = 'emoji'
+
+    KINDS_LIST = [
+        KIND_ROLLING,
+        KIND_CONGRATULATION,
+        KIND_EMOJI,
+    ]
+
+    id = AutoField()
+    chat = ForeignKeyField(Chat, backref='contents', on_delete='CASCADE', on_update='CASCADE')
+    kind = CharField(null=False)
+    key = CharField(null=False, default='', constraints=[SQL("DEFAULT ''")])
+    text = TextField(null=False)
+
+    class Meta:
+        indexes = (
+            (('chat', 'kind', 'key'), False),
+        )
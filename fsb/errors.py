@@ -19,6 +19,10 @@ class DisconnectFailedError(BaseFsbException):
     message = "Disconnect error"
 
 
+class ConfigurationError(BaseFsbException):
+    pass
+
+
 class ExitControllerException(BaseFsbException):
     def __init__(self, object_context: Union[str, object] = None, reason: str = None, sending_message: str = None):
         if not isinstance(object_context, str) and object_context is not None:
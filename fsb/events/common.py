@@ -22,6 +22,7 @@ class EventDTO:
         self.chat_type = event.chat.__class__.__name__
         self.debug = False
         self.area = self.ALL
+        self.db_chat = None
 
         from fsb.db.models import Module
         self.module_name = Module.MODULE_DEFAULT
@@ -94,3 +95,4 @@ class MentionEventDTO(MessageEventDTO):
     def __init__(self, event):
         super().__init__(event)
         self.mentions = []
+        self.triggers = {}
@@ -32,20 +32,20 @@ class CronQueryEvent(QueryEvent):
         data = data_dict['data']
         return cls(sender_id=sender_id, cron_job_id=data['cron_job_id'])
 
-    def get_cron_job(self) -> Union[CronJob, None]:
+    async def get_cron_job(self) -> Union[CronJob, None]:
         if not self.cron_job and self.cron_job_id:
-            self.cron_job = CronJob.get_by_id(self.cron_job_id)
+            self.cron_job = await CronJob.aio_get(self.cron_job_id)
 
         return self.cron_job
 
 
 class GeneralMenuCronEvent(CronQueryEvent):
     @staticmethod
-    def get_message_and_buttons(sender_id) -> tuple:
+    async def get_message_and_buttons(sender_id) -> tuple:
         return "Меню планировщика", [
-            [Button.inline('Список задач', ListCronEvent(sender_id).save_get_id())],
-            [Button.inline('Добавить задачу', CreateCronEvent(sender_id).save_get_id()),],
-            [Button.inline('Закрыть', CloseGeneralMenuCronEvent(sender_id).save_get_id())]
+            [Button.inline('Список задач', await ListCronEvent(sender_id).aio_get_callback_data())],
+            [Button.inline('Добавить задачу', await CreateCronEvent(sender_id).aio_get_callback_data()),],
+            [Button.inline('Закрыть', await CloseGeneralMenuCronEvent(sender_id).aio_get_callback_data())]
         ]
 
 
@@ -37,22 +37,22 @@ class ModuleQueryEvent(QueryEvent):
         data = data_dict['data']
         return cls(sender_id=sender_id, chat_id=data['chat_id'], module_id=data['module_id'])
 
-    def get_chat(self) -> Union[Chat, None]:
+    async def get_chat(self) -> Union[Chat, None]:
         if not self.chat and self.chat_id:
-            self.chat = Chat.get_by_id(self.chat_id)
+            self.chat = await Chat.aio_get(self.chat_id)
 
         return self.chat
 
-    def get_module(self) -> Union[Module, None]:
+    async def get_module(self) -> Union[Module, None]:
         if not self.module and self.module_id:
-            self.module = Module.get_by_id(self.module_id)
+            self.module = await Module.aio_get(self.module_id)
 
         return self.module
 
 
 class GeneralMenuModuleEvent(ModuleQueryEvent):
     @staticmethod
-    def get_message_and_buttons(sender_id, chat_id, enabled_modules_names) -> tuple:
+    async def get_message_and_buttons(sender_id, chat_id, enabled_modules_names) -> tuple:
         buttons = []
 
         try:
@@ -60,7 +60,7 @@ class GeneralMenuModuleEvent(ModuleQueryEvent):
                        .where(Module.active & (Module.name != Module.MODULE_DEFAULT))
                        .order_by(Module.sort.asc()))
 
-            for module in modules:
+            for module in await modules.aio_execute():
                 if module.name in enabled_modules_names:
                     event_class = DisableModuleEvent
                     text = module.get_readable_name() + ': ВКЛ'
@@ -70,11 +70,11 @@ class GeneralMenuModuleEvent(ModuleQueryEvent):
 
                 buttons.append((
                     text,
-                    event_class(sender_id=sender_id, chat_id=chat_id, module_id=module.name).save_get_id()
+                    await event_class(sender_id=sender_id, chat_id=chat_id, module_id=module.name).aio_get_callback_data()
                 ))
 
             buttons = Helper.make_buttons_layout(
-                buttons, ('Закрыть', CloseGeneralMenuModuleEvent(sender_id=sender_id).save_get_id())
+                buttons, ('Закрыть', await CloseGeneralMenuModuleEvent(sender_id=sender_id).aio_get_callback_data())
             )
             message = 'Модули'
         except DoesNotExist:
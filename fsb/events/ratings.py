@@ -44,46 +44,46 @@ class RatingQueryEvent(QueryEvent):
             rating_member_id=data['rating_member_id']
         )
 
-    def get_rating(self) -> Union[Rating, None]:
+    async def get_rating(self) -> Union[Rating, None]:
         if not self.rating and self.rating_id:
-            self.rating = Rating.get_by_id(self.rating_id)
+            self.rating = await Rating.aio_get(self.rating_id)
 
         return self.rating
 
-    def get_member(self) -> Union[Member, None]:
+    async def get_member(self) -> Union[Member, None]:
         if not self.member and self.member_id:
-            self.member = Member.get_by_id(self.member_id)
+            self.member = await Member.aio_get(self.member_id)
 
         return self.member
 
-    def get_rating_member(self) -> Union[RatingMember, None]:
+    async def get_rating_member(self) -> Union[RatingMember, None]:
         if not self.rating_member and self.rating_member_id:
-            self.rating_member = RatingMember.get_by_id(self.rating_member_id)
+            self.rating_member = await RatingMember.aio_get(self.rating_member_id)
 
         return self.rating_member
 
 
 class GeneralMenuRatingEvent(RatingQueryEvent):
     @staticmethod
-    def get_message_and_buttons(sender_id, ratings_list) -> tuple:
+    async def get_message_and_buttons(sender_id, ratings_list) -> tuple:
         if ratings_list:
             text = "**Список твоих рейтингов:**\n" + '\n'.join(ratings_list)
         else:
             text = "Список твоих рейтингов пуст"
         buttons = [
             [
-                Button.inline("Зарегаться", RegMenuRatingEvent(sender_id).save_get_id()),
-                Button.inline("Разрегаться", UnregMenuRatingEvent(sender_id).save_get_id())
+                Button.inline("Зарегаться", await RegMenuRatingEvent(sender_id).aio_get_callback_data()),
+                Button.inline("Разрегаться", await UnregMenuRatingEvent(sender_id).aio_get_callback_data())
             ],
             [
-                Button.inline("Создать рейтинг", CreateRatingEvent(sender_id).save_get_id()),
-                Button.inline("Список рейтингов", ListRatingEvent(sender_id).save_get_id()),
+                Button.inline("Создать рейтинг", await CreateRatingEvent(sender_id).aio_get_callback_data()),
+                Button.inline("Список рейтингов", await ListRatingEvent(sender_id).aio_get_callback_data()),
             ],
             [
-                Button.inline("Создать дефолтные рейтинги", CreateDefaultRatingEvent(sender_id).save_get_id()),
+                Button.inline("Создать дефолтные рейтинги", await CreateDefaultRatingEvent(sender_id).aio_get_callback_data()),
             ],
             [
-                Button.inline("Закрыть", CloseGeneralMenuRatingEvent(sender_id).save_get_id())
+                Button.inline("Закрыть", await CloseGeneralMenuRatingEvent(sender_id).aio_get_callback_data())
             ]
         ]
         return text, buttons
@@ -36,32 +36,32 @@ class RoleQueryEvent(QueryEvent):
         data = data_dict['data']
         return cls(sender_id=sender_id, role_id=data['role_id'], member_id=data['member_id'])
 
-    def get_role(self) -> Union[Role, None]:
+    async def get_role(self) -> Union[Role, None]:
         if not self.role and self.role_id:
-            self.role = Role.get_by_id(self.role_id)
+            self.role = await Role.aio_get(self.role_id)
 
         return self.role
 
-    def get_member(self) -> Union[Member, None]:
+    async def get_member(self) -> Union[Member, None]:
         if not self.member and self.member_id:
-            self.member = Member.get_by_id(self.member_id)
+            self.member = await Member.aio_get(self.member_id)
 
         return self.member
 
 
 class GeneralMenuRoleEvent(RoleQueryEvent):
     @staticmethod
-    def get_message_and_buttons(sender_id) -> tuple:
+    async def get_message_and_buttons(sender_id) -> tuple:
         return "Меню ролей", [
             [
-                Button.inline('Список ролей', ListRoleEvent(sender_id).save_get_id())
+                Button.inline('Список ролей', await ListRoleEvent(sender_id).aio_get_callback_data())
             ],
             [
-                Button.inline('Создать роль', CreateRoleEvent(sender_id).save_get_id()),
-                Button.inline('Удалить роль', DeleteMenuRoleEvent(sender_id).save_get_id()),
+                Button.inline('Создать роль', await CreateRoleEvent(sender_id).aio_get_callback_data()),
+                Button.inline('Удалить роль', await DeleteMenuRoleEvent(sender_id).aio_get_callback_data()),
             ],
             [
-                Button.inline('Закрыть', CloseGeneralMenuRoleEvent(sender_id).save_get_id())
+                Button.inline('Закрыть', await CloseGeneralMenuRoleEvent(sender_id).aio_get_callback_data())
             ]
         ]
 
@@ -2,7 +2,7 @@
 
 from typing import Type
 
-from fsb.controllers import Controller
+from fsb.controllers import Controller, MessageController, MessageDispatcher
 from fsb.telegram.client import TelegramApiClient
 
 
@@ -15,11 +15,16 @@ class Factory:
 
 
 class ControllerFactory(Factory):
-    def __init__(self, controller_class: Type[Controller], client: TelegramApiClient):
+    def __init__(self, controller_class: Type[Controller], client: TelegramApiClient,
+                 dispatcher: MessageDispatcher = None):
         assert issubclass(controller_class, Controller)
         super().__init__(controller_class)
         self._client = client
         self._loop = client.loop
+        self._dispatcher = dispatcher
 
     def create_object(self) -> Controller:
+        if issubclass(self.cls, MessageController):
+            return self.cls(self._client, self._dispatcher)
+
         return self.cls(self._client)
@@ -1,10 +1,12 @@
 # !/usr/bin/env python
 
 import logging
+from functools import wraps
 
 from fsb.events.common import (
     EventDTO, CommandEventDTO, MentionEventDTO, MenuEventDTO, ChatActionEventDTO, MessageEventDTO
 )
+from fsb.helpers import Metrics
 from fsb.services import FoolService
 from fsb.telegram.client import TelegramApiClient
 
@@ -19,9 +21,27 @@ class Handler:
         for attr, value in event.get_attributes().items():
             setattr(self, attr, value)
 
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+
+        if 'run' in cls.__dict__:
+            cls.run = Handler._measure_run(cls.run)
+
     async def run(self):
         self.logger.info(f"Run handler {self.__class__.__name__}")
 
+    @staticmethod
+    def _measure_run(run: callable):
+        @wraps(run)
+        async def measured_run(self, *args, **kwargs):
+            # Вызовы через super().run() не замеряются, иначе время попадёт в гистограммы всех предков
+            if type(self).run is not measured_run:
+                return await run(self, *args, **kwargs)
+
+            with Metrics.timer(Metrics.HANDLER, type(self).__name__):
+                return await run(self, *args, **kwargs)
+        return measured_run
+
 
 class CommandHandler(Handler, CommandEventDTO):
     event_class = CommandEventDTO
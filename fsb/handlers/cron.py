@@ -22,7 +22,7 @@ from fsb.services import CronService
 class CronSettingsCommandHandler(CommandHandler):
     async def run(self):
         await super().run()
-        text, buttons = GeneralMenuCronEvent.get_message_and_buttons(self.sender.id)
+        text, buttons = await GeneralMenuCronEvent.get_message_and_buttons(self.sender.id)
         await self.client.send_message(self.chat, text, buttons=buttons)
 
 
@@ -46,7 +46,7 @@ class CronSettingsQueryHandler(MenuHandler):
             await action()
 
     async def action_general_menu(self):
-        text, buttons = GeneralMenuCronEvent.get_message_and_buttons(self.sender.id)
+        text, buttons = await GeneralMenuCronEvent.get_message_and_buttons(self.sender.id)
         await self.menu_message.edit(text, buttons=buttons)
 
     async def get_cron_job_params(self, conv, change: bool = False):
@@ -87,9 +87,9 @@ class CronSettingsQueryHandler(MenuHandler):
         response_event = await response
         schedule = response_event.message.text
 
-        chat = Chat.get_by_telegram_id(self.chat.id)
+        chat = await Chat.aio_get_by_telegram_id(self.chat.id)
 
-        if CronJob.get_or_none(CronJob.chat == chat, CronJob.name == name):
+        if await CronJob.aio_get_or_none(CronJob.chat == chat, CronJob.name == name):
             return None
         else:
             return name, chat, message, schedule
@@ -115,19 +115,19 @@ class CronSettingsQueryHandler(MenuHandler):
                 await conv.send_message(ex.message)
 
     async def action_list(self, new_message: bool = False):
-        chat = Chat.get_by_telegram_id(self.chat.id)
+        chat = await Chat.aio_get_by_telegram_id(self.chat.id)
         cron_jobs = CronJob.find_by_chat(chat)
         buttons = []
 
-        for cron_job in cron_jobs:
+        for cron_job in await cron_jobs.aio_execute():
             buttons.append((
                 f"{cron_job.name}",
-                MenuCronEvent(self.sender.id, cron_job.id).save_get_id()
+                await MenuCronEvent(self.sender.id, cron_job.id).aio_get_callback_data()
             ))
 
         buttons = Helper.make_buttons_layout(buttons, (
             "<< В меню планировщика",
-            GeneralMenuCronEvent(self.sender.id).save_get_id()
+            await GeneralMenuCronEvent(self.sender.id).aio_get_callback_data()
         ))
         text = "Список задач:"
 
@@ -137,20 +137,20 @@ class CronSettingsQueryHandler(MenuHandler):
             await self.menu_message.edit(text, buttons=buttons)
 
     async def action_menu(self, new_message: bool = False):
-        cron_job = self.query_event.get_cron_job()
+        cron_job = await self.query_event.get_cron_job()
         text = f"Меню задачи **{cron_job.name}**:\n  Сообщение: {cron_job.message}\n  Расписание: {cron_job.schedule}"
         active_text = "Отключить" if cron_job.active else "Включить"
 
         buttons = [
             [
-                Button.inline(active_text, ActiveToggleCronEvent(self.sender.id, cron_job.id).save_get_id()),
+                Button.inline(active_text, await ActiveToggleCronEvent(self.sender.id, cron_job.id).aio_get_callback_data()),
             ],
             [
-                Button.inline('Изменить', ChangeCronEvent(self.sender.id, cron_job.id).save_get_id()),
-                Button.inline('Удалить', DeleteCronEvent(self.sender.id, cron_job.id).save_get_id()),
+                Button.inline('Изменить', await ChangeCronEvent(self.sender.id, cron_job.id).aio_get_callback_data()),
+                Button.inline('Удалить', await DeleteCronEvent(self.sender.id, cron_job.id).aio_get_callback_data()),
             ],
             [
-                Button.inline('<< К списку задач', ListCronEvent(self.sender.id).save_get_id())
+                Button.inline('<< К списку задач', await ListCronEvent(self.sender.id).aio_get_callback_data())
             ],
         ]
 
@@ -160,23 +160,23 @@ class CronSettingsQueryHandler(MenuHandler):
             await self.menu_message.edit(text, buttons=buttons)
 
     async def action_active_toggle(self):
-        cron_job = self.query_event.get_cron_job()
+        cron_job = await self.query_event.get_cron_job()
 
         if cron_job.active:
-            self.cron_service.disable_cron(cron_job=cron_job)
+            await self.cron_service.disable_cron(cron_job=cron_job)
         else:
             await self.cron_service.enable_cron(cron_job=cron_job)
 
         await self.action_menu()
 
     async def action_delete(self):
-        cron_job = self.query_event.get_cron_job()
-        self.cron_service.remove_cron_job(cron_job=cron_job)
+        cron_job = await self.query_event.get_cron_job()
+        await self.cron_service.remove_cron_job(cron_job=cron_job)
         await self.client.send_message(self.chat, f"Удалена задача: {cron_job.name}")
         await self.action_list()
 
     async def action_change(self):
-        cron_job = self.query_event.get_cron_job()
+        cron_job = await self.query_event.get_cron_job()
 
         async with self.client._client.conversation(self.chat) as conv:
             try:
@@ -187,7 +187,7 @@ class CronSettingsQueryHandler(MenuHandler):
                     cron_job.name = cron_job.name if name == '-' else name
                     cron_job.message = cron_job.message if message == '-' else message
                     cron_job.schedule = cron_job.schedule if schedule == '-' else schedule
-                    cron_job.save()
+                    await cron_job.aio_save()
                     await self.cron_service.update_cron(cron_job=cron_job)
                     await conv.send_message(f"Изменена задача {cron_job.name}")
                 else:
@@ -2,38 +2,45 @@
 
 from collections import OrderedDict
 
-from peewee import DoesNotExist
-
-from fsb.db.models import Chat, MemberRole, Role
 from fsb.handlers import MentionHandler
+from fsb.helpers import Helper
 
 
 class AllMentionHandler(MentionHandler):
     async def run(self):
+        return [mention async for mentions in self.iter_mentions() for mention in mentions]
+
+    async def iter_mentions(self):
         await super().run()
-        members = await self.client.get_dialog_members(self.chat)
-        members.remove(self.sender)
-        return self.get_members_mentions(members, self.MENTION_NAME_NONE)
+        members = (
+            member
+            async for chunk in self.client.iter_dialog_members(self.chat, chunk_size=self.MESSAGE_MENTION_LIMIT)
+            for member in chunk
+            if member.id != self.sender.id
+        )
+
+        async for chunk in Helper.iter_chunks(members, self.MESSAGE_MENTION_LIMIT):
+            yield self.get_members_mentions(chunk, self.MENTION_NAME_NONE)
 
 
 class CustomMentionHandler(MentionHandler):
     async def run(self):
         await super().run()
-        members = await self.client.get_dialog_members(self.chat)
-        members.remove(self.sender)
+        roles_members_ids = list(self.triggers.values())
+
+        # Участники всех упомянутых ролей ищутся за один проход по чату
+        members_ids = set().union(*roles_members_ids) - {self.sender.id}
+        members = {}
+
+        if members_ids:
+            async for chunk in self.client.iter_dialog_members(self.chat):
+                members.update((member.id, member) for member in chunk if member.id in members_ids)
+
         members_mentions = []
 
-        for role in Role.find_by_chat(Chat.get_by_telegram_id(self.chat.id)):
-            if role.nickname in self.mentions:
-                members_mentions += self.get_members_mentions_by_role(members, role)
+        for role_members_ids in roles_members_ids:
+            members_mentions += self.get_members_mentions(
+                [member for member_id, member in members.items() if member_id in role_members_ids]
+            )
 
         return list(OrderedDict.fromkeys(members_mentions))
-
-    def get_members_mentions_by_role(self, all_members: list, role: Role) -> list:
-        try:
-            role_members = MemberRole.select().where(MemberRole.role == role)
-            members_ids = [role_member.member.user.telegram_id for role_member in role_members]
-            members = [member for member in all_members if member.id in members_ids]
-            return self.get_members_mentions(members)
-        except DoesNotExist:
-            return []
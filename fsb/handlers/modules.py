@@ -1,7 +1,6 @@
 # !/usr/bin/env python
 
 from inflection import underscore
-from peewee import DoesNotExist
 
 from fsb.db.models import Module, ChatModule, Chat
 from fsb.events.modules import ModuleQueryEvent, GeneralMenuModuleEvent
@@ -23,14 +22,11 @@ class ModulesSettingsQueryHandler(MenuHandler):
             await action()
 
     async def action_general_menu(self, new_message: bool = False):
-        chat = self.query_event.get_chat()
+        chat = await self.query_event.get_chat()
 
-        try:
-            modules_names = [chat_module.module_id for chat_module in ChatModule.select().where(ChatModule.chat == chat)]
-        except DoesNotExist:
-            modules_names = []
+        modules_names = list(await ChatModule.aio_get_chat_modules(chat.id))
 
-        message, buttons = GeneralMenuModuleEvent.get_message_and_buttons(self.sender.id, chat.id, modules_names)
+        message, buttons = await GeneralMenuModuleEvent.get_message_and_buttons(self.sender.id, chat.id, modules_names)
 
         if new_message:
             await self.client.send_message(self.chat, message, buttons=buttons)
@@ -38,17 +34,17 @@ class ModulesSettingsQueryHandler(MenuHandler):
             await self.menu_message.edit(message, buttons=buttons)
 
     async def action_enable(self):
-        chat = self.query_event.get_chat()
+        chat = await self.query_event.get_chat()
         module_name = self.query_event.module_id
 
-        chat.enable_module(module_name)
+        await chat.aio_enable_module(module_name)
         await self.action_general_menu()
 
     async def action_disable(self):
-        chat = self.query_event.get_chat()
+        chat = await self.query_event.get_chat()
         module_name = self.query_event.module_id
 
-        chat.disable_module(module_name)
+        await chat.aio_disable_module(module_name)
         await self.action_general_menu()
 
 
@@ -56,13 +52,13 @@ class ModulesSettingsCommandHandler(CommandHandler):
     async def run(self):
         await super().run()
 
-        chat = Chat.get_by_telegram_id(self.chat.id)
+        chat = await Chat.aio_get_by_telegram_id(self.chat.id)
 
-        try:
-            modules_names = [chat_module.module_id for chat_module in ChatModule.select().where(ChatModule.chat == chat)]
-        except DoesNotExist:
-            modules_names = []
+        # Меню показывает состояние из бд, заодно обновляя кеш модулей
+        Module.invalidate_cache()
+        ChatModule.invalidate_cache(chat.id)
+        modules_names = list(await ChatModule.aio_get_chat_modules(chat.id))
 
-        message, buttons = GeneralMenuModuleEvent.get_message_and_buttons(self.sender.id, chat.id, modules_names)
+        message, buttons = await GeneralMenuModuleEvent.get_message_and_buttons(self.sender.id, chat.id, modules_names)
 
         await self.client.send_message(self.chat, message, buttons=buttons)
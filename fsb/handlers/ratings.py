@@ -15,7 +15,7 @@ from fsb.events.ratings import (
     DailyRollRatingEvent,
 )
 from fsb.handlers import CommandHandler, MenuHandler
-from fsb.helpers import Helper
+from fsb.helpers import Helper, ChatLock
 from fsb.services import RatingService
 
 
@@ -24,15 +24,15 @@ class RatingsSettingsCommandHandler(CommandHandler):
         await super().run()
         try:
             ratings = Rating.select().join(RatingMember, on=(RatingMember.rating_id == Rating.id)).where(
-                RatingMember.member == Member.get(
-                    Member.user == User.get_by_telegram_id(self.sender.id),
-                    Member.chat == Chat.get_by_telegram_id(self.chat.id)
+                RatingMember.member == await Member.aio_get(
+                    Member.user == await User.aio_get_by_telegram_id(self.sender.id),
+                    Member.chat == await Chat.aio_get_by_telegram_id(self.chat.id)
                 ),
             )
-            ratings_list = [f'{rating.command} (__{rating.name}__)' for rating in ratings]
+            ratings_list = [f'{rating.command} (__{rating.name}__)' for rating in await ratings.aio_execute()]
         except DoesNotExist:
             ratings_list = []
-        text, buttons = GeneralMenuRatingEvent.get_message_and_buttons(self.sender.id, ratings_list)
+        text, buttons = await GeneralMenuRatingEvent.get_message_and_buttons(self.sender.id, ratings_list)
         await self.client.send_message(self.chat, text, buttons=buttons)
 
 
@@ -47,18 +47,19 @@ class RatingCommandHandler(CommandHandler):
     async def run(self):
         await super().run()
         self._ratings_service = RatingService(self.client)
-        chat = Chat.get_by_telegram_id(self.chat.id)
+        chat = await Chat.aio_get_by_telegram_id(self.chat.id)
 
         if self.args:
-            ratings = [Rating.get(
+            ratings = [await Rating.aio_get(
                 Rating.command == self.args[0],
                 Rating.chat == chat
             )]
         else:
-            ratings = Rating.select().where(Rating.chat == chat)
+            ratings = await Rating.select().where(Rating.chat == chat).aio_execute()
 
-        for rating in ratings:
-            await self._win_send_message(rating)
+        async with ChatLock.hold(self.chat.id):
+            for rating in ratings:
+                await self._win_send_message(rating)
 
     async def _win_send_message(self, rating: Rating):
         match self.command:
@@ -80,15 +81,15 @@ class StatRatingCommandHandler(CommandHandler):
         await super().run()
         self._rating_service = RatingService(self.client)
         is_all = self.command == self.STAT_ALL_COMMAND
-        chat = Chat.get_by_telegram_id(self.chat.id)
+        chat = await Chat.aio_get_by_telegram_id(self.chat.id)
 
         if self.args:
-            ratings = [Rating.get(
+            ratings = [await Rating.aio_get(
                 Rating.command == self.args[0],
                 Rating.chat == chat
             )]
         else:
-            ratings = Rating.select().where(Rating.chat == chat)
+            ratings = await Rating.select().where(Rating.chat == chat).aio_execute()
 
         for rating in ratings:
             message = await self._rating_service.get_stat_message(rating, is_all)
@@ -112,47 +113,47 @@ class RatingsSettingsQueryHandler(MenuHandler):
     async def action_general_menu(self):
         try:
             ratings = Rating.select().join(RatingMember, on=(RatingMember.rating_id == Rating.id)).where(
-                RatingMember.member == Member.get(
-                    Member.user == User.get_by_telegram_id(self.sender.id),
-                    Member.chat == Chat.get_by_telegram_id(self.chat.id)
+                RatingMember.member == await Member.aio_get(
+                    Member.user == await User.aio_get_by_telegram_id(self.sender.id),
+                    Member.chat == await Chat.aio_get_by_telegram_id(self.chat.id)
                 ),
             ).order_by(Rating.id)
-            ratings_list = [f'{rating.command} (__{rating.name}__)' for rating in ratings]
+            ratings_list = [f'{rating.command} (__{rating.name}__)' for rating in await ratings.aio_execute()]
         except DoesNotExist:
             ratings_list = []
-        text, buttons = GeneralMenuRatingEvent.get_message_and_buttons(self.sender.id, ratings_list)
+        text, buttons = await GeneralMenuRatingEvent.get_message_and_buttons(self.sender.id, ratings_list)
         await self.menu_message.edit(text, buttons=buttons)
 
     async def action_reg_menu(self):
-        chat = Chat.get_by_telegram_id(self.chat.id)
-        member = Member.get(
-            Member.user == User.get_by_telegram_id(self.sender.id),
+        chat = await Chat.aio_get_by_telegram_id(self.chat.id)
+        member = await Member.aio_get(
+            Member.user == await User.aio_get_by_telegram_id(self.sender.id),
             Member.chat == chat
         )
-        chat_ratings = list(Rating.select().where(Rating.chat == chat).execute())
-        member_ratings = list(Rating.select().join(RatingMember, on=(RatingMember.rating_id == Rating.id)).where(
+        chat_ratings = await Rating.select().where(Rating.chat == chat).aio_execute()
+        member_ratings = await Rating.select().join(RatingMember, on=(RatingMember.rating_id == Rating.id)).where(
             Rating.chat == chat,
             RatingMember.member == member
-        ).execute())
+        ).aio_execute()
         ratings = list(set(chat_ratings) - set(member_ratings))
 
         buttons = []
         for rating in ratings:
             buttons.append((
                 f"{rating.command}",
-                RegRatingEvent(sender_id=self.sender.id, rating_id=rating.id, member_id=member.id).save_get_id()
+                await RegRatingEvent(sender_id=self.sender.id, rating_id=rating.id, member_id=member.id).aio_get_callback_data()
             ))
         buttons = Helper.make_buttons_layout(buttons, (
             "<< К меню рейтингов",
-            GeneralMenuRatingEvent(self.sender.id).save_get_id()
+            await GeneralMenuRatingEvent(self.sender.id).aio_get_callback_data()
         ))
 
         await self.menu_message.edit("Куда регаться", buttons=buttons)
 
     async def action_reg(self):
-        rating = self.query_event.get_rating()
-        member = self.query_event.get_member()
-        rating_member = RatingMember.get_or_none(
+        rating = await self.query_event.get_rating()
+        member = await self.query_event.get_member()
+        rating_member = await RatingMember.aio_get_or_none(
             RatingMember.rating == rating,
             RatingMember.member == member
         )
@@ -160,61 +161,61 @@ class RatingsSettingsQueryHandler(MenuHandler):
             await self.client.send_message(self.chat, "Ты уже зареган")
             return
         else:
-            RatingMember.create(rating=rating, member=member)
+            await RatingMember.aio_create(rating=rating, member=member)
             await self.action_reg_menu()
 
     async def action_unreg_menu(self):
-        chat = Chat.get_by_telegram_id(self.chat.id)
-        member = Member.get(
-            Member.user == User.get_by_telegram_id(self.sender.id),
+        chat = await Chat.aio_get_by_telegram_id(self.chat.id)
+        member = await Member.aio_get(
+            Member.user == await User.aio_get_by_telegram_id(self.sender.id),
             Member.chat == chat
         )
-        ratings = Rating.select().join(RatingMember, on=(RatingMember.rating_id == Rating.id)).where(
+        ratings = await Rating.select().join(RatingMember, on=(RatingMember.rating_id == Rating.id)).where(
             Rating.chat == chat,
             RatingMember.member == member
-        )
+        ).aio_execute()
 
         buttons = []
         for rating in ratings:
             buttons.append((
                 f"{rating.command}",
-                UnregRatingEvent(sender_id=self.sender.id, rating_id=rating.id, member_id=member.id).save_get_id()
+                await UnregRatingEvent(sender_id=self.sender.id, rating_id=rating.id, member_id=member.id).aio_get_callback_data()
             ))
         buttons = Helper.make_buttons_layout(buttons, (
             "<< К меню рейтингов",
-            GeneralMenuRatingEvent(self.sender.id).save_get_id()
+            await GeneralMenuRatingEvent(self.sender.id).aio_get_callback_data()
         ))
 
         await self.menu_message.edit("Откуда разрегаться", buttons=buttons)
 
     async def action_unreg(self):
-        rating = self.query_event.get_rating()
-        member = self.query_event.get_member()
-        rating_member = RatingMember.get_or_none(
+        rating = await self.query_event.get_rating()
+        member = await self.query_event.get_member()
+        rating_member = await RatingMember.aio_get_or_none(
             RatingMember.rating == rating,
             RatingMember.member == member
         )
         if rating_member:
-            rating_member.delete_instance()
+            await rating_member.aio_delete_instance()
             await self.action_unreg_menu()
         else:
             await self.client.send_message(self.chat, "Ты уже разреган")
             return
 
     async def action_list(self, new_message: bool=False):
-        chat = Chat.get_by_telegram_id(self.chat.id)
-        ratings = Rating.select().where(Rating.chat == chat).order_by(Rating.id)
+        chat = await Chat.aio_get_by_telegram_id(self.chat.id)
+        ratings = await Rating.select().where(Rating.chat == chat).order_by(Rating.id).aio_execute()
         buttons = []
 
         for rating in ratings:
             buttons.append((
                 rating.command,
-                MenuRatingEvent(sender_id=self.sender.id, rating_id=rating.id).save_get_id()
+                await MenuRatingEvent(sender_id=self.sender.id, rating_id=rating.id).aio_get_callback_data()
             ))
 
         buttons = Helper.make_buttons_layout(
             buttons,
-            ("<< К меню рейтингов", GeneralMenuRatingEvent(self.sender.id).save_get_id())
+            ("<< К меню рейтингов", await GeneralMenuRatingEvent(self.sender.id).aio_get_callback_data())
         )
         text = "Список рейтингов:"
 
@@ -232,9 +233,9 @@ class RatingsSettingsQueryHandler(MenuHandler):
         response_event_name = await response
 
         command, name = Rating.parse_from_message(response_event_name.message.text)
-        chat = Chat.get_by_telegram_id(self.chat.id)
+        chat = await Chat.aio_get_by_telegram_id(self.chat.id)
 
-        if Rating.get_or_none(Rating.chat == chat, Rating.command == command):
+        if await Rating.aio_get_or_none(Rating.chat == chat, Rating.command == command):
             return None
         else:
             return name, command, chat
@@ -245,7 +246,7 @@ class RatingsSettingsQueryHandler(MenuHandler):
                 params = await self.get_rating_params(conv)
 
                 if params:
-                    rating_id = Rating.create(name=params[0], command=params[1], chat=params[2]).save_get_id()
+                    rating_id = (await Rating.aio_create(name=params[0], command=params[1], chat=params[2])).id
                     await conv.send_message(f"Создан рейтинг: {params[0]} (__{params[1]}__)")
                 else:
                     await conv.send_message("Такой рейтинг уже существует")
@@ -259,7 +260,7 @@ class RatingsSettingsQueryHandler(MenuHandler):
                 await conv.send_message(ex.message)
 
     async def action_change(self):
-        rating = self.query_event.get_rating()
+        rating = await self.query_event.get_rating()
 
         async with self.client._client.conversation(self.chat) as conv:
             try:
@@ -270,7 +271,7 @@ class RatingsSettingsQueryHandler(MenuHandler):
                     old_command = rating.command
                     rating.name = params[0]
                     rating.command = params[1]
-                    rating.save()
+                    await rating.aio_save()
                     await conv.send_message(
                         f"Изменен рейтинг с {old_command} (__{old_name}__) на {rating.command} (__{rating.name}__)"
                     )
@@ -283,16 +284,16 @@ class RatingsSettingsQueryHandler(MenuHandler):
                 await conv.send_message(ex.message)
 
     async def action_delete(self):
-        rating = self.query_event.get_rating()
-        rating.delete_instance()
+        rating = await self.query_event.get_rating()
+        await rating.aio_delete_instance()
         await self.client.send_message(self.chat, f"Удалена роль: {rating.command} (__{rating.name}__)")
         await self.action_list()
 
     async def action_menu(self, new_message: bool = False):
-        rating = self.query_event.get_rating()
-        members = Helper.collect_members(
-            await self.client.get_dialog_members(self.chat),
-            RatingMember.select().where(RatingMember.rating == rating)
+        rating = await self.query_event.get_rating()
+        members = await Helper.aio_collect_members(
+            self.client.iter_dialog_members(self.chat),
+            await RatingMember.select_with_users().where(RatingMember.rating == rating).aio_execute()
         )
         members_names = []
 
@@ -301,10 +302,10 @@ class RatingsSettingsQueryHandler(MenuHandler):
 
         text = f"Меню рейтинга **{rating.command}** ({rating.name})\n\n**Участники:**\n" \
             + '\n'.join(members_names)
-        back_button = Button.inline('<< К списку ролей', ListRatingEvent(self.sender.id).save_get_id())
+        back_button = Button.inline('<< К списку ролей', await ListRatingEvent(self.sender.id).aio_get_callback_data())
         autorun_button = Button.inline(
             f'Авторолл: {"ВКЛ" if rating.autorun else "ВЫКЛ"}',
-            DailyRollRatingEvent(self.sender.id, rating.id).save_get_id()
+            await DailyRollRatingEvent(self.sender.id, rating.id).aio_get_callback_data()
         )
 
         if rating.command in [RatingService.PIDOR_KEYWORD, RatingService.CHAD_KEYWORD]:
@@ -315,8 +316,8 @@ class RatingsSettingsQueryHandler(MenuHandler):
         else:
             buttons = [
                 [
-                    Button.inline('Изменить', ChangeRatingEvent(self.sender.id, rating.id).save_get_id()),
-                    Button.inline('Удалить', DeleteRatingEvent(self.sender.id, rating.id).save_get_id()),
+                    Button.inline('Изменить', await ChangeRatingEvent(self.sender.id, rating.id).aio_get_callback_data()),
+                    Button.inline('Удалить', await DeleteRatingEvent(self.sender.id, rating.id).aio_get_callback_data()),
                     autorun_button,
                 ],
                 [back_button],
@@ -328,14 +329,14 @@ class RatingsSettingsQueryHandler(MenuHandler):
             await self.menu_message.edit(text, buttons=buttons)
 
     async def action_daily_roll(self):
-        rating = self.query_event.get_rating()
+        rating = await self.query_event.get_rating()
         rating.autorun = not rating.autorun
-        rating.save()
+        await rating.aio_save()
         await self.action_menu()
 
     async def action_create_default(self):
-        chat = Chat.get_by_telegram_id(self.chat.id)
-        self._rating_service.create_default_ratings(chat)
+        chat = await Chat.aio_get_by_telegram_id(self.chat.id)
+        await self._rating_service.create_default_ratings(chat)
         message = (f"Созданы рейтинги:"
                    f" {RatingService.PIDOR_KEYWORD} (__{RatingService.PIDOR_NAME}__)"
                    f" и {RatingService.CHAD_KEYWORD} (__{RatingService.CHAD_NAME}__)")
@@ -10,7 +10,6 @@ from fsb.db.models import Chat
 from fsb.db.models import Member
 from fsb.db.models import MemberRole
 from fsb.db.models import Role
-from fsb.db.models import User
 from fsb.errors import ConversationTimeoutError
 from fsb.errors import InputValueError
 from fsb.events.roles import (
@@ -25,7 +24,7 @@ from fsb.helpers import Helper
 class RolesSettingsCommandHandler(CommandHandler):
     async def run(self):
         await super().run()
-        text, buttons = GeneralMenuRoleEvent.get_message_and_buttons(self.sender.id)
+        text, buttons = await GeneralMenuRoleEvent.get_message_and_buttons(self.sender.id)
         await self.client.send_message(self.chat, text, buttons=buttons)
 
 
@@ -41,7 +40,7 @@ class RolesSettingsQueryHandler(MenuHandler):
             await action()
 
     async def action_general_menu(self):
-        text, buttons = GeneralMenuRoleEvent.get_message_and_buttons(self.sender.id)
+        text, buttons = await GeneralMenuRoleEvent.get_message_and_buttons(self.sender.id)
         await self.menu_message.edit(text, buttons=buttons)
 
     async def get_role_params(self, conv):
@@ -54,15 +53,15 @@ class RolesSettingsQueryHandler(MenuHandler):
 
         name, nickname = Role.parse_from_message(response_event.message.text)
 
-        chat = Chat.get_or_create(
+        chat = (await Chat.aio_get_or_create(
             telegram_id=self.chat.id,
             defaults={
                 'name': self.chat.title,
                 'type': Chat.get_chat_type(self.chat)
             }
-        )[0]
+        ))[0]
 
-        if Role.get_or_none(Role.chat == chat, Role.nickname == nickname):
+        if await Role.aio_get_or_none(Role.chat == chat, Role.nickname == nickname):
             return None
         else:
             return name, nickname, chat
@@ -73,7 +72,8 @@ class RolesSettingsQueryHandler(MenuHandler):
                 params = await self.get_role_params(conv)
 
                 if params:
-                    role_id = Role.create(name=params[0], nickname=params[1], chat=params[2]).save_get_id()
+                    role_id = (await Role.aio_create(name=params[0], nickname=params[1], chat=params[2])).id
+                    Role.invalidate_triggers(self.chat.id)
                     await conv.send_message(f"Создана роль: {params[0]} (__{params[1]}__)")
                 else:
                     await conv.send_message("Такая роль уже существует")
@@ -89,27 +89,27 @@ class RolesSettingsQueryHandler(MenuHandler):
         await self.client._client.send_message(entity=self.chat, message=self.menu_message)
 
     async def action_list(self, new_message: bool = False):
-        chat = Chat.get_or_create(
+        chat = (await Chat.aio_get_or_create(
             telegram_id=self.chat.id,
             defaults={
                 'name': self.chat.title,
                 'type': Chat.get_chat_type(self.chat)
             }
-        )[0]
-        roles = Role.find_by_chat(chat)
+        ))[0]
+        roles = await Role.find_by_chat(chat).aio_execute()
         buttons = []
         buttons_line = []
         for role in roles:
             buttons_line.append(Button.inline(
                 f"{role.name} (@{role.nickname})",
-                MenuRoleEvent(self.sender.id, role.id).save_get_id()
+                await MenuRoleEvent(self.sender.id, role.id).aio_get_callback_data()
             ))
             if len(buttons_line) == 2:
                 buttons.append(buttons_line.copy())
                 buttons_line = []
         if buttons_line:
             buttons.append(buttons_line.copy())
-        buttons.append([Button.inline("<< К меню ролей", GeneralMenuRoleEvent(self.sender.id).save_get_id())])
+        buttons.append([Button.inline("<< К меню ролей", await GeneralMenuRoleEvent(self.sender.id).aio_get_callback_data())])
         text = "Список ролей:"
         if new_message:
             await self.client.send_message(self.chat, text, buttons=buttons)
@@ -117,20 +117,20 @@ class RolesSettingsQueryHandler(MenuHandler):
             await self.menu_message.edit(text, buttons=buttons)
 
     async def action_delete_menu(self):
-        chat = Chat.get_or_create(
+        chat = (await Chat.aio_get_or_create(
             telegram_id=self.chat.id,
             defaults={
                 'name': self.chat.title,
                 'type': Chat.get_chat_type(self.chat)
             }
-        )[0]
-        roles = Role.find_by_chat(chat)
+        ))[0]
+        roles = await Role.find_by_chat(chat).aio_execute()
         buttons = []
         buttons_line = []
         for role in roles:
             buttons_line.append(Button.inline(
                 f"{role.name} (@{role.nickname})",
-                DeleteRoleEvent(self.sender.id, role.id).save_get_id()
+                await DeleteRoleEvent(self.sender.id, role.id).aio_get_callback_data()
             ))
             if len(buttons_line) == 2:
                 buttons.append(buttons_line.copy())
@@ -138,22 +138,22 @@ class RolesSettingsQueryHandler(MenuHandler):
         if buttons_line:
             buttons.append(buttons_line.copy())
 
-        buttons.append([Button.inline("<< К меню ролей", GeneralMenuRoleEvent(self.sender.id).save_get_id())])
+        buttons.append([Button.inline("<< К меню ролей", await GeneralMenuRoleEvent(self.sender.id).aio_get_callback_data())])
         await self.menu_message.edit("Удалить роль:", buttons=buttons)
 
     async def action_menu(self, new_message: bool = False):
-        role = self.query_event.get_role()
+        role = await self.query_event.get_role()
         text = f"Меню роли **{role.name}** (@{role.nickname}):"
         buttons = [
             [
-                Button.inline('Участники', ListMembersRoleEvent(self.sender.id, role.id).save_get_id()),
+                Button.inline('Участники', await ListMembersRoleEvent(self.sender.id, role.id).aio_get_callback_data()),
             ],
             [
-                Button.inline('Изменить', ChangeRoleEvent(self.sender.id, role.id).save_get_id()),
-                Button.inline('Удалить', DeleteRoleEvent(self.sender.id, role.id).save_get_id()),
+                Button.inline('Изменить', await ChangeRoleEvent(self.sender.id, role.id).aio_get_callback_data()),
+                Button.inline('Удалить', await DeleteRoleEvent(self.sender.id, role.id).aio_get_callback_data()),
             ],
             [
-                Button.inline('<< К списку ролей', ListRoleEvent(self.sender.id).save_get_id())
+                Button.inline('<< К списку ролей', await ListRoleEvent(self.sender.id).aio_get_callback_data())
             ],
         ]
 
@@ -163,13 +163,14 @@ class RolesSettingsQueryHandler(MenuHandler):
             await self.menu_message.edit(text, buttons=buttons)
 
     async def action_delete(self):
-        role = self.query_event.get_role()
-        role.delete_instance()
+        role = await self.query_event.get_role()
+        await role.aio_delete_instance()
+        Role.invalidate_triggers(self.chat.id)
         await self.client.send_message(self.chat, f"Удалена роль: {role.name} (__{role.nickname}__)")
         await self.action_list(True)
 
     async def action_change(self):
-        role = self.query_event.get_role()
+        role = await self.query_event.get_role()
 
         async with self.client._client.conversation(self.chat) as conv:
             try:
@@ -179,7 +180,8 @@ class RolesSettingsQueryHandler(MenuHandler):
                     old_nickname = role.nickname
                     role.name = params[0]
                     role.nickname = params[1]
-                    role.save()
+                    await role.aio_save()
+                    Role.invalidate_triggers(self.chat.id)
                     await conv.send_message(
                         f"Изменена роль с {old_name} (__{old_nickname}__) на {role.name} (__{role.nickname}__)"
                     )
@@ -194,13 +196,13 @@ class RolesSettingsQueryHandler(MenuHandler):
         await self.action_menu(True)
 
     async def get_role_members(self, role: Role) -> list:
-        return Helper.collect_members(
-            await self.client.get_dialog_members(self.chat),
-            MemberRole.select().where(MemberRole.role == role)
+        return await Helper.aio_collect_members(
+            self.client.iter_dialog_members(self.chat),
+            await MemberRole.select_with_users().where(MemberRole.role == role).aio_execute()
         )
 
     async def action_list_members(self, new_message: bool = False):
-        role = self.query_event.get_role()
+        role = await self.query_event.get_role()
         members_names = []
         for tg_member, db_member in await self.get_role_members(role):
             members_names.append(Helper.make_member_name(tg_member))
@@ -211,11 +213,11 @@ class RolesSettingsQueryHandler(MenuHandler):
 
         buttons = [
             [
-                Button.inline('Добавить участника', AddMemberMenuRoleEvent(self.sender.id, role.id).save_get_id()),
-                Button.inline('Удалить участника', RemoveMemberMenuRoleEvent(self.sender.id, role.id).save_get_id()),
+                Button.inline('Добавить участника', await AddMemberMenuRoleEvent(self.sender.id, role.id).aio_get_callback_data()),
+                Button.inline('Удалить участника', await RemoveMemberMenuRoleEvent(self.sender.id, role.id).aio_get_callback_data()),
             ],
             [
-                Button.inline('<< К меню роли', MenuRoleEvent(self.sender.id, role.id).save_get_id())
+                Button.inline('<< К меню роли', await MenuRoleEvent(self.sender.id, role.id).aio_get_callback_data())
             ],
         ]
         if new_message:
@@ -224,57 +226,52 @@ class RolesSettingsQueryHandler(MenuHandler):
             await self.menu_message.edit(text, buttons=buttons)
 
     async def action_add_member_menu(self, new_message: bool = False):
-        role = self.query_event.get_role()
-        chat = Chat.get_by_telegram_id(self.chat.id)
-
-        role_members_tg_ids = [tg_member.id for tg_member, db_member in await self.get_role_members(role)]
-        members = []
-        for tg_member in await self.client.get_dialog_members(self.chat):
-            if tg_member.id in role_members_tg_ids:
-                continue
-
-            user = User.get_or_create(
-                telegram_id=tg_member.id,
-                defaults={
-                    'name': Helper.make_member_name(tg_member, with_username=False),
-                    'nickname': tg_member.username
-                }
-            )[0]
-            db_member = Member.get_or_create(chat=chat, user=user)[0]
-
-            members.append((tg_member, db_member))
+        role = await self.query_event.get_role()
+        chat = await Chat.aio_get_by_telegram_id(self.chat.id)
+
+        # Меню строится по уже синхронизированным участникам чата и ничего не пишет в бд
+        members = await Helper.aio_collect_members(
+            self.client.iter_dialog_members(self.chat),
+            await Member.select_with_users().where(
+                (Member.chat == chat)
+                & Member.deleted_at.is_null()
+                & Member.id.not_in(MemberRole.select(MemberRole.member).where(MemberRole.role == role))
+            ).aio_execute()
+        )
 
         await self._member_menu('add', members, new_message)
 
     async def action_add_member(self):
-        role = self.query_event.get_role()
-        member = self.query_event.get_member()
+        role = await self.query_event.get_role()
+        member = await self.query_event.get_member()
 
-        if MemberRole.get_or_none(MemberRole.role == role, MemberRole.member == member):
+        if await MemberRole.aio_get_or_none(MemberRole.role == role, MemberRole.member == member):
             await self.client.send_message(self.chat, f"Этот участник уже добавлен к {role.name} (__{role.nickname}__).")
             return
         else:
-            MemberRole.create(role=role, member=member)
+            await MemberRole.aio_create(role=role, member=member)
+            Role.invalidate_triggers(self.chat.id)
             await self.action_add_member_menu()
 
     async def action_remove_member_menu(self, new_message: bool = False):
-        role = self.query_event.get_role()
+        role = await self.query_event.get_role()
         members = [(tg_member, db_member.member) for tg_member, db_member in await self.get_role_members(role)]
         await self._member_menu('remove', members, new_message)
 
     async def action_remove_member(self):
-        role = self.query_event.get_role()
-        member = self.query_event.get_member()
-        role_member = MemberRole.get_or_none(MemberRole.role == role, MemberRole.member == member)
+        role = await self.query_event.get_role()
+        member = await self.query_event.get_member()
+        role_member = await MemberRole.aio_get_or_none(MemberRole.role == role, MemberRole.member == member)
 
         if not role_member:
             await self.client.send_message(self.chat, f"Этот участник уже удален из {role.name} (@{role.nickname}).")
         else:
-            role_member.delete_instance()
+            await role_member.aio_delete_instance()
+            Role.invalidate_triggers(self.chat.id)
             await self.action_remove_member_menu()
 
     async def _member_menu(self, action: str, members: list, new_message: bool = False):
-        role = self.query_event.get_role()
+        role = await self.query_event.get_role()
 
         match action:
             case 'add':
@@ -290,11 +287,11 @@ class RolesSettingsQueryHandler(MenuHandler):
         for tg_member, db_member in members:
             buttons.append((
                 Helper.make_member_name(tg_member, with_mention=True),
-                event_class(sender_id=self.sender.id, role_id=role.id, member_id=db_member.id).save_get_id()
+                await event_class(sender_id=self.sender.id, role_id=role.id, member_id=db_member.id).aio_get_callback_data()
             ))
         buttons = Helper.make_buttons_layout(
             buttons,
-            ("<< Участники", ListMembersRoleEvent(self.sender.id, role.id).save_get_id())
+            ("<< Участники", await ListMembersRoleEvent(self.sender.id, role.id).aio_get_callback_data())
         )
 
         if new_message:
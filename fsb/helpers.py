@@ -1,10 +1,13 @@
 # !/usr/bin/env python
 
 import json
-import logging
+from asyncio import Lock, sleep, wait_for, TimeoutError as AsyncTimeoutError
+from bisect import bisect_left
+from contextlib import asynccontextmanager, contextmanager
 from datetime import datetime
-from threading import Thread
-from typing import Union, Iterable
+from functools import lru_cache
+from time import monotonic, perf_counter
+from typing import Union, Iterable, AsyncIterable
 
 import yaml
 from pymorphy3 import MorphAnalyzer
@@ -13,19 +16,25 @@ from telethon.tl.patched import Message
 
 from fsb.config import config
 from fsb.events.common import CallbackQueryEventDTO, EventDTO, MessageEventDTO, ChatActionEventDTO
+from fsb.logger import LazyMessage
 
 
 class InfoBuilder:
 
     JSON = 1
     YAML = 2
+    LAZY = 3
 
     @staticmethod
     def builder_decorator(callback: callable):
-        def build(*args, **kwargs):
-            data_info = callback(*args, **kwargs)
-            view_type = kwargs.get('view_type')
+        def build(*args, title: str = None, view_type: int = None, **kwargs):
+            # view_type и title нужны только здесь, сами построители получают лишь данные
             view_type = view_type if isinstance(view_type, int) else InfoBuilder.JSON
+
+            if view_type == InfoBuilder.LAZY:
+                return LazyMessage(title, lambda: callback(*args, **kwargs))
+
+            data_info = callback(*args, **kwargs)
             match view_type:
                 case InfoBuilder.JSON:
                     return json.dumps(data_info, sort_keys=False, indent=2, ensure_ascii=False)
@@ -34,17 +43,13 @@ class InfoBuilder:
         return build
 
     @staticmethod
-    @builder_decorator
-    def build_log(message: str, data):
-        data_info = {
-            'message': message,
-            'data': data,
-        }
-        return data_info
+    def build_log(message: str, data) -> LazyMessage:
+        # Копия, так как данные сериализуются в другом потоке, а счётчики продолжают меняться
+        return LazyMessage(message, lambda: dict(data) if isinstance(data, dict) else data)
 
     @staticmethod
     @builder_decorator
-    def build_message_info_by_message_event(event: MessageEventDTO, view_type: int = None):
+    def build_message_info_by_message_event(event: MessageEventDTO):
         assert isinstance(event, MessageEventDTO)
         chat_info = InfoBuilder.build_chat_info(event)
 
@@ -57,7 +62,7 @@ class InfoBuilder:
 
     @staticmethod
     @builder_decorator
-    def build_message_info_by_query_event(event: CallbackQueryEventDTO, view_type: int = None):
+    def build_message_info_by_query_event(event: CallbackQueryEventDTO):
         assert isinstance(event, CallbackQueryEventDTO)
         chat_info = InfoBuilder.build_chat_info(event)
 
@@ -73,7 +78,7 @@ class InfoBuilder:
 
     @staticmethod
     @builder_decorator
-    def build_message_info_by_chat_action(event: ChatActionEventDTO, view_type: int = None):
+    def build_message_info_by_chat_action(event: ChatActionEventDTO):
         assert isinstance(event, ChatActionEventDTO)
 
         data_info = {
@@ -120,7 +125,7 @@ class InfoBuilder:
 
     @staticmethod
     @builder_decorator
-    def build_entity_info(entity, view_type: int = None):
+    def build_entity_info(entity):
         match entity.__class__.__name__:
             case 'Chat' | 'Channel':
                 data_info = {
@@ -192,6 +197,9 @@ class Helper:
            'июль', 'август', 'сентябрь', 'октябрь', 'ноябрь', 'декабрь']
     COLLECT_RETURN_ONLY_TG = 1
     COLLECT_RETURN_ONLY_DB = 2
+    MORPH_CACHE_SIZE = 1024
+
+    _morph_analyzer = None
 
     @staticmethod
     def make_member_name(member, with_fullname: bool = True, with_username: bool = True, with_mention: bool = False,
@@ -282,6 +290,34 @@ class Helper:
         except AttributeError:
             return None
 
+    @staticmethod
+    async def aio_collect_members(tg_members_chunks: AsyncIterable, db_members: Iterable, flag: int = None) -> Union[list, None]:
+        # Из потока участников чата запоминаются только нужные, поэтому память не растёт с размером чата
+        try:
+            db_members = list(db_members)
+            telegram_ids = {db_member.get_telegram_id() for db_member in db_members}
+            tg_members = {}
+
+            try:
+                async for chunk in tg_members_chunks:
+                    for tg_member in chunk:
+                        if tg_member.id in telegram_ids:
+                            tg_members[tg_member.id] = tg_member
+
+                    if len(tg_members) == len(telegram_ids):
+                        break
+            finally:
+                if hasattr(tg_members_chunks, 'aclose'):
+                    await tg_members_chunks.aclose()
+
+            return Helper.collect_members(tg_members.values(), db_members, flag)
+        except AttributeError:
+            return None
+
+    @staticmethod
+    def filter_members_by_ids(telegram_ids: set, db_members: Iterable) -> list:
+        return [db_member for db_member in db_members if db_member.get_telegram_id() in telegram_ids]
+
     @staticmethod
     def make_count_str(count: int, advanced_count: int = None) -> str:
         dozens = count % 100
@@ -317,9 +353,32 @@ class Helper:
             buttons.append([Button.inline(closing_button[0], closing_button[1])])
         return buttons
 
+    @staticmethod
+    def get_morph_analyzer() -> MorphAnalyzer:
+        # Словари pymorphy3 грузятся долго, поэтому анализатор один на процесс
+        if Helper._morph_analyzer is None:
+            Helper._morph_analyzer = MorphAnalyzer(lang='ru')
+
+        return Helper._morph_analyzer
+
+    @staticmethod
+    def get_morph_cache_stats() -> dict:
+        stats = {}
+
+        for name, cached in [('inflect', Helper._inflect_word), ('lexeme', Helper._get_lexeme)]:
+            info = cached.cache_info()
+            stats.update({f'{name}_hits': info.hits, f'{name}_misses': info.misses, f'{name}_size': info.currsize})
+
+        return stats
+
     @staticmethod
     def inflect_word(word, grammemes):
-        inflected_word = MorphAnalyzer(lang='ru').parse(word)[0].inflect(grammemes)
+        return Helper._inflect_word(word, frozenset(grammemes))
+
+    @staticmethod
+    @lru_cache(maxsize=MORPH_CACHE_SIZE)
+    def _inflect_word(word: str, grammemes: frozenset) -> str:
+        inflected_word = Helper.get_morph_analyzer().parse(word)[0].inflect(set(grammemes))
 
         if inflected_word:
             result = inflected_word.word
@@ -328,6 +387,12 @@ class Helper:
 
         return result
 
+    @staticmethod
+    @lru_cache(maxsize=MORPH_CACHE_SIZE)
+    def _get_lexeme(word: str) -> tuple:
+        parsed_word = Helper.get_morph_analyzer().parse(word)[0]
+        return tuple((item.tag.case, item.tag.number, item.word) for item in parsed_word.lexeme)
+
     @staticmethod
     def get_words_lexeme(**kwargs) -> dict:
         string_format = {}
@@ -344,21 +409,19 @@ class Helper:
             else:
                 word_case = None
 
-            parsed_word = MorphAnalyzer(lang='ru').parse(word)[0]
-
-            for lexeme_item in parsed_word.lexeme:
-                lexeme_key = f'{key}_{lexeme_item.tag.case}_{lexeme_item.tag.number}'
+            for case, number, item_word in Helper._get_lexeme(word.lower()):
+                lexeme_key = f'{key}_{case}_{number}'
                 lexeme_key = lexeme_key.rstrip('_')
 
                 match word_case:
                     case 'upper':
-                        lexeme_word = lexeme_item.word.upper()
+                        lexeme_word = item_word.upper()
                     case 'lower':
-                        lexeme_word = lexeme_item.word.lower()
+                        lexeme_word = item_word.lower()
                     case 'capitalize':
-                        lexeme_word = lexeme_item.word.capitalize()
+                        lexeme_word = item_word.capitalize()
                     case _:
-                        lexeme_word = lexeme_item.word
+                        lexeme_word = item_word
 
                 string_format[lexeme_key] = lexeme_word
 
@@ -382,19 +445,242 @@ class Helper:
     def split_chunks(items: list, chunk_size: int) -> list:
         return [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
 
+    @staticmethod
+    async def iter_chunks(items: Union[Iterable, AsyncIterable], chunk_size: int):
+        chunk = []
+
+        if hasattr(items, '__aiter__'):
+            async for item in items:
+                chunk.append(item)
+
+                if len(chunk) >= chunk_size:
+                    yield chunk
+                    chunk = []
+        else:
+            for item in items:
+                chunk.append(item)
 
-class ReturnedThread(Thread):
+                if len(chunk) >= chunk_size:
+                    yield chunk
+                    chunk = []
+
+        if chunk:
+            yield chunk
+
+
+class ChatLock:
     TIMEOUT = 60
-    result = None
-    logger = logging.getLogger('main')
 
-    def run(self):
+    stats = {
+        'acquired': 0,
+        'contended': 0,
+        'timeouts': 0,
+        'max_queue_depth': 0,
+    }
+    _locks = {}
+    _queue_depths = {}
+
+    @staticmethod
+    @asynccontextmanager
+    async def hold(chat_id: int, timeout: int = TIMEOUT):
+        # asyncio.Lock будит ожидающих в порядке очереди, так что очередь событий чата честная
+        lock = ChatLock._locks.setdefault(chat_id, Lock())
+
+        if lock.locked() or ChatLock.get_queue_depth(chat_id):
+            ChatLock.stats['contended'] += 1
+
+        ChatLock._queue_depths[chat_id] = ChatLock._queue_depths.get(chat_id, 0) + 1
+        ChatLock.stats['max_queue_depth'] = max(ChatLock.stats['max_queue_depth'], ChatLock._queue_depths[chat_id])
+
+        try:
+            await wait_for(lock.acquire(), timeout)
+        except AsyncTimeoutError:
+            ChatLock.stats['timeouts'] += 1
+            raise TimeoutError(f'Chat {chat_id} lock timeout')
+        finally:
+            ChatLock._queue_depths[chat_id] -= 1
+
+        ChatLock.stats['acquired'] += 1
+
         try:
-            if self._target is not None:
-                self.result = self._target(*self._args, **self._kwargs)
-                self.logger.info(f'Thread result: {self.result}')
+            yield lock
         finally:
-            del self._target, self._args, self._kwargs
+            lock.release()
+
+            if not ChatLock._queue_depths[chat_id]:
+                ChatLock._queue_depths.pop(chat_id, None)
+                ChatLock._locks.pop(chat_id, None)
+
+    @staticmethod
+    async def wait(chat_id: int, timeout: int = TIMEOUT):
+        if ChatLock.is_locked(chat_id):
+            async with ChatLock.hold(chat_id, timeout):
+                pass
+
+    @staticmethod
+    def is_locked(chat_id: int) -> bool:
+        lock = ChatLock._locks.get(chat_id)
+        return bool(lock) and lock.locked()
+
+    @staticmethod
+    def get_queue_depth(chat_id: int) -> int:
+        return ChatLock._queue_depths.get(chat_id, 0)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity if capacity else max(rate, 1)
+        self._tokens = self.capacity
+        self._updated = monotonic()
+        self._lock = Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+
+                await sleep((1 - self._tokens) / self.rate)
+
+
+class Histogram:
+    # Границы корзин в секундах
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, buckets: tuple = BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        if not self.count:
+            return 0.0
+
+        rank = q * self.count
+        seen = 0
+
+        # Оценка сверху: граница корзины, в которую попал квантиль
+        for i, count in enumerate(self.counts):
+            seen += count
+
+            if seen >= rank:
+                return min(self.buckets[i], self.max) if i < len(self.buckets) else self.max
+
+        return self.max
+
+    def to_dict(self) -> dict:
+        return {
+            'count': self.count,
+            'avg': round(self.sum / self.count, 4) if self.count else 0.0,
+            'p50': round(self.quantile(0.5), 4),
+            'p95': round(self.quantile(0.95), 4),
+            'p99': round(self.quantile(0.99), 4),
+            'max': round(self.max, 4),
+        }
+
+
+class Metrics:
+    HANDLE = 'handle'
+    HANDLER = 'handler'
+    TELEGRAM = 'telegram'
+    LOOP_LAG = 'loop_lag'
+
+    PREFIX = 'fsb_'
+
+    # метрика => {(метка, ((имя доп. метки, значение), ...)): Histogram}
+    histograms = {}
+    # метрика => {(имя метки, значение), ...: значение счётчика}
+    counters = {}
+
+    @staticmethod
+    def observe(name: str, label: str, value: float, **labels):
+        histograms = Metrics.histograms.setdefault(name, {})
+        key = (label, tuple(sorted(labels.items())))
+        histogram = histograms.get(key)
+
+        if histogram is None:
+            histogram = histograms[key] = Histogram()
+
+        histogram.observe(value)
+
+    @staticmethod
+    @contextmanager
+    def timer(name: str, label: str):
+        started = perf_counter()
+
+        try:
+            yield
+        finally:
+            Metrics.observe(name, label, perf_counter() - started)
+
+    @staticmethod
+    def get_summary() -> dict:
+        return {
+            name: {
+                label + Metrics._format_labels(labels): histogram.to_dict()
+                for (label, labels), histogram in sorted(histograms.items())
+            }
+            for name, histograms in Metrics.histograms.items()
+        }
+
+    @staticmethod
+    def inc(name: str, value: float = 1, **labels):
+        values = Metrics.counters.setdefault(name, {})
+        key = tuple(sorted(labels.items()))
+        values[key] = values.get(key, 0) + value
+
+    @staticmethod
+    def render_prometheus(gauges: dict = None) -> str:
+        lines = []
+
+        for name, values in Metrics.counters.items():
+            lines.append(f"# TYPE {Metrics.PREFIX}{name}_total counter")
+
+            for labels, value in values.items():
+                lines.append(f"{Metrics.PREFIX}{name}_total{Metrics._format_labels(labels)} {value}")
+
+        for name, labels_histograms in Metrics.histograms.items():
+            lines.append(f"# TYPE {Metrics.PREFIX}{name}_seconds histogram")
+
+            for (label, extra_labels), histogram in labels_histograms.items():
+                cumulative = 0
+
+                for bucket, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+                    cumulative += count
+                    labels = Metrics._format_labels((('name', label),) + extra_labels + (('le', bucket),))
+                    lines.append(f"{Metrics.PREFIX}{name}_seconds_bucket{labels} {cumulative}")
+
+                labels = Metrics._format_labels((('name', label),) + extra_labels)
+                lines.append(f"{Metrics.PREFIX}{name}_seconds_sum{labels} {histogram.sum}")
+                lines.append(f"{Metrics.PREFIX}{name}_seconds_count{labels} {histogram.count}")
+
+        for name, values in (gauges or {}).items():
+            lines.append(f"# TYPE {Metrics.PREFIX}{name} gauge")
+
+            for labels, value in values.items():
+                lines.append(f"{Metrics.PREFIX}{name}{Metrics._format_labels(labels)} {value}")
+
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def _format_labels(labels: tuple) -> str:
+        if not labels:
+            return ''
 
-    def join(self, timeout=TIMEOUT):
-        super().join(timeout)
+        return '{' + ','.join(
+            f'{name}="' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"' for name, value in labels
+        ) + '}'
@@ -0,0 +1,246 @@
+# !/usr/bin/env python
+
+import logging
+from datetime import datetime
+from hashlib import md5
+from random import randint
+from time import time
+
+from telethon.tl.functions.messages import GetStickerSetRequest
+from telethon.tl.types import InputStickerSetShortName, DocumentAttributeVideo
+
+from fsb.config import config
+from fsb.db.models import Chat, Module, Rating
+from fsb.helpers import ChatLock, Helper, InfoBuilder
+from fsb.services import BirthdayService, BroadcastService, FoolService, RatingService
+from fsb.telegram.client import TelegramApiClient
+
+
+# Плановые задачи бота. Запускаются консольными командами и планировщиком внутри процесса бота (system_jobs в config.yml)
+
+def ratings_with_chat():
+    return Rating.with_enabled_module(query=Rating.select(Rating, Chat).join(Chat))
+
+
+async def autorun_ratings():
+    return await ratings_with_chat().where(Rating.autorun).aio_execute()
+
+
+async def run_rolls(client: TelegramApiClient, name: str, roll: callable) -> dict:
+    # Разные чаты роллятся параллельно в общем лимите отправки, рейтинги одного чата - строго по очереди
+    started = time()
+    chats_ratings = {}
+
+    for rating in await autorun_ratings():
+        chats_ratings.setdefault(rating.chat_id, (rating.chat, []))[1].append(rating)
+
+    broadcast = BroadcastService(client, name)
+    ratings_service = RatingService(broadcast)
+    rolled = []
+
+    async def job(chat: Chat):
+        async with ChatLock.hold(chat.telegram_id):
+            for rating in chats_ratings[chat.id][1]:
+                if await roll(ratings_service, rating):
+                    rolled.append(rating.id)
+
+    report = await broadcast.run([chat for chat, _ in chats_ratings.values()], job)
+    run_time = time() - started
+    roll_report = {
+        'chats': len(chats_ratings),
+        'ratings': sum(len(ratings) for _, ratings in chats_ratings.values()),
+        'rolled': len(rolled),
+        'failed_chats': report['failed'],
+        'time': round(run_time, 2),
+        'rolls_per_minute': round(len(rolled) / run_time * 60, 2) if run_time else 0,
+    }
+    logging.getLogger('main').info(InfoBuilder.build_log(f'Rolls {name} report', roll_report))
+
+    return roll_report
+
+
+async def month_roll(client: TelegramApiClient):
+    async def roll(ratings_service: RatingService, rating: Rating) -> bool:
+        if rating.last_month_winner_id \
+                and rating.last_month_run \
+                and rating.last_month_run >= datetime.today().replace(hour=0, minute=0, second=0, microsecond=0, day=1):
+            return False
+
+        if config.FOOL_DAY:
+            await ratings_service.fool_roll(rating, rating.chat.telegram_id, True)
+        else:
+            await ratings_service.roll(rating, rating.chat.telegram_id, True)
+
+        return True
+
+    return await run_rolls(client, 'month-roll', roll)
+
+
+async def day_roll(client: TelegramApiClient):
+    async def roll(ratings_service: RatingService, rating: Rating) -> bool:
+        if rating.last_run \
+                and rating.last_run >= datetime.today().replace(hour=0, minute=0, second=0, microsecond=0):
+            return False
+
+        if config.FOOL_DAY:
+            await ratings_service.fool_roll(rating, rating.chat.telegram_id)
+        else:
+            await ratings_service.roll(rating, rating.chat.telegram_id)
+
+        return True
+
+    return await run_rolls(client, 'day-roll', roll)
+
+
+async def year_roll(client: TelegramApiClient):
+    async def roll(ratings_service: RatingService, rating: Rating) -> bool:
+        rolled = False
+
+        if not (rating.last_month_winner_id
+                and rating.last_month_run
+                and rating.last_month_run >= datetime.today().replace(hour=0, minute=0, second=0, microsecond=0, day=1)):
+            await ratings_service.roll(rating, rating.chat.telegram_id, True)
+            rolled = True
+
+        if not (rating.last_year_winner_id
+                and rating.last_year_run
+                and rating.last_year_run >= datetime.today().replace(hour=0, minute=0, second=0, microsecond=0, day=1, month=1)):
+            await ratings_service.roll_year(rating, rating.chat.telegram_id)
+            rolled = True
+
+        return rolled
+
+    return await run_rolls(client, 'year-roll', roll)
+
+
+async def natural_not_found(client: TelegramApiClient):
+    rating_service = RatingService(client)
+
+    for rating in await ratings_with_chat().where(Rating.command == 'natural').aio_execute():
+        stat_message = await rating_service.get_stat_message(rating, True)
+        main_message = 'В этом чате натуралы все еще не обнаружены'
+
+        await client.send_message(rating.chat.telegram_id, stat_message)
+        await client.send_message(rating.chat.telegram_id, main_message)
+
+
+async def dude_broadcast(client: TelegramApiClient):
+    sticker_set_name = config.dude.sticker_set_name
+    stickers_ids = config.dude.sticker_set_documents_ids
+
+    if sticker_set_name and stickers_ids:
+        sticker_set = await client.request(GetStickerSetRequest(InputStickerSetShortName(sticker_set_name)))
+        stickers = [sticker for sticker in sticker_set.documents if sticker.id in stickers_ids]
+        message = stickers[randint(0, len(stickers) - 1)]
+        is_file = True
+    else:
+        message = 'It is Wednesday, my dudes!'
+        is_file = False
+
+    broadcast = BroadcastService(client, 'dude')
+    fool_service = FoolService(broadcast)
+
+    async def job(chat: Chat):
+        if config.FOOL_DAY:
+            await fool_service.send_message(chat.telegram_id)
+        else:
+            await broadcast.send_message(chat.telegram_id, message, is_file=is_file)
+
+    await broadcast.run(list(await Chat.with_enabled_module(Module.MODULE_DUDE).aio_execute()), job)
+
+
+async def new_year_broadcast(client: TelegramApiClient):
+    film = None
+    gif = None
+
+    if config.content.new_year_film:
+        film = await client._client.upload_file(config.content.new_year_film, file_name='Happy New Year.mp4')
+
+    if config.content.new_year_gif:
+        gif = await client._client.upload_file(config.content.new_year_gif, file_name='Happy New Year.gif')
+
+    broadcast = BroadcastService(client, 'new-year', str(datetime.now().year))
+
+    async def job(chat: Chat):
+        if gif:
+            await broadcast.send_message(chat.telegram_id, gif, is_file=True)
+        else:
+            await broadcast.send_message(chat.telegram_id, 'Happy New Year!')
+
+        if film:
+            await broadcast.send_message(chat.telegram_id, film, is_file=True, caption='Новогодно-короткометражный подгон', attributes=(DocumentAttributeVideo(0, 426, 240),))
+
+    await broadcast.run(list(await Chat.with_enabled_module(Module.MODULE_HAPPY_NEW_YEAR).aio_execute()), job)
+
+
+async def birthday_congratulation(client: TelegramApiClient):
+    broadcast = BroadcastService(client, 'birthday')
+    birthday_service = BirthdayService(broadcast)
+
+    await broadcast.run(list(await Chat.with_enabled_module(Module.MODULE_BIRTHDAY).aio_execute()), birthday_service.send_message)
+
+
+async def send_message(client: TelegramApiClient, text: str, chats: str):
+    if not text:
+        return
+
+    if chats:
+        chats = [chat_id.strip() for chat_id in chats.split(',')]
+        query = Chat.select()
+
+        if 'all' not in chats:
+            chats_ids = []
+
+            for chat in chats:
+                match chat:
+                    case 'user':
+                        query = query.orwhere(Chat.type == Chat.USER_TYPE)
+                    case 'channel':
+                        query = query.orwhere(Chat.type.in_([Chat.CHAT_TYPE, Chat.CHANNEL_TYPE]))
+                    case _:
+                        if chat.isnumeric():
+                            chats_ids.append(int(chat))
+                        else:
+                            raise ValueError(f'Invalid chat argument: "{chat}"')
+
+            if chats_ids:
+                query = query.where(Chat.id.in_(chats_ids))
+    else:
+        return
+
+    # Повторный запуск той же рассылки в тот же день продолжит её с места остановки
+    run_key = md5(f'{text}|{",".join(chats)}|{datetime.now():%Y-%m-%d}'.encode()).hexdigest()
+    broadcast = BroadcastService(client, 'message', run_key)
+
+    async def job(chat: Chat):
+        await broadcast.send_message(chat.telegram_id, text)
+
+    await broadcast.run(list(await query.aio_execute()), job)
+
+
+async def countdown(client: TelegramApiClient, text: str, date: str, chats: str):
+    if date:
+        now = datetime.now().replace(hour=0, minute=0, second=0)
+        date = datetime.fromisoformat(date).replace(hour=0, minute=0, second=0)
+
+        left_days = abs((date - now).days)
+
+        day_word_lexeme = Helper.get_morph_analyzer().parse('день')[0]
+        day_word = day_word_lexeme.make_agree_with_number(left_days).word
+
+        text = text.format(day_word=day_word, left_days=left_days)
+
+    await send_message(client, text, chats)
+
+
+SYSTEM_JOBS = {
+    'month-roll': month_roll,
+    'day-roll': day_roll,
+    'year-roll': year_roll,
+    'natural-not-found': natural_not_found,
+    'dude-broadcast': dude_broadcast,
+    'new-year-broadcast': new_year_broadcast,
+    'birthday-congratulation': birthday_congratulation,
+    'send-message': send_message,
+    'countdown': countdown,
+}
@@ -3,7 +3,7 @@
 from fsb.config import config
 from fsb.controllers import (
     Controller, CommandController, MentionController, MenuController, ChatActionController, FoolCommandController,
-    FoolMentionController
+    FoolMentionController, MessageDispatcher
 )
 from fsb.factories import ControllerFactory
 from fsb.telegram.client import TelegramApiClient
@@ -45,6 +45,7 @@ class ControllerLoader(Loader):
 
     def __init__(self, client: TelegramApiClient):
         self._client = client
+        self._dispatcher = MessageDispatcher(client)
         self._init_fool()
         self.create_objects()
 
@@ -53,7 +54,14 @@ class ControllerLoader(Loader):
             self._loaded_classes = self._fool_loaded_classes
 
     def _create_object(self, cls) -> Controller:
-        return ControllerFactory(cls, self._client).create_object()
+        return ControllerFactory(cls, self._client, self._dispatcher).create_object()
+
+    def run_objects(self):
+        super().run_objects()
+        self._dispatcher.listen()
 
     def _run_object(self, obj: Controller):
         obj.listen()
+
+    def get_mention_triggers(self) -> set:
+        return self._dispatcher.get_mention_triggers()
@@ -1,8 +1,14 @@
 # !/usr/bin/env python
 
+import atexit
+import copy
+import json
 import logging
 import logging.config
 import os
+import random
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
 
 from fsb.config import config
 
@@ -17,11 +23,93 @@ class LevelFilter(logging.Filter):
         return record.levelno < self.level
 
 
+class SampleFilter(logging.Filter):
+    # Пропускает только долю записей, помеченных extra={'sample': True}
+    def __init__(self, rate: float):
+        self.rate = float(rate)
+
+    def filter(self, record):
+        return not getattr(record, 'sample', False) or self.rate >= 1 or random.random() < self.rate
+
+
+class LazyMessage:
+    # Данные собираются и сериализуются только когда запись реально пишется хендлером
+    def __init__(self, title: str, builder: callable):
+        self.title = title
+        self._builder = builder
+        self._data = None
+        self._payload = None
+        self._text = None
+
+    def resolve(self):
+        if self._builder is not None:
+            self._data = self._builder()
+            self._builder = None
+
+        return self._data
+
+    def get_payload(self) -> str:
+        if self._payload is None:
+            self._payload = json.dumps(self.resolve(), ensure_ascii=False, default=str)
+
+        return self._payload
+
+    def __str__(self):
+        if self._text is None:
+            text = json.dumps(self.resolve(), sort_keys=False, indent=2, ensure_ascii=False, default=str)
+            self._text = f"{self.title}:\n{text}" if self.title else text
+
+        return self._text
+
+
+class JsonFormatter(logging.Formatter):
+    # Однострочный json для logstash, готовые данные LazyMessage вставляются без повторной сериализации
+    def format(self, record):
+        line = '{"time": %s, "level": %s, "logger": %s, "message": %s' % (
+            json.dumps(self.formatTime(record)),
+            json.dumps(record.levelname),
+            json.dumps(record.name),
+            json.dumps(record.msg.title if isinstance(record.msg, LazyMessage) else record.getMessage(),
+                       ensure_ascii=False),
+        )
+
+        if isinstance(record.msg, LazyMessage):
+            line += ', "data": ' + record.msg.get_payload()
+
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+
+        if record.exc_text:
+            line += ', "exception": ' + json.dumps(record.exc_text, ensure_ascii=False)
+
+        return line + '}'
+
+
+class LazyQueueHandler(QueueHandler):
+    def prepare(self, record):
+        # Данные собираются в потоке логирования, пока объекты события актуальны,
+        # а сериализация, оформление и запись уходят в поток слушателя
+        if isinstance(record.msg, LazyMessage) and not record.exc_info:
+            record = copy.copy(record)
+            record.msg.resolve()
+            return record
+
+        return super().prepare(record)
+
+
+_queue_listener = None
+
+
 def init_logger(console: bool):
+    global _queue_listener
+
     logging_config = config.logging.to_dict()
     logger_config_key = 'console' if console else 'app'
+    logger_config = logging_config['loggers'][logger_config_key]
+    use_queue = bool(logger_config.pop('queue', False))
+    sample_rate = float(logger_config.pop('events_sample_rate', 1))
 
-    for opt_name, opt_value in logging_config['loggers'][logger_config_key].items():
+    for opt_name, opt_value in logger_config.items():
         logging_config['root'][opt_name] = opt_value
 
     logging_config.pop('loggers')
@@ -40,3 +128,20 @@ def init_logger(console: bool):
         logger.setLevel(logging.DEBUG)
     else:
         logger.setLevel(logging.INFO)
+
+    if sample_rate < 1:
+        logger.addFilter(SampleFilter(sample_rate))
+
+    if use_queue:
+        # Хендлеры root переносятся в отдельный поток, чтобы запись в файлы не блокировала event loop
+        root = logging.getLogger()
+        handlers = list(root.handlers)
+        log_queue = SimpleQueue()
+
+        for handler in handlers:
+            root.removeHandler(handler)
+
+        root.addHandler(LazyQueueHandler(log_queue))
+        _queue_listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+        _queue_listener.start()
+        atexit.register(_queue_listener.stop)
@@ -2,108 +2,265 @@
 
 import json
 import logging
+import os
 import random
-from asyncio import sleep
-from datetime import datetime
+from asyncio import sleep, gather, get_running_loop, start_server, wait_for, Event, Lock, Semaphore
+from collections import deque
+from datetime import datetime, timedelta
+from time import time, monotonic
+from typing import Union
 
 import aiocron
 import quantumrand as qr
 from dateutil.relativedelta import relativedelta as delta
-from peewee import fn
+from peewee import fn, Value
 from pytz import timezone
+from telethon.errors import FloodWaitError
 from telethon.tl.functions.messages import GetStickerSetRequest
 from telethon.tl.types import InputPeerUser, InputPeerChat, InputPeerChannel
 from telethon.tl.types import InputStickerSetShortName
 
 from fsb.config import config
 from fsb.db import database
-from fsb.db.models import Chat, User, Member, Rating, RatingMember, RatingLeader, CacheQuantumRand, Module, CronJob
+from fsb.db.models import Chat, User, Member, Rating, RatingMember, RatingLeader, CacheQuantumRand, Module, CronJob, \
+    QueryEvent, ChatContent
 from fsb.errors import BaseFsbException, NoMembersRatingError, NoApproachableMembers
 from fsb.events.common import ChatActionEventDTO, EventDTO
-from fsb.helpers import Helper, ReturnedThread, InfoBuilder
+from fsb.helpers import ChatLock, Helper, InfoBuilder, Metrics, TokenBucket
 from fsb.telegram.client import TelegramApiClient
 
 
 class QuantumRandService:
+    DATA_TYPE = 'uint16'
+    VALUE_BITS = 16
+    BATCH_SIZE = 1024
+    LOW_WATER_MARK = 256
+    REFILL_RETRY_INTERVAL = 60
+    COLD_REFILL_TIMEOUT = 5
+
+    stats = {
+        'quantum_values': 0,
+        'fallback_values': 0,
+        'refills': 0,
+        'refill_errors': 0,
+    }
+    _pool = deque()
+    _bit_buffer = 0
+    _bit_buffer_size = 0
+    _fallback = None
+    _refill_lock = None
+    _refill_needed = None
+    _running = False
+
+    @staticmethod
+    async def randint(min=0, max=10) -> int:
+        rand_range = max - min + 1
+
+        if rand_range <= 1:
+            return min
+
+        if not QuantumRandService._pool and not QuantumRandService._running:
+            # Без фонового пополнения (консольные команды) пул один раз заполняется синхронно
+            try:
+                await wait_for(QuantumRandService.refill(), QuantumRandService.COLD_REFILL_TIMEOUT)
+            except Exception as ex:
+                logging.getLogger('main').warning(f'QuantumRandService cold refill failed: {ex!r}')
+
+        # Отбрасывание значений вне диапазона убирает смещение, которое дает взятие по модулю
+        bits = (rand_range - 1).bit_length()
+
+        while True:
+            value = QuantumRandService._take_bits(bits)
+
+            if value < rand_range:
+                return min + value
+
+    @staticmethod
+    def _take_bits(bits: int) -> int:
+        while QuantumRandService._bit_buffer_size < bits:
+            QuantumRandService._bit_buffer = (QuantumRandService._bit_buffer << QuantumRandService.VALUE_BITS) \
+                | QuantumRandService._take_value()
+            QuantumRandService._bit_buffer_size += QuantumRandService.VALUE_BITS
+
+        QuantumRandService._bit_buffer_size -= bits
+        value = QuantumRandService._bit_buffer >> QuantumRandService._bit_buffer_size
+        QuantumRandService._bit_buffer &= (1 << QuantumRandService._bit_buffer_size) - 1
+
+        return value
+
+    @staticmethod
+    def _take_value() -> int:
+        pool = QuantumRandService._pool
+
+        if len(pool) <= QuantumRandService.get_low_water_mark() and QuantumRandService._refill_needed:
+            QuantumRandService._refill_needed.set()
+
+        if pool:
+            QuantumRandService.stats['quantum_values'] += 1
+            return pool.popleft()
+
+        if QuantumRandService._fallback is None:
+            QuantumRandService._fallback = random.Random(config.quantum_rand.fallback_seed)
+
+        QuantumRandService.stats['fallback_values'] += 1
+        return QuantumRandService._fallback.getrandbits(QuantumRandService.VALUE_BITS)
+
+    @staticmethod
+    def get_low_water_mark() -> int:
+        return int(config.quantum_rand.low_water_mark or QuantumRandService.LOW_WATER_MARK)
+
     @staticmethod
-    def randint(min=0, max=10):
-        return qr.randint(min, max, QuantumRandService.generator())
+    def get_batch_size() -> int:
+        return min(int(config.quantum_rand.batch_size or QuantumRandService.BATCH_SIZE), qr.MAX_LEN)
 
     @staticmethod
-    def generator(data_type='uint16', cache_size=1024):
+    async def run():
+        QuantumRandService._running = True
+        QuantumRandService._refill_needed = Event()
         logger = logging.getLogger('main')
 
         while True:
-            if not CacheQuantumRand.select().where(CacheQuantumRand.type == data_type).first():
-                data = qr.get_data(data_type, cache_size, cache_size)
-                CacheQuantumRand.insert_many(
-                    [(data_item, data_type) for data_item in data],
+            try:
+                while len(QuantumRandService._pool) <= QuantumRandService.get_low_water_mark():
+                    await QuantumRandService.refill()
+            except Exception as ex:
+                QuantumRandService.stats['refill_errors'] += 1
+                logger.exception(ex)
+                await sleep(QuantumRandService.REFILL_RETRY_INTERVAL)
+                continue
+
+            QuantumRandService._refill_needed.clear()
+            await QuantumRandService._refill_needed.wait()
+
+    @staticmethod
+    async def refill():
+        if QuantumRandService._refill_lock is None:
+            QuantumRandService._refill_lock = Lock()
+
+        async with QuantumRandService._refill_lock:
+            values = await QuantumRandService._reserve_batch()
+
+            if not values:
+                data = await get_running_loop().run_in_executor(
+                    None, qr.get_data, QuantumRandService.DATA_TYPE, QuantumRandService.get_batch_size(), 1
+                )
+                await CacheQuantumRand.insert_many(
+                    [(data_item, QuantumRandService.DATA_TYPE) for data_item in data],
                     [CacheQuantumRand.value, CacheQuantumRand.type]
-                ).execute()
+                ).aio_execute()
+                values = await QuantumRandService._reserve_batch()
+
+            QuantumRandService._pool.extend(values)
+            QuantumRandService.stats['refills'] += 1
+            logging.getLogger('main').info(f'QuantumRandService pool refilled: {len(QuantumRandService._pool)}')
+
+    @staticmethod
+    async def _reserve_batch() -> list:
+        # Строки блокируются до удаления, чтобы бот и консоль не взяли одни и те же значения
+        async with database.aio_atomic():
+            cache = await (CacheQuantumRand
+                           .select()
+                           .where(CacheQuantumRand.type == QuantumRandService.DATA_TYPE)
+                           .order_by(CacheQuantumRand.id)
+                           .limit(QuantumRandService.get_batch_size())
+                           .for_update()
+                           .aio_execute())
+
+            if cache:
+                await CacheQuantumRand.delete().where(CacheQuantumRand.id.in_([row.id for row in cache])).aio_execute()
 
-            for cache in CacheQuantumRand.select().where(CacheQuantumRand.type == data_type):
-                value = cache.value
-                cache.delete_instance()
-                logger.info(f'QuantumRandService generator value: {value}')
-                yield value
+        return [row.value for row in cache]
 
 
 class ChatService:
+    MEMBERS_SYNC_INTERVAL = 3600
+    MEMBERS_SYNC_CHUNK_SIZE = 1000
+    INIT_CHATS_CONCURRENCY = 8
+    INIT_CHAT_ATTEMPTS = 3
+
+    members_sync_stats = {
+        'participants_fetches': 0,
+        'participants_fetches_avoided': 0,
+        'members_upserts': 0,
+        'members_upserts_avoided': 0,
+        'errors': 0,
+    }
+    init_chats_stats = {
+        'initialized': 0,
+        'failed': 0,
+        'flood_waits': 0,
+    }
+    _members_synced = {}
+    _members_sync_tasks = {}
+    _flood_wait_until = 0
+
     def __init__(self, client: TelegramApiClient):
         self.client = client
+        self.logger = logging.getLogger('main')
 
-    async def create_chat(self, event: EventDTO = None, entity=None, update: bool = False):
-        with database.atomic():
-            if event:
-                entity = event.chat
-                input_chat = event.telegram_event.input_chat.to_json()
-            elif entity:
-                input_chat = None
-            else:
-                return None
-
-            match Chat.get_chat_type(entity):
-                case Chat.USER_TYPE:
-                    name = entity.username
-                    if not input_chat:
-                        input_chat = InputPeerUser(entity.id, entity.access_hash).to_json()
-                case Chat.CHAT_TYPE:
-                    name = entity.title
-                    if not input_chat:
-                        input_chat = InputPeerChat(entity.id).to_json()
-                case Chat.CHANNEL_TYPE:
-                    name = entity.title
-                    if not input_chat:
-                        input_chat = InputPeerChannel(entity.id, entity.access_hash).to_json()
-                case _:
-                    name = None
-
-            type = Chat.get_chat_type(entity)
-            chat = Chat.get_by_telegram_id(entity.id)
+    async def create_chat(self, event: EventDTO = None, entity=None, update: bool = False, sync_members: bool = True):
+        if event:
+            entity = event.chat
+            input_chat = event.telegram_event.input_chat.to_json()
+        elif entity:
+            input_chat = None
+        else:
+            return None
+
+        match Chat.get_chat_type(entity):
+            case Chat.USER_TYPE:
+                name = entity.username
+                if not input_chat:
+                    input_chat = InputPeerUser(entity.id, entity.access_hash).to_json()
+            case Chat.CHAT_TYPE:
+                name = entity.title
+                if not input_chat:
+                    input_chat = InputPeerChat(entity.id).to_json()
+            case Chat.CHANNEL_TYPE:
+                name = entity.title
+                if not input_chat:
+                    input_chat = InputPeerChannel(entity.id, entity.access_hash).to_json()
+            case _:
+                name = None
+
+        type = Chat.get_chat_type(entity)
+
+        async with database.aio_atomic():
+            chat = await Chat.aio_get_by_telegram_id(entity.id)
             new_chat = False
 
             if not chat:
                 new_chat = True
-                chat = Chat.create(telegram_id=entity.id, name=name, type=type, input_peer=input_chat)
+                chat = await Chat.aio_create(telegram_id=entity.id, name=name, type=type, input_peer=input_chat)
 
             if update:
                 with chat.dirty():
                     chat.name = name if name else chat.name
                     chat.type = type if type else chat.type
                     chat.input_peer = input_chat if input_chat else chat.input_chat
-                    chat.save()
+                await chat.aio_save()
 
             left_reason = self._is_left(event, entity, True)
+            restored_chat = False
 
             if left_reason and not chat.is_deleted():
-                self.disable_chat(chat, left_reason)
+                await self.disable_chat(chat, left_reason)
             elif new_chat or chat.is_deleted():
-                self.enable_chat(chat)
+                restored_chat = True
+                await self.enable_chat(chat)
 
-            if not chat.is_deleted():
+            if not chat.is_deleted() and isinstance(event, ChatActionEventDTO):
+                await self.actualize_members_by_action(event, chat)
+
+        if not chat.is_deleted():
+            if sync_members or restored_chat:
                 await self.actualize_members(entity=entity, chat=chat, update=update)
+            elif not self.is_members_synced(chat):
+                self._schedule_members_sync(entity, chat, update)
+            else:
+                self._count_avoided_members_sync(chat)
 
-            return chat
+        return chat
 
     async def actualize_members(self, event: EventDTO = None, entity=None, chat=None, update: bool = False):
         if event:
@@ -112,62 +269,206 @@ class ChatService:
             return None
 
         if not chat:
-            chat = Chat.get_by_telegram_id(entity.id)
+            chat = await Chat.aio_get_by_telegram_id(entity.id)
+
+        tg_members = await self.client.get_dialog_members(entity, use_cache=False)
+        tg_members_ids = [tg_member.id for tg_member in tg_members]
+        self.members_sync_stats['participants_fetches'] += 1
+        chunk_size = self.get_members_sync_chunk_size()
+
+        # Запросы идут пачками, чтобы IN (...) не рос вместе с размером чата.
+        # Ушедшие участники вычисляются по списку из бд, а не через NOT IN всего чата
+        async with database.aio_atomic():
+            for chunk in Helper.split_chunks(tg_members, chunk_size):
+                await self.upsert_members(chat, chunk, update)
+
+            db_members_ids = await (User
+                                    .select(User.telegram_id)
+                                    .join(Member)
+                                    .where((Member.chat == chat) & Member.deleted_at.is_null())
+                                    .aio_execute())
+            left_ids = list({user.telegram_id for user in db_members_ids} - set(tg_members_ids))
+
+            for chunk in Helper.split_chunks(left_ids, chunk_size):
+                await self.delete_members(
+                    chat,
+                    Member.user.in_(User.select(User.id).where(User.telegram_id.in_(chunk))),
+                    'Actualize members'
+                )
 
-        tg_members_ids = []
+        self.members_sync_stats['members_upserts'] += len(tg_members_ids)
+        self._members_synced[chat.id] = {'time': int(time()), 'count': len(tg_members_ids)}
 
-        for tg_member in await self.client.get_dialog_members(entity, use_cache=False):
-            user = self.create_user(entity=tg_member, update=update)
-            chat_member = Member.get_or_create(chat=chat, user=user)[0]
-            chat_member.mark_as_undeleted()
-            chat_member.save()
-            tg_members_ids.append(tg_member.id)
+    async def actualize_members_by_action(self, event: ChatActionEventDTO, chat: Chat):
+        if event.is_self:
+            return
 
-        for chat_member in Member.find_by_chat(chat):
-            if chat_member.user.telegram_id not in tg_members_ids:
-                chat_member.mark_as_deleted('Actualize members')
-                chat_member.save()
+        if event.user_joined or event.user_added or event.user_left or event.user_kicked:
+            self.client.invalidate_dialog_members(event.chat.id)
 
-    def create_user(self, event: EventDTO = None, entity=None, update: bool = False):
-        if event:
-            entity = event.chat
-            input_peer = json.dumps(event.telegram_event.input_chat.to_dict())
-        elif entity:
-            input_peer = InputPeerUser(entity.id, entity.access_hash).to_json()
-        else:
-            return None
+        if event.user_joined or event.user_added:
+            tg_members = [
+                tg_member for tg_member in event.telegram_event.users
+                if not tg_member.bot or config.FSB_DEV_MODE
+            ]
+            await self.upsert_members(chat, tg_members, True)
+            self.members_sync_stats['members_upserts'] += len(tg_members)
+        elif event.user_left or event.user_kicked:
+            reason = 'Kicked' if event.user_kicked else 'Left'
+            await self.delete_members(
+                chat,
+                Member.user.in_(User.select(User.id).where(User.telegram_id.in_(event.user_ids))),
+                reason
+            )
 
-        name = Helper.make_member_name(entity, with_username=False)
-        user = User.get_or_create(
-            telegram_id=entity.id,
-            defaults={
-                'name': name,
-                'nickname': entity.username,
-                'phone': entity.phone,
-                'input_peer': input_peer
-            }
-        )[0]
+    async def upsert_members(self, chat: Chat, tg_members: list, update: bool = False):
+        if not tg_members:
+            return
+
+        await self.upsert_users(tg_members, update)
+
+        users = User.select(Value(chat.id), User.id).where(User.telegram_id.in_([tg_member.id for tg_member in tg_members]))
+        await (Member
+               .insert_from(users, [Member.chat, Member.user])
+               .on_conflict(update={Member.deleted_at: None, Member.deletion_reason: None})
+               .aio_execute())
+
+    @staticmethod
+    async def upsert_users(tg_members: list, update: bool = False):
+        rows = [{
+            User.telegram_id: tg_member.id,
+            User.name: Helper.make_member_name(tg_member, with_username=False),
+            User.nickname: tg_member.username,
+            User.phone: tg_member.phone,
+            User.input_peer: InputPeerUser(tg_member.id, tg_member.access_hash).to_json(),
+        } for tg_member in tg_members]
+        query = User.insert_many(rows)
 
         if update:
-            with user.dirty():
-                user.name = name
-                user.nickname = entity.username if entity.username else user.nickname
-                user.phone = entity.phone if entity.phone else user.phone
-                user.input_peer = input_peer if input_peer else user.input_peer
-                user.save()
+            query = query.on_conflict(
+                preserve=[User.name, User.input_peer],
+                update={
+                    User.nickname: fn.COALESCE(fn.VALUES(User.nickname), User.nickname),
+                    User.phone: fn.COALESCE(fn.VALUES(User.phone), User.phone),
+                }
+            )
+        else:
+            query = query.on_conflict_ignore()
+
+        await query.aio_execute()
 
-        return user
+    @staticmethod
+    async def delete_members(chat: Chat, condition, reason: str):
+        await (Member
+               .update(deleted_at=datetime.now(), deletion_reason=reason)
+               .where((Member.chat == chat) & Member.deleted_at.is_null() & condition)
+               .aio_execute())
 
-    def enable_chat(self, chat: Chat):
-        return chat.mark_as_undeleted()
+    def is_members_synced(self, chat: Chat) -> bool:
+        synced = self._members_synced.get(chat.id)
+        return bool(synced) and synced['time'] + self.get_members_sync_interval() > int(time())
 
-    def disable_chat(self, chat: Chat, reason = None):
-        return chat.mark_as_deleted(reason)
+    @staticmethod
+    def get_members_sync_interval() -> int:
+        return int(config.members_sync.interval or ChatService.MEMBERS_SYNC_INTERVAL)
+
+    @staticmethod
+    def get_members_sync_chunk_size() -> int:
+        return int(config.members_sync.chunk_size or ChatService.MEMBERS_SYNC_CHUNK_SIZE)
+
+    def _schedule_members_sync(self, entity, chat: Chat, update: bool = False):
+        task = self._members_sync_tasks.get(chat.id)
+
+        if task and not task.done():
+            self._count_avoided_members_sync(chat)
+            return
+
+        task = self.client.loop.create_task(self.actualize_members(entity=entity, chat=chat, update=update))
+        task.add_done_callback(lambda done: self._finish_members_sync(chat, done))
+        self._members_sync_tasks[chat.id] = task
+
+    def _finish_members_sync(self, chat: Chat, task):
+        if task.cancelled() or not task.exception():
+            return
+
+        self.members_sync_stats['errors'] += 1
+        self.logger.error(f'Members sync of chat {chat.telegram_id} failed', exc_info=task.exception())
+
+    def _count_avoided_members_sync(self, chat: Chat):
+        synced = self._members_synced.get(chat.id)
+        self.members_sync_stats['participants_fetches_avoided'] += 1
+        self.members_sync_stats['members_upserts_avoided'] += synced['count'] if synced else 0
+
+    async def run_members_reconciliation(self):
+        interval = self.get_members_sync_interval()
+
+        while True:
+            await sleep(interval)
+
+            try:
+                await self.reconcile_members()
+            except Exception as ex:
+                self.logger.exception(ex)
+
+    async def reconcile_members(self):
+        for chat in await Chat.only_undeleted().aio_execute():
+            if self.is_members_synced(chat):
+                continue
 
-    async def init_chats(self):
-        for chat in Chat.select():
             entity = await self.client.get_entity(chat.telegram_id)
-            await self.create_chat(entity=entity, update=True)
+
+            if entity:
+                await self.actualize_members(entity=entity, chat=chat, update=True)
+
+        self.logger.info(InfoBuilder.build_log('Members sync stats', self.members_sync_stats))
+        self.logger.info(InfoBuilder.build_log('Entity cache stats', self.client.get_entity_cache_stats()))
+
+    async def enable_chat(self, chat: Chat):
+        return await chat.aio_mark_as_undeleted()
+
+    async def disable_chat(self, chat: Chat, reason = None):
+        return await chat.aio_mark_as_deleted(reason)
+
+    async def init_chats(self):
+        started = time()
+        semaphore = Semaphore(self.get_init_chats_concurrency())
+        chats = await Chat.select().aio_execute()
+
+        await gather(*[self._init_chat(chat, semaphore) for chat in chats])
+        self.logger.info(f"Initialized {self.init_chats_stats['initialized']} of {len(chats)} chats "
+                         f"in {time() - started:.1f}s, failed {self.init_chats_stats['failed']}")
+
+    @staticmethod
+    def get_init_chats_concurrency() -> int:
+        return max(1, int(config.chats_init.concurrency or ChatService.INIT_CHATS_CONCURRENCY))
+
+    async def _init_chat(self, chat: Chat, semaphore: Semaphore):
+        async with semaphore:
+            for _ in range(self.INIT_CHAT_ATTEMPTS):
+                # FloodWait касается всего клиента, поэтому ждут все воркеры, а не только получивший ошибку
+                if self._flood_wait_until > time():
+                    await sleep(self._flood_wait_until - time())
+
+                try:
+                    entity = await self.client.get_entity(chat.telegram_id)
+
+                    if entity:
+                        await self.create_chat(entity=entity, update=True)
+                        self.init_chats_stats['initialized'] += 1
+                    return
+                except FloodWaitError as ex:
+                    ChatService._flood_wait_until = max(self._flood_wait_until, time() + ex.seconds)
+                    self.init_chats_stats['flood_waits'] += 1
+                    Metrics.inc('telegram_flood_wait_seconds', ex.seconds, method='init_chat')
+                    self.logger.warning(f'FloodWait {ex.seconds}s on chat {chat.telegram_id} init')
+                except Exception as ex:
+                    self.init_chats_stats['failed'] += 1
+                    self.logger.error(f'Chat {chat.telegram_id} init failed', exc_info=ex)
+                    return
+
+            # Все попытки ушли на FloodWait, чат останется неинициализированным до сверки участников
+            self.init_chats_stats['failed'] += 1
+            self.logger.error(f'Chat {chat.telegram_id} init failed after {self.INIT_CHAT_ATTEMPTS} FloodWaits')
 
     def _is_forbidden(self, entity):
         return entity.__class__.__name__ in ['ChatForbidden', 'ChannelForbidden']
@@ -189,6 +490,112 @@ class ChatService:
         return reason if return_reason else bool(reason)
 
 
+class ContentService:
+    RELOAD_CHECK_INTERVAL = 5
+    CHAT_CACHE_TTL = 300
+
+    # Путь файла => распарсенное содержимое и mtime, по которому файл перечитывается
+    _files = {}
+    # chat_id => (время загрузки, {(вид, ключ): [тексты]})
+    _chats = {}
+
+    @staticmethod
+    def get_folder() -> str:
+        return os.path.join(config.ROOT_FOLDER, 'content')
+
+    @staticmethod
+    def load_all():
+        folder = ContentService.get_folder()
+
+        for name in sorted(os.listdir(folder)):
+            if name.endswith('.txt'):
+                ContentService._load(os.path.join(folder, name))
+
+        logging.getLogger('main').info(f"Content loaded: {len(ContentService._files)} files")
+
+    @staticmethod
+    def get_lines(path: str) -> list:
+        return ContentService._get_file(path)['lines']
+
+    @staticmethod
+    def get_blocks(path: str) -> list:
+        return ContentService._get_file(path)['blocks']
+
+    @staticmethod
+    def _get_path(path: str) -> str:
+        return os.path.normpath(path if os.path.isabs(path) else os.path.join(config.ROOT_FOLDER, path))
+
+    @staticmethod
+    def _get_file(path: str) -> dict:
+        path = ContentService._get_path(path)
+        content = ContentService._files.get(path)
+
+        if content is None:
+            return ContentService._load(path)
+
+        if monotonic() - content['checked_at'] > ContentService.RELOAD_CHECK_INTERVAL:
+            content['checked_at'] = monotonic()
+
+            if os.stat(path).st_mtime != content['mtime']:
+                content = ContentService._load(path)
+
+        return content
+
+    @staticmethod
+    def _load(path: str) -> dict:
+        path = ContentService._get_path(path)
+        mtime = os.stat(path).st_mtime
+
+        with open(path, 'r', encoding='utf-8') as file:
+            lines = [line.strip('\n ') for line in file.readlines()]
+
+        # Блоки разделяются пустой строкой, например сценарии ролла
+        blocks = []
+        block = []
+
+        for line in lines:
+            if line:
+                block.append(line)
+            elif block:
+                blocks.append(block)
+                block = []
+
+        if block:
+            blocks.append(block)
+
+        content = {
+            'mtime': mtime,
+            'checked_at': monotonic(),
+            'lines': [line for line in lines if line],
+            'blocks': blocks,
+        }
+        ContentService._files[path] = content
+
+        return content
+
+    @staticmethod
+    async def aio_get_chat_texts(chat_id: int, kind: str, key: str = '') -> list:
+        cached = ContentService._chats.get(chat_id)
+
+        if not cached or monotonic() - cached[0] > ContentService.CHAT_CACHE_TTL:
+            texts = {}
+
+            for chat_content in await ChatContent.select().where(ChatContent.chat == chat_id).aio_execute():
+                texts.setdefault((chat_content.kind, chat_content.key), []).append(chat_content.text)
+
+            cached = (monotonic(), texts)
+            ContentService._chats[chat_id] = cached
+
+        return cached[1].get((kind, key), [])
+
+    @staticmethod
+    def invalidate_chat(chat_id: int = None):
+        if chat_id is None:
+            ContentService._chats.clear()
+        else:
+            ContentService._chats.pop(chat_id, None)
+
+
 class RatingService:
     PIDOR_KEYWORD = 'pidor'
     PIDOR_NAME = 'пидор'
@@ -224,17 +631,18 @@ class RatingService:
     async def roll(self, rating: Rating, chat, is_month: bool = False):
         self.logger.info(InfoBuilder.build_log(f"{'Month' if is_month else 'Day'} rolling rating", {
             'rating': rating.id,
-            'stats': self.get_month_stat(rating)
+            'stats': await self.get_month_stat(rating)
         }))
 
         try:
-            if not rating.members.exists():
+            if not await rating.members.aio_exists():
                 raise NoMembersRatingError()
 
             # Если участник уже победил в каком-либо рейтинге в чате, то в других он участвовать не может
-            actual_members = await self.client.get_dialog_members(chat)
-            rating_members = rating.get_non_winners(is_month)
-            members_collection = Helper.collect_members(actual_members, rating_members, Helper.COLLECT_RETURN_ONLY_DB)
+            rating_members = await rating.aio_get_non_winners(is_month)
+            members_collection = Helper.filter_members_by_ids(
+                await self.client.get_dialog_members_ids(chat), rating_members
+            )
 
             if not members_collection:
                 raise NoApproachableMembers(rating.name)
@@ -251,24 +659,28 @@ class RatingService:
             else:
                 rating.last_run = datetime.now()
 
-            rating.save()
+            await rating.aio_save()
             return
 
     async def _month_roll(self, members_collection: list, rating: Rating, chat):
-        if self.get_month_winner(rating):
+        if await self.get_month_winner(rating):
             await self.send_last_month_winner_message(rating, chat)
         else:
             current_month = datetime.today().replace(hour=0, minute=0, second=0, microsecond=0, day=1) - delta(months=1)
 
             # Участники, которые претендуют стать лидерами
             winners_query = (RatingMember
-                             .select()
+                             .select_with_users()
                              .where(RatingMember.id.in_(members_collection)))
-            win_count = winners_query.select(fn.MAX(RatingMember.current_month_count)).scalar()
-            winners = list(winners_query.where(RatingMember.current_month_count == win_count).execute())
+            win_count = await winners_query.select(fn.MAX(RatingMember.current_month_count)).aio_scalar()
+            winners = await winners_query.where(RatingMember.current_month_count == win_count).aio_execute()
             winners_len = len(winners)
 
-            already_winner_members = list(rating.members.where(RatingMember.id.not_in(members_collection)).execute())
+            already_winner_members = await (RatingMember
+                                            .select_with_users()
+                                            .where((RatingMember.rating == rating)
+                                                   & RatingMember.id.not_in(members_collection))
+                                            .aio_execute())
 
             rating_name_gent_sing = Helper.inflect_word(rating.name, {'gent', 'sing'}).upper()
             rating_name_gent_plur = Helper.inflect_word(rating.name, {'gent', 'plur'}).upper()
@@ -304,35 +716,35 @@ class RatingService:
 
             win_db_member.month_count += 1
             win_db_member.current_year_count += 1
-            win_db_member.save()
+            await win_db_member.aio_save()
             rating.last_month_winner = win_db_member
             rating.last_month_run = datetime.now()
-            rating.save()
-            RatingLeader.create(
+            await rating.aio_save()
+            await RatingLeader.aio_create(
                 rating_member=win_db_member,
                 date=current_month,
-                chat=win_db_member.rating.chat
+                chat=rating.chat_id
             )
-            RatingMember.update(current_month_count=0).where(RatingMember.rating == rating).execute()
+            await RatingMember.update(current_month_count=0).where(RatingMember.rating == rating).aio_execute()
 
             await self.send_last_month_winner_message(rating, chat, True)
 
     async def _day_roll(self, members_collection: list, rating: Rating, chat):
-        if self.get_day_winner(rating):
+        if await self.get_day_winner(rating):
             await self.send_last_day_winner_message(rating, chat)
         else:
             db_member = await self._determine_winner(members_collection, rating, chat)
             db_member.total_count += 1
             db_member.current_month_count += 1
-            db_member.save()
+            await db_member.aio_save()
             rating.last_winner = db_member
             rating.last_run = datetime.now()
-            rating.save()
+            await rating.aio_save()
 
             await self.send_last_day_winner_message(rating, chat, True)
 
-    def create_default_ratings(self, chat: Chat):
-        Rating.get_or_create(
+    async def create_default_ratings(self, chat: Chat):
+        await Rating.aio_get_or_create(
             command=self.PIDOR_KEYWORD,
             chat=chat,
             defaults={
@@ -340,7 +752,7 @@ class RatingService:
             }
         )
 
-        Rating.get_or_create(
+        await Rating.aio_get_or_create(
             command=self.CHAD_KEYWORD,
             chat=chat,
             defaults={
@@ -357,12 +769,9 @@ class RatingService:
         elif participants_len == 0:
             return None
         else:
-            qr_thread = ReturnedThread(target=QuantumRandService.randint, args=(0, participants_len - 1))
-            qr_thread.start()
+            winner_index = await QuantumRandService.randint(0, participants_len - 1)
             await self._send_rolling_message(rating, chat)
-            qr_thread.join()
-            assert qr_thread.result is not None
-            return participants[qr_thread.result]
+            return participants[winner_index]
 
     async def _send_rolling_message(self, rating: Rating, chat):
         match rating.command:
@@ -373,23 +782,18 @@ class RatingService:
             case _:
                 run_messages_file = config.content.custom_rating_messages_file
 
-        try:
-            with open(run_messages_file, 'r', encoding='utf-8') as file:
-                run_messages = []
-                run_message = []
-
-                for line in file.readlines():
-                    if line == '\n':
-                        if run_message:
-                            run_messages.append(run_message)
-                            run_message = []
-                    else:
-                        run_message.append(line.strip('\n '))
+        run_messages = [
+            text.strip('\n ').split('\n')
+            for text in await ContentService.aio_get_chat_texts(rating.chat_id, ChatContent.KIND_ROLLING, rating.command)
+        ]
 
-                if run_message:
-                    run_messages.append(run_message)
-        except Exception as ex:
-            self.logger.exception(ex)
+        if not run_messages:
+            try:
+                run_messages = ContentService.get_blocks(run_messages_file)
+            except Exception as ex:
+                self.logger.exception(ex)
+
+        if not run_messages:
             run_messages = [self.RUN_MESSAGE]
 
         message = await self.client.send_message(entity=chat, message='Итаааааак...')
@@ -398,11 +802,11 @@ class RatingService:
 
         for line in random.choice(run_messages):
             text += line + '\n'
-            await message.edit(text)
+            await self.client.edit_message(chat, message, text)
             await sleep(self.MESSAGE_WAIT)
 
     async def send_last_day_winner_message(self, rating: Rating, chat, announcing: bool = False):
-        winner = self.get_day_winner(rating)
+        winner = await self.get_day_winner(rating)
 
         if winner:
             tg_member = await winner.get_telegram_member(self.client)
@@ -414,7 +818,7 @@ class RatingService:
             await self.client.send_message(chat, f"Сегодняшний {rating.name.upper()} еще не объявился.")
 
     async def send_last_month_winner_message(self, rating: Rating, chat, announcing: bool = False):
-        winner = self.get_month_winner(rating)
+        winner = await self.get_month_winner(rating)
 
         if winner:
             tg_member = await winner.get_telegram_member(self.client)
@@ -430,62 +834,66 @@ class RatingService:
             ))
 
     @staticmethod
-    def get_day_winner(rating: Rating):
+    async def get_day_winner(rating: Rating):
         winner = None
 
-        if rating.last_winner \
+        if rating.last_winner_id \
                 and rating.last_run \
                 and rating.last_run >= datetime.today().replace(hour=0, minute=0, second=0, microsecond=0):
-            winner = rating.last_winner
+            winner = await RatingService._get_winner(rating.last_winner_id)
 
         return winner
 
     @staticmethod
-    def get_month_winner(rating: Rating):
+    async def get_month_winner(rating: Rating):
         winner = None
 
-        if rating.last_month_winner \
+        if rating.last_month_winner_id \
                 and rating.last_month_run \
                 and rating.last_month_run >= datetime.today().replace(hour=0, minute=0, second=0, microsecond=0, day=1):
-            winner = rating.last_month_winner
+            winner = await RatingService._get_winner(rating.last_month_winner_id)
 
         return winner
 
     @staticmethod
-    def get_month_stat(rating: Rating) -> dict:
+    async def get_month_stat(rating: Rating) -> dict:
         result = {}
 
-        for rating_member in rating.members:
+        for rating_member in await rating.members.aio_execute():
             result[rating_member.id] = rating_member.current_month_count
 
         return result
 
     @staticmethod
-    def get_year_winner(rating: Rating):
+    async def get_year_winner(rating: Rating):
         winner = None
 
-        if rating.last_year_winner \
+        if rating.last_year_winner_id \
                 and rating.last_year_run \
                 and rating.last_year_run >= datetime.today().replace(hour=0, minute=0, second=0, microsecond=0, day=1,
                                                                      month=1):
-            winner = rating.last_month_winner
+            winner = await RatingService._get_winner(rating.last_year_winner_id)
 
         return winner
 
     @staticmethod
-    def get_year_stat(rating: Rating) -> dict:
+    async def get_year_stat(rating: Rating) -> dict:
         result = {}
 
-        for rating_member in rating.members:
+        for rating_member in await rating.members.aio_execute():
             result[rating_member.id] = rating_member.month_count
 
         return result
 
+    @staticmethod
+    async def _get_winner(rating_member_id: int):
+        return await RatingMember.select_with_users().where(RatingMember.id == rating_member_id).aio_first()
+
     async def send_last_year_winner_message(self, rating: Rating, chat, announcing: bool = False):
-        winner = self.get_year_winner(rating)
+        winner = await self.get_year_winner(rating)
 
         if winner:
-            tg_member = await rating.last_year_winner.get_telegram_member(self.client)
+            tg_member = await winner.get_telegram_member(self.client)
             rating_name_lexeme = Helper.get_words_lexeme(rating_name=rating.name.upper())
             year = (datetime.now().replace(hour=0, minute=10, second=0, microsecond=0, day=1, month=1)
                     - delta(years=1)).year
@@ -496,13 +904,15 @@ class RatingService:
             )
 
             if announcing:
-                with open(config.content.rating_congratulations_file, 'r', encoding='utf-8') as file:
-                    congratulations = file.readlines()
-                    congratulation = random.choice(congratulations).strip(' \n')
-                    congratulation = congratulation.format(**rating_name_lexeme)
-                with open(config.content.year_emojis_file, 'r', encoding='utf-8') as file:
-                    emojis = file.readlines()
-                    emoji = random.choice(emojis).strip(' \n')
+                congratulations = await ContentService.aio_get_chat_texts(
+                    rating.chat_id, ChatContent.KIND_CONGRATULATION, rating.command
+                )
+                congratulation = random.choice(
+                    congratulations or ContentService.get_lines(config.content.rating_congratulations_file)
+                ).strip(' \n')
+                congratulation = congratulation.format(**rating_name_lexeme)
+                emojis = await ContentService.aio_get_chat_texts(rating.chat_id, ChatContent.KIND_EMOJI)
+                emoji = random.choice(emojis or ContentService.get_lines(config.content.year_emojis_file)).strip(' \n')
 
                 await self.client.send_message(chat, winner_message + ' ' + congratulation)
                 await self.client.send_message(chat, emoji)
@@ -517,16 +927,17 @@ class RatingService:
     async def roll_year(self, rating: Rating, chat):
         self.logger.info(InfoBuilder.build_log(f"Year rolling rating", {
             'rating': rating.id,
-            'stats': self.get_year_stat(rating)
+            'stats': await self.get_year_stat(rating)
         }))
 
         try:
-            if not rating.members.exists():
+            if not await rating.members.aio_exists():
                 raise NoMembersRatingError()
 
-            actual_members = await self.client.get_dialog_members(chat)
-            rating_members = rating.members
-            members_collection = Helper.collect_members(actual_members, rating_members, Helper.COLLECT_RETURN_ONLY_DB)
+            rating_members = await RatingMember.select_with_users().where(RatingMember.rating == rating).aio_execute()
+            members_collection = Helper.filter_members_by_ids(
+                await self.client.get_dialog_members_ids(chat), rating_members
+            )
             year = (datetime.now().replace(hour=0, minute=10, second=0, microsecond=0, day=1, month=1)
                     - delta(years=1)).year
 
@@ -534,10 +945,10 @@ class RatingService:
                 raise NoApproachableMembers(rating.name)
 
             winners_query = (RatingMember
-                             .select()
+                             .select_with_users()
                              .where(RatingMember.id.in_(members_collection)))
-            win_count = winners_query.select(fn.MAX(RatingMember.current_year_count)).scalar()
-            winners = list(winners_query.where(RatingMember.current_year_count == win_count).execute())
+            win_count = await winners_query.select(fn.MAX(RatingMember.current_year_count)).aio_scalar()
+            winners = await winners_query.where(RatingMember.current_year_count == win_count).aio_execute()
             winners_len = len(winners)
 
             if winners_len > 1:
@@ -554,8 +965,8 @@ class RatingService:
 
             rating.last_year_winner = win_db_member
             rating.last_year_run = datetime.now()
-            rating.save()
-            RatingMember.update(current_year_count=0).where(RatingMember.rating == rating).execute()
+            await rating.aio_save()
+            await RatingMember.update(current_year_count=0).where(RatingMember.rating == rating).aio_execute()
 
             await self.send_last_year_winner_message(rating, chat, True)
         except BaseFsbException as ex:
@@ -582,9 +993,15 @@ class RatingService:
 
     async def get_stat_message(self, rating: Rating, is_all: bool):
         order = RatingMember.total_count.desc() if is_all else RatingMember.current_month_count.desc()
-        actual_members = await self.client.get_dialog_members(rating.chat.telegram_id)
-        rating_members = RatingMember.select().where(RatingMember.rating == rating).order_by(order)
-        members_collection = Helper.collect_members(actual_members, rating_members)
+        chat = await Chat.aio_get(rating.chat_id)
+        rating_members = await (RatingMember
+                                .select_with_users()
+                                .where(RatingMember.rating == rating)
+                                .order_by(order)
+                                .aio_execute())
+        members_collection = await Helper.aio_collect_members(
+            self.client.iter_dialog_members(chat.telegram_id), rating_members
+        )
 
         if not members_collection:
             return None
@@ -641,23 +1058,91 @@ class BirthdayService:
                         & (fn.DATE_FORMAT(User.birthday, '%m-%d') == datetime.today().strftime('%m-%d')))
         )
 
-        for user in query:
+        for user in await query.aio_execute():
             await self.client.send_message(chat.telegram_id, self.BIRTHDAY_MESSAGE.format(
                 name=Helper.make_member_name(await user.get_telegram_member(self.client), with_mention=True)
             ))
 
 
 class CronService:
+    SYSTEM_JOB_PREFIX = 'system:'
+
     cron_list = {}
+    system_jobs_stats = {}
+    _system_jobs_locks = {}
 
     def __init__(self, client: TelegramApiClient):
         self.client = client
         self.logger = logging.getLogger('main')
 
     async def run(self):
-        for cron_job in CronJob.select().where(CronJob.active):
+        for cron_job in await CronJob.select().where(CronJob.active).aio_execute():
             await self.enable_cron(cron_job=cron_job)
 
+    def enable_system_jobs(self, jobs: dict):
+        # Плановые задачи из config.yml выполняются в процессе бота на уже подключенном клиенте.
+        # С CRON_FALLBACK=True их уже запускает cron, второй запуск продублировал бы рассылки
+        if not config.system_jobs.enabled or config.CRON_FALLBACK:
+            self.logger.info(f"System jobs are disabled{' (CRON_FALLBACK)' if config.CRON_FALLBACK else ''}")
+            return
+
+        if config.FOOL_DAY:
+            jobs_config = config.system_jobs.fool_jobs
+            extra_jobs_config = config.get('FOOL_JOBS_EXTRA', default_value=None)
+        else:
+            jobs_config = config.system_jobs.jobs
+            extra_jobs_config = config.get('SYSTEM_JOBS_EXTRA', default_value=None)
+
+        if extra_jobs_config and not isinstance(extra_jobs_config, list):
+            self.logger.error(f"Extra system jobs must be a json list: {extra_jobs_config!r}")
+            extra_jobs_config = None
+
+        # Задачи конкретного окружения (например, countdown с личными аргументами) задаются json-списком в env
+        for job_config in list(jobs_config or []) + list(extra_jobs_config or []):
+            name = job_config['name']
+            job = jobs.get(job_config.get('job', name))
+
+            if not job:
+                self.logger.error(f"Unknown system job: {name}")
+                continue
+
+            self.cron_list[self.SYSTEM_JOB_PREFIX + name] = aiocron.crontab(
+                job_config['schedule'],
+                func=self.run_system_job,
+                args=(name, job, job_config.get('args') or []),
+                start=True,
+                loop=self.client.loop,
+                tz=timezone('Europe/Moscow')
+            )
+
+        self.logger.info(f"System jobs: {', '.join(self.get_system_jobs_names()) or 'none'}")
+
+    def get_system_jobs_names(self) -> list:
+        return [name.replace(self.SYSTEM_JOB_PREFIX, '', 1) for name in self.cron_list if str(name).startswith(self.SYSTEM_JOB_PREFIX)]
+
+    async def run_system_job(self, name: str, job: callable, args: list):
+        lock = self._system_jobs_locks.setdefault(name, Lock())
+
+        if lock.locked():
+            self.logger.warning(f"System job {name} is still running, skipped")
+            return
+
+        async with lock:
+            started = time()
+            stats = self.system_jobs_stats.setdefault(name, {'runs': 0, 'errors': 0, 'last_run': None, 'last_time': None})
+            self.logger.info(f"Start system job {name}")
+
+            try:
+                await job(self.client, *args)
+            except Exception as ex:
+                stats['errors'] += 1
+                self.logger.exception(ex)
+
+            stats['runs'] += 1
+            stats['last_run'] = datetime.now().isoformat()
+            stats['last_time'] = round(time() - started, 2)
+            self.logger.info(InfoBuilder.build_log(f"System job {name} finished", stats))
+
     def stop(self):
         for cron_job in self.cron_list.values():
             cron_job.stop()
@@ -665,17 +1150,17 @@ class CronService:
         self.cron_list.clear()
 
     async def add_cron_job(self, name: str, chat: Chat, message: str, schedule: str):
-        cron_job = CronJob.create(name=name, chat=chat, message=message, schedule=schedule)
+        cron_job = await CronJob.aio_create(name=name, chat=chat, message=message, schedule=schedule)
         await self.enable_cron(cron_job=cron_job)
         return cron_job
 
-    def remove_cron_job(self, cron_job_id: int = None, cron_job: CronJob = None):
-        cron_job = self.disable_cron(cron_job_id=cron_job_id, cron_job=cron_job)
-        cron_job.delete_instance()
+    async def remove_cron_job(self, cron_job_id: int = None, cron_job: CronJob = None):
+        cron_job = await self.disable_cron(cron_job_id=cron_job_id, cron_job=cron_job)
+        await cron_job.aio_delete_instance()
 
     async def enable_cron(self, cron_job_id: int = None, cron_job: CronJob = None):
         if cron_job_id:
-            cron_job = CronJob.get_by_id(cron_job_id)
+            cron_job = await CronJob.aio_get(cron_job_id)
 
         if not cron_job:
             return
@@ -684,20 +1169,20 @@ class CronService:
             cron = aiocron.crontab(
                 cron_job.schedule,
                 func=self.send_message,
-                args=(cron_job.chat, cron_job.message),
+                args=(await Chat.aio_get(cron_job.chat_id), cron_job.message),
                 start=True,
                 loop=self.client.loop,
                 tz=timezone('Europe/Moscow')
             )
             self.cron_list[cron_job.id] = cron
             cron_job.active = True
-            cron_job.save()
+            await cron_job.aio_save()
 
         return cron_job
 
-    def disable_cron(self, cron_job_id: int = None, cron_job: CronJob = None):
+    async def disable_cron(self, cron_job_id: int = None, cron_job: CronJob = None):
         if cron_job_id:
-            cron_job = CronJob.get_by_id(cron_job_id)
+            cron_job = await CronJob.aio_get(cron_job_id)
 
         if not cron_job:
             return
@@ -706,23 +1191,422 @@ class CronService:
             cron = self.cron_list.pop(cron_job.id)
             cron.stop()
             cron_job.active = False
-            cron_job.save()
+            await cron_job.aio_save()
 
         return cron_job
 
     async def update_cron(self, cron_job_id: int = None, cron_job: CronJob = None):
         if cron_job_id:
-            cron_job = CronJob.get_by_id(cron_job_id)
+            cron_job = await CronJob.aio_get(cron_job_id)
 
         if not cron_job:
             return
 
         if cron_job.id in self.cron_list:
-            self.disable_cron(cron_job=cron_job)
+            await self.disable_cron(cron_job=cron_job)
             await self.enable_cron(cron_job=cron_job)
 
         return cron_job
 
     async def send_message(self, chat: Chat, message: str):
-        if chat.is_enabled_module(Module.MODULE_CRON):
+        if await chat.aio_is_enabled_module(Module.MODULE_CRON):
             await self.client.send_message(chat.telegram_id, message)
+
+
+class QueryEventService:
+    TTL_DAYS = 30
+    SWEEP_INTERVAL = 3600
+    SWEEP_BATCH_SIZE = 1000
+    SWEEP_BATCH_PAUSE = 0.5
+    PARTITION_MONTHS_AHEAD = 3
+
+    stats = {
+        'runs': 0,
+        'deleted': 0,
+        'dropped_partitions': 0,
+        'last_run': None,
+    }
+
+    @staticmethod
+    def get_ttl_days(event_class: type) -> int:
+        ttl_by_class = config.query_events.ttl_days_by_class
+        ttl_by_class = ttl_by_class.to_dict() if ttl_by_class else {}
+
+        return int(
+            ttl_by_class.get(event_class.__name__)
+            or event_class.TTL_DAYS
+            or config.query_events.ttl_days
+            or QueryEventService.TTL_DAYS
+        )
+
+    @staticmethod
+    def get_expired_condition(ttl_days: int):
+        expired_at = datetime.now() - timedelta(days=ttl_days)
+
+        return (QueryEvent.last_usage_date < expired_at) \
+            | (QueryEvent.last_usage_date.is_null() & (QueryEvent.created_at < expired_at))
+
+    @staticmethod
+    def get_expired_conditions() -> list:
+        default_ttl = QueryEventService.get_ttl_days(QueryEvent)
+        conditions = []
+        custom_classes = []
+
+        for event_class in QueryEvent._classes.values():
+            ttl_days = QueryEventService.get_ttl_days(event_class)
+
+            if ttl_days != default_ttl:
+                custom_classes.append(event_class.__name__)
+                conditions.append(
+                    QueryEventService.get_expired_condition(ttl_days)
+                    & (QueryEvent.module_name == event_class.__module__)
+                    & (QueryEvent.class_name == event_class.__name__)
+                )
+
+        # Все остальные классы, в том числе уже удалённые из кода, чистятся по общему ttl
+        default_condition = QueryEventService.get_expired_condition(default_ttl)
+
+        if custom_classes:
+            default_condition &= QueryEvent.class_name.not_in(custom_classes)
+
+        conditions.append(default_condition)
+
+        return conditions
+
+    @staticmethod
+    async def run():
+        logger = logging.getLogger('main')
+        interval = int(config.query_events.sweep_interval or QueryEventService.SWEEP_INTERVAL)
+
+        while True:
+            try:
+                await QueryEventService.sweep()
+            except Exception as ex:
+                logger.exception(ex)
+
+            await sleep(interval)
+
+    @staticmethod
+    async def sweep() -> int:
+        batch_size = int(config.query_events.sweep_batch_size or QueryEventService.SWEEP_BATCH_SIZE)
+        deleted = 0
+
+        if await QueryEventService.get_partitions():
+            await QueryEventService.drop_expired_partitions()
+
+        # Удаляем небольшими пачками, чтобы не держать долгие блокировки на таблице
+        for condition in QueryEventService.get_expired_conditions():
+            while True:
+                count = await QueryEvent.delete().where(condition).limit(batch_size).aio_execute()
+                deleted += count
+
+                if count < batch_size:
+                    break
+
+                await sleep(QueryEventService.SWEEP_BATCH_PAUSE)
+
+        QueryEventService.stats['runs'] += 1
+        QueryEventService.stats['deleted'] += deleted
+        QueryEventService.stats['last_run'] = datetime.now().isoformat()
+        logging.getLogger('main').info(InfoBuilder.build_log('Query events sweep stats', QueryEventService.stats))
+
+        return deleted
+
+    @staticmethod
+    async def get_partitions() -> list:
+        rows = await database.aio_execute_sql(
+            "SELECT PARTITION_NAME, PARTITION_DESCRIPTION FROM information_schema.PARTITIONS "
+            "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND PARTITION_NAME IS NOT NULL "
+            "ORDER BY PARTITION_ORDINAL_POSITION",
+            [QueryEvent._meta.table_name],
+            fetch_results=lambda cursor: cursor.fetchall()
+        )
+
+        return [(row[0], row[1].strip("'")) for row in rows]
+
+    @staticmethod
+    async def partition(months_ahead: int = None) -> Union[list, None]:
+        # Добавляет недостающие будущие партиции. Саму таблицу на партиции переводит миграция
+        # partition_query_events, без неё возвращается None
+        months_ahead = int(months_ahead or config.query_events.partition_months_ahead or QueryEventService.PARTITION_MONTHS_AHEAD)
+        table = QueryEvent._meta.table_name
+        partitions = await QueryEventService.get_partitions()
+
+        if not partitions:
+            return None
+
+        existing = [name for name, _ in partitions]
+        months = []
+        month = datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+        while month <= datetime.now() + delta(months=months_ahead):
+            name = month.strftime('p%Y%m')
+
+            if name not in existing:
+                months.append((name, (month + delta(months=1)).strftime('%Y-%m-%d')))
+
+            month += delta(months=1)
+
+        if months:
+            definitions = [f"PARTITION {name} VALUES LESS THAN ('{bound}')" for name, bound in months]
+            definitions.append('PARTITION pmax VALUES LESS THAN (MAXVALUE)')
+            await database.aio_execute_sql(f"ALTER TABLE {table} REORGANIZE PARTITION pmax INTO ({', '.join(definitions)})")
+
+        return [name for name, _ in months]
+
+    @staticmethod
+    async def drop_expired_partitions() -> list:
+        table = QueryEvent._meta.table_name
+        ttl_days = max([QueryEventService.get_ttl_days(event_class) for event_class in QueryEvent._classes.values()]
+                       + [QueryEventService.get_ttl_days(QueryEvent)])
+        expired_at = datetime.now() - timedelta(days=ttl_days)
+        dropped = []
+
+        for name, bound in await QueryEventService.get_partitions():
+            if name == 'pmax' or datetime.fromisoformat(bound) > expired_at:
+                continue
+
+            # Партиция удаляется целиком, только если её кнопками давно никто не пользовался
+            used = await database.aio_execute_sql(
+                f'SELECT 1 FROM {table} PARTITION ({name}) WHERE last_usage_date >= %s LIMIT 1',
+                [expired_at],
+                fetch_results=lambda cursor: cursor.fetchone()
+            )
+
+            if not used:
+                await database.aio_execute_sql(f'ALTER TABLE {table} DROP PARTITION {name}')
+                dropped.append(name)
+
+        QueryEventService.stats['dropped_partitions'] += len(dropped)
+
+        return dropped
+
+
+class BroadcastService:
+    RATE = 25
+    PER_CHAT_INTERVAL = 1
+    CONCURRENCY = 10
+    MAX_ATTEMPTS = 3
+
+    def __init__(self, client: TelegramApiClient, name: str, run_key: str = None):
+        self.client = client
+        self.name = name
+        self.run_key = run_key if run_key else datetime.now().strftime('%Y-%m-%d')
+        self.logger = logging.getLogger('main')
+        self.report = {
+            'total': 0,
+            'sent': 0,
+            'skipped': 0,
+            'failed': 0,
+            'messages': 0,
+            'flood_waits': 0,
+            'time': 0,
+            'chats_per_second': 0,
+        }
+
+        self._global_bucket = TokenBucket(float(config.broadcast.rate or self.RATE))
+        self._chat_buckets = {}
+        self._flood_wait_until = 0
+        self._state = None
+
+    def __getattr__(self, name):
+        # Рассылку можно передавать в сервисы вместо клиента, тогда их отправка тоже ограничивается
+        return getattr(self.client, name)
+
+    async def run(self, chats: list, job: callable) -> dict:
+        started = time()
+        self._load_state()
+        semaphore = Semaphore(int(config.broadcast.concurrency or self.CONCURRENCY))
+        self.report['total'] = len(chats)
+
+        await gather(*[self._run_job(chat, job, semaphore) for chat in chats])
+
+        self._state['finished'] = not self._state['failed']
+        self._save_state()
+        self.report['time'] = round(time() - started, 2)
+        self.report['chats_per_second'] = round(self.report['sent'] / self.report['time'], 2) if self.report['time'] else 0
+        self.logger.info(InfoBuilder.build_log(f'Broadcast {self.name} report', self.report))
+
+        return self.report
+
+    async def _run_job(self, chat: Chat, job: callable, semaphore: Semaphore):
+        chat_key = str(chat.telegram_id)
+
+        if chat_key in self._state['done']:
+            self.report['skipped'] += 1
+            return
+
+        async with semaphore:
+            try:
+                await job(chat)
+                self._state['done'].append(chat_key)
+                self._state['failed'].pop(chat_key, None)
+                self.report['sent'] += 1
+            except Exception as ex:
+                self._state['failed'][chat_key] = repr(ex)
+                self.report['failed'] += 1
+                self.logger.exception(ex)
+
+            self._save_state()
+
+    async def send_message(self, entity, *args, **kwargs):
+        return await self._call(entity, self.client.send_message, entity, *args, **kwargs)
+
+    async def edit_message(self, entity, *args, **kwargs):
+        # Правки в роллах идут тем же лимитом, что и отправка
+        return await self._call(entity, self.client.edit_message, entity, *args, **kwargs)
+
+    async def _call(self, entity, method: callable, *args, **kwargs):
+        for attempt in range(1, self.MAX_ATTEMPTS + 1):
+            await self.throttle(entity)
+
+            try:
+                message = await method(*args, **kwargs)
+                self.report['messages'] += 1
+                return message
+            except FloodWaitError as ex:
+                self.report['flood_waits'] += 1
+                self._flood_wait_until = max(self._flood_wait_until, time() + ex.seconds)
+                self.logger.warning(f'Broadcast {self.name}: FloodWait {ex.seconds}s')
+
+                if attempt == self.MAX_ATTEMPTS:
+                    raise ex
+
+    async def throttle(self, entity):
+        if self._flood_wait_until > time():
+            await sleep(self._flood_wait_until - time())
+
+        chat_key = entity if isinstance(entity, (int, str)) else getattr(entity, 'id', entity)
+
+        if chat_key not in self._chat_buckets:
+            self._chat_buckets[chat_key] = TokenBucket(1 / float(config.broadcast.per_chat_interval or self.PER_CHAT_INTERVAL), 1)
+
+        await self._chat_buckets[chat_key].acquire()
+        await self._global_bucket.acquire()
+
+    def _get_state_file(self) -> str:
+        state_dir = os.path.abspath(config.get('LOG_FOLDER', default_value=config.ROOT_FOLDER + '/logs') + '/broadcasts')
+        os.makedirs(state_dir, exist_ok=True)
+        return f'{state_dir}/{self.name}.json'
+
+    def _load_state(self):
+        self._state = {'run_key': self.run_key, 'done': [], 'failed': {}, 'finished': False}
+
+        try:
+            with open(self._get_state_file(), 'r', encoding='utf-8') as file:
+                state = json.load(file)
+
+            if state.get('run_key') == self.run_key:
+                self._state.update(state)
+                self.logger.info(f"Broadcast {self.name}: resuming, {len(self._state['done'])} chats already done")
+        except (OSError, ValueError):
+            pass
+
+    def _save_state(self):
+        with open(self._get_state_file(), 'w', encoding='utf-8') as file:
+            json.dump(self._state, file)
+
+
+class MetricsService:
+    LAG_PROBE_INTERVAL = 0.5
+    SUMMARY_INTERVAL = 300
+    HTTP_HOST = '127.0.0.1'
+    HTTP_PORT = 9464
+    HTTP_TIMEOUT = 5
+
+    @staticmethod
+    async def run():
+        logger = logging.getLogger('main')
+        probe_interval = float(config.metrics.lag_probe_interval or MetricsService.LAG_PROBE_INTERVAL)
+        summary_interval = int(config.metrics.summary_interval or MetricsService.SUMMARY_INTERVAL)
+        summary_at = monotonic() + summary_interval
+
+        while True:
+            # Насколько позже запланированного проснулась задача - столько цикл событий был занят
+            started = monotonic()
+            await sleep(probe_interval)
+            now = monotonic()
+            Metrics.observe(Metrics.LOOP_LAG, 'loop', max(now - started - probe_interval, 0.0))
+
+            if now >= summary_at:
+                summary_at = now + summary_interval
+                logger.info(InfoBuilder.build_log('Latency summary', Metrics.get_summary()))
+
+    @staticmethod
+    async def serve(client: TelegramApiClient):
+        logger = logging.getLogger('main')
+        host = config.metrics.http_host or MetricsService.HTTP_HOST
+        port = int(config.metrics.http_port or MetricsService.HTTP_PORT)
+
+        async def read_request(reader) -> str:
+            request_line = await reader.readline()
+
+            # Заголовки дочитываются, чтобы закрытие сокета не оборвало ответ
+            while (await reader.readline()).strip():
+                pass
+
+            return request_line.decode('latin-1')
+
+        async def handle(reader, writer):
+            try:
+                request = (await wait_for(read_request(reader), MetricsService.HTTP_TIMEOUT)).split()
+
+                if len(request) >= 2 and request[1].split('?')[0] == '/metrics':
+                    status, body = '200 OK', Metrics.render_prometheus(MetricsService.collect(client))
+                else:
+                    status, body = '404 Not Found', 'Not Found\n'
+
+                body = body.encode()
+                writer.write(
+                    f"HTTP/1.1 {status}\r\n"
+                    "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                    f"Content-Length: {len(body)}\r\n"
+                    "Connection: close\r\n\r\n".encode() + body
+                )
+                await writer.drain()
+            except Exception as ex:
+                logger.warning(f'Metrics request failed: {ex!r}')
+            finally:
+                writer.close()
+
+        server = await start_server(handle, host, port)
+        logger.info(f'Metrics endpoint: http://{host}:{port}/metrics')
+
+        return server
+
+    @staticmethod
+    def collect(client: TelegramApiClient) -> dict:
+        entity_cache = client.get_entity_cache_stats()
+        participants_cache = client.participants_cache_stats
+        morph_cache = Helper.get_morph_cache_stats()
+        sources = {
+            'db': database.stats,
+            'db_pool': database.get_pool_stats(),
+            'entity_cache': entity_cache,
+            'participants_cache': participants_cache,
+            'morph_cache': morph_cache,
+            'members_sync': ChatService.members_sync_stats,
+            'chats_init': ChatService.init_chats_stats,
+            'chat_lock': ChatLock.stats,
+            'quantum_rand': QuantumRandService.stats,
+            'query_events': QueryEventService.stats,
+        }
+        gauges = {}
+
+        for group, stats in sources.items():
+            for key, value in stats.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    gauges[f'{group}_{key}'] = {(): value}
+
+        hits_and_misses = {
+            'entity': (entity_cache['hits'], entity_cache['misses']),
+            'participants': (participants_cache['hits'] + participants_cache['stale_hits'], participants_cache['fetches']),
+            'morph_inflect': (morph_cache['inflect_hits'], morph_cache['inflect_misses']),
+            'morph_lexeme': (morph_cache['lexeme_hits'], morph_cache['lexeme_misses']),
+        }
+        gauges['cache_hit_ratio'] = {
+            (('cache', name),): round(hits / (hits + misses), 4) if hits + misses else 0.0
+            for name, (hits, misses) in hits_and_misses.items()
+        }
+
+        return gauges
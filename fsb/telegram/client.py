@@ -2,11 +2,15 @@
 
 import json
 import logging
-from time import sleep, time
+from asyncio import Event, shield
+from collections import OrderedDict
+from contextvars import Context
+from time import sleep, monotonic
 from typing import Any, Union
 
 from telethon import TelegramClient, errors, functions
 from telethon.errors import BadRequestError
+from telethon.events import Raw
 from telethon.events.common import EventBuilder
 from telethon.tl.types import (
     Message,
@@ -19,25 +23,97 @@ from fsb.db.models import User, Chat, TelegramEntity
 from fsb.errors import (
     DisconnectFailedError
 )
-from fsb.helpers import InfoBuilder
+from fsb.helpers import Helper, InfoBuilder, Metrics
+
+
+class MembersRefresh:
+    # Общий поток участников одного обновления: задача наполняет список, читатели идут по нему следом
+    def __init__(self):
+        self.task = None
+        self.generation = None
+        self.members = []
+        self.done = False
+        self.error = None
+        self._changed = Event()
+
+    def append(self, member):
+        self.members.append(member)
+        self._notify()
+
+    def finish(self, error: Exception = None):
+        self.done = True
+        self.error = error
+        self._notify()
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = Event()
+
+    async def __aiter__(self):
+        position = 0
+
+        while True:
+            while position < len(self.members):
+                yield self.members[position]
+                position += 1
+
+            if self.done:
+                break
+
+            await self._changed.wait()
+
+        if self.error:
+            raise self.error
 
 
 class TelegramApiClient:
     MAX_RELOGIN_COUNT = 3
     DISCONNECT_TIMEOUT = 15
-    PARTICIPANTS_LIMIT = 200
+    PARTICIPANTS_CHUNK_SIZE = 200
+    PARTICIPANTS_CACHE_MEMBERS_LIMIT = 10000
     PARTICIPANTS_CACHE_TIME = 60
+    PARTICIPANTS_STALE_TIME = 600
+    PARTICIPANTS_CACHE_SIZE = 500
+    ENTITY_CACHE_SIZE = 5000
+    ENTITY_CACHE_TTL = 600
 
-    def __init__(self, name: str = None, cli: bool = False):
+    def __init__(self, name: str = None, cli: bool = False, telegram_client: TelegramClient = None):
         self.name = name
-        self._client = TelegramClient(name, config.API_ID, config.API_HASH)
+        self._client = telegram_client if telegram_client else TelegramClient(name, config.API_ID, config.API_HASH)
         self.loop = self._client.loop
         self._relogin_count = 0
         self._current_user = None
         self.cli = cli
         self.logger = logging.getLogger('main')
 
-        self._chat_members_cache = {}
+        self._chat_members_cache = OrderedDict()
+        self._participants_refreshes = {}
+        self._participants_generation = 0
+        self._participants_chats_generations = {}
+        self._participants_cache_size = int(config.participants_cache.size or self.PARTICIPANTS_CACHE_SIZE)
+        self._participants_ttl = int(config.participants_cache.ttl or self.PARTICIPANTS_CACHE_TIME)
+        self._participants_stale_time = int(config.participants_cache.stale_ttl or self.PARTICIPANTS_STALE_TIME)
+        chats_ttl = config.participants_cache.chats_ttl
+        self._participants_chats_ttl = {int(chat_id): int(ttl) for chat_id, ttl in (chats_ttl.to_dict() if chats_ttl else {}).items()}
+        self.participants_cache_stats = {
+            'hits': 0,
+            'stale_hits': 0,
+            'fetches': 0,
+            'coalesced': 0,
+            'evictions': 0,
+            'invalidations': 0,
+            'ids_only': 0,
+        }
+        self._entity_cache = OrderedDict()
+        self._entity_cache_size = int(config.entity_cache.size or self.ENTITY_CACHE_SIZE)
+        self._entity_cache_ttl = int(config.entity_cache.ttl or self.ENTITY_CACHE_TTL)
+        self.entity_cache_stats = {
+            'hits': 0,
+            'misses': 0,
+            'seeded': 0,
+            'evictions': 0,
+        }
+        self._client.add_event_handler(self._count_update, Raw)
 
     def start(self):
         self._client.run_until_disconnected()
@@ -65,38 +141,58 @@ class TelegramApiClient:
         self.logger.info("Logout")
 
     async def send_message(self, entity, message: Any, reply_to: Message = None, buttons=None, is_file: bool = False, **kwargs):
-        try:
-            if isinstance(entity, Union[str, int]):
-                entity = await self.get_entity(entity)
-
-            if config.FSB_DEV_MODE:
-                self.logger.debug(InfoBuilder.build_debug_message_info(entity, message, reply_to))
-            elif self.cli:
-                self.logger.info(InfoBuilder.build_debug_message_info(entity, message, reply_to))
-
-            new_message = None
-            if isinstance(message, str):
-                message = message.rstrip('\t \n')
-            if message:
-                if is_file:
-                    new_message = await self._client.send_file(entity=entity, file=message, reply_to=reply_to, buttons=buttons, **kwargs)
-                else:
-                    new_message = await self._client.send_message(entity=entity, message=message, reply_to=reply_to, buttons=buttons, **kwargs)
-            return new_message
-        except errors.PeerFloodError as e:
-            self.logger.error(f"{entity}: PeerFloodError")
-            raise e
-        except errors.UsernameInvalidError as e:
-            self.logger.error(f"{entity}: UsernameInvalidError")
-            raise e
-        except ValueError as e:
-            self.logger.error(f"{entity}: ValueError")
-            raise e
-        except BadRequestError as ex:
-            self._bad_request_handle(self._get_db_entity(entity.id), ex)
+        with Metrics.timer(Metrics.TELEGRAM, 'send_message'):
+            try:
+                if isinstance(entity, Union[str, int]):
+                    entity = await self.get_entity(entity)
+
+                if config.FSB_DEV_MODE:
+                    self.logger.debug(InfoBuilder.build_debug_message_info(entity, message, reply_to, view_type=InfoBuilder.LAZY))
+                elif self.cli:
+                    self.logger.info(InfoBuilder.build_debug_message_info(entity, message, reply_to, view_type=InfoBuilder.LAZY))
+
+                new_message = None
+                if isinstance(message, str):
+                    message = message.rstrip('\t \n')
+                if message:
+                    if is_file:
+                        new_message = await self._client.send_file(entity=entity, file=message, reply_to=reply_to, buttons=buttons, **kwargs)
+                    else:
+                        new_message = await self._client.send_message(entity=entity, message=message, reply_to=reply_to, buttons=buttons, **kwargs)
+                    Metrics.inc('telegram_sent_messages')
+                return new_message
+            except errors.FloodWaitError as e:
+                Metrics.inc('telegram_flood_wait_seconds', e.seconds, method='send_message')
+                raise e
+            except errors.PeerFloodError as e:
+                self.logger.error(f"{entity}: PeerFloodError")
+                raise e
+            except errors.UsernameInvalidError as e:
+                self.logger.error(f"{entity}: UsernameInvalidError")
+                raise e
+            except ValueError as e:
+                self.logger.error(f"{entity}: ValueError")
+                raise e
+            except BadRequestError as ex:
+                db_entity = await self._get_db_entity(entity.id)
+
+                if db_entity:
+                    await self._bad_request_handle(db_entity, ex)
+
+    async def edit_message(self, entity, message: Message, text: str, **kwargs):
+        with Metrics.timer(Metrics.TELEGRAM, 'edit_message'):
+            try:
+                return await self._client.edit_message(entity, message, text, **kwargs)
+            except errors.FloodWaitError as e:
+                Metrics.inc('telegram_flood_wait_seconds', e.seconds, method='edit_message')
+                raise e
 
     async def get_entity(self, uid: Union[str, int], with_full: bool = True):
-        entity = None
+        entity = self._get_cached_entity(uid) if with_full else None
+
+        if entity:
+            return entity
+
         db_entity = None
 
         try:
@@ -105,7 +201,7 @@ class TelegramApiClient:
                     entity = await self._client.get_entity(uid)
             except ValueError:
                 if with_full:
-                    db_entity = self._get_db_entity(uid)
+                    db_entity = await self._get_db_entity(uid)
 
                     if db_entity and db_entity.input_peer:
                         metadata = json.loads(db_entity.input_peer)
@@ -123,18 +219,81 @@ class TelegramApiClient:
                     entity = await self.get_entity(uid, False)
         except BadRequestError as ex:
             if not db_entity:
-                db_entity = self._get_db_entity(uid)
+                db_entity = await self._get_db_entity(uid)
 
             if db_entity:
-                self._bad_request_handle(db_entity, ex)
+                await self._bad_request_handle(db_entity, ex)
         finally:
+            if entity:
+                self._cache_entity(entity, uid)
+
             return entity
 
+    def get_entity_cache_stats(self) -> dict:
+        return {**self.entity_cache_stats, 'size': len(self._entity_cache)}
+
+    def invalidate_entity(self, uid: Union[str, int] = None):
+        if uid is None:
+            self._entity_cache.clear()
+        else:
+            self._entity_cache.pop(self._get_entity_cache_key(uid), None)
+
+    @staticmethod
+    def _get_entity_cache_key(uid: Union[str, int]):
+        if isinstance(uid, str):
+            uid = uid.strip().lstrip('@').lower()
+            return int(uid) if uid.lstrip('-').isdigit() else uid
+
+        return uid
+
+    def _get_cached_entity(self, uid: Union[str, int]):
+        if not uid:
+            return None
+
+        key = self._get_entity_cache_key(uid)
+        cached = self._entity_cache.get(key)
+
+        if not cached or monotonic() - cached[0] > self._entity_cache_ttl:
+            self.entity_cache_stats['misses'] += 1
+            return None
+
+        self._entity_cache.move_to_end(key)
+        self.entity_cache_stats['hits'] += 1
+
+        return cached[1]
+
+    def _cache_entity(self, entity, uid: Union[str, int] = None):
+        keys = {entity.id}
+
+        if uid:
+            keys.add(self._get_entity_cache_key(uid))
+        if getattr(entity, 'username', None):
+            keys.add(entity.username.lower())
+
+        cached_at = monotonic()
+
+        for key in keys:
+            self._entity_cache[key] = (cached_at, entity)
+            self._entity_cache.move_to_end(key)
+
+        while len(self._entity_cache) > self._entity_cache_size:
+            self._entity_cache.popitem(last=False)
+            self.entity_cache_stats['evictions'] += 1
+
     def add_event_handler(self, handler: callable, event: EventBuilder):
         self._client.add_event_handler(handler, event)
 
     async def request(self, data):
-        return await self._client(data)
+        with Metrics.timer(Metrics.TELEGRAM, data.__class__.__name__):
+            try:
+                return await self._client(data)
+            except errors.FloodWaitError as ex:
+                Metrics.inc('telegram_flood_wait_seconds', ex.seconds, method=data.__class__.__name__)
+                raise ex
+
+    @staticmethod
+    async def _count_update(update):
+        Metrics.inc('telegram_updates', type=update.__class__.__name__)
 
     async def get_dialog_members(self, entity, with_bot: bool = None, use_cache: bool = True) -> list:
         if isinstance(entity, Union[str, int]):
@@ -145,40 +304,233 @@ class TelegramApiClient:
         else:
             with_bot = False
 
-        members_cache = self._chat_members_cache.get(entity.id)
-        now = int(time())
+        members_cache = self._get_cached_members(entity.id)
+        age = monotonic() - members_cache['time'] if members_cache else None
 
-        if not use_cache or not members_cache or members_cache['time'] + self.PARTICIPANTS_CACHE_TIME < now:
-            members = []
+        if not use_cache or age is None or age > self._participants_stale_time:
+            members = await shield(self._refresh_dialog_members(entity).task)
+        else:
+            self._chat_members_cache.move_to_end(entity.id)
+            members = members_cache['members']
 
-            try:
-                for member in await self._client.get_participants(entity, aggressive=False, limit=self.PARTICIPANTS_LIMIT):
-                    if member.username == self._current_user.username or (not with_bot and member.bot):
-                        continue
-                    members.append(member)
-            except BadRequestError as ex:
-                db_entity = self._get_db_entity(entity.id)
+            # Устаревший список отдаём сразу, а обновляем его в фоне
+            if age > self.get_participants_ttl(entity.id):
+                self.participants_cache_stats['stale_hits'] += 1
+                self._refresh_dialog_members(entity)
+            else:
+                self.participants_cache_stats['hits'] += 1
 
-                if db_entity:
-                    self._bad_request_handle(db_entity, ex)
-                else:
-                    raise ex
+        return [member for member in members if with_bot or not member.bot]
+
+    async def iter_dialog_members(self, entity, with_bot: bool = None, chunk_size: int = None):
+        if isinstance(entity, Union[str, int]):
+            entity = await self.get_entity(entity)
+
+        if with_bot is None:
+            with_bot = True if config.FSB_DEV_MODE else False
+        else:
+            with_bot = False
+
+        chunk_size = chunk_size if chunk_size else self.PARTICIPANTS_CHUNK_SIZE
+        members_cache = self._get_cached_members(entity.id)
+        age = monotonic() - members_cache['time'] if members_cache else None
 
-            self._chat_members_cache.update({entity.id: {'time': now, 'members': members}})
+        if age is None or age > self._participants_stale_time:
+            # Промах читает общее обновление по мере загрузки. Оно доходит до конца и попадает в кеш,
+            # даже если читатель остановился раньше
+            members = self._refresh_dialog_members(entity)
         else:
+            self._chat_members_cache.move_to_end(entity.id)
             members = members_cache['members']
 
-        return members
+            if age > self.get_participants_ttl(entity.id):
+                self.participants_cache_stats['stale_hits'] += 1
+                self._refresh_dialog_members(entity)
+            else:
+                self.participants_cache_stats['hits'] += 1
+
+        async for chunk in Helper.iter_chunks(members, chunk_size):
+            chunk = [member for member in chunk if with_bot or not member.bot]
+
+            if chunk:
+                yield chunk
+
+    async def get_dialog_members_ids(self, entity, with_bot: bool = None) -> set:
+        # Только telegram id участников. Для больших чатов кешируется лишь этот набор,
+        # поэтому розыгрыши и прочие сверки по id не перечитывают чат при каждом вызове
+        if isinstance(entity, Union[str, int]):
+            entity = await self.get_entity(entity)
+
+        if with_bot is None:
+            with_bot = True if config.FSB_DEV_MODE else False
+        else:
+            with_bot = False
+
+        members_cache = self._chat_members_cache.get(entity.id)
+        age = monotonic() - members_cache['time'] if members_cache else None
+
+        if age is None or age > self._participants_stale_time:
+            members = await shield(self._refresh_dialog_members(entity).task)
+            return {member.id for member in members if with_bot or not member.bot}
+
+        self._chat_members_cache.move_to_end(entity.id)
+
+        if age > self.get_participants_ttl(entity.id):
+            self.participants_cache_stats['stale_hits'] += 1
+            self._refresh_dialog_members(entity)
+        else:
+            self.participants_cache_stats['hits'] += 1
+
+        return members_cache['ids'] | members_cache['bots'] if with_bot else members_cache['ids']
+
+    def _get_cached_members(self, chat_id: int) -> Union[dict, None]:
+        # У больших чатов в кеше только набор id, список участников для них всегда читается заново
+        members_cache = self._chat_members_cache.get(chat_id)
+
+        if members_cache and members_cache['members'] is None:
+            self.participants_cache_stats['ids_only'] += 1
+            return None
+
+        return members_cache
+
+    def get_participants_ttl(self, chat_id: int) -> int:
+        return int(self._participants_chats_ttl.get(chat_id) or self._participants_ttl)
+
+    def set_participants_ttl(self, chat_id: int, ttl: int = None):
+        if ttl is None:
+            self._participants_chats_ttl.pop(chat_id, None)
+        else:
+            self._participants_chats_ttl[chat_id] = ttl
+
+    def invalidate_dialog_members(self, chat_id: int = None):
+        # Обновления, начатые до сброса, дочитываются своими читателями, но в кеш уже не попадут,
+        # а следующий промах запустит новое
+        if chat_id is None:
+            self._chat_members_cache.clear()
+            self._participants_refreshes.clear()
+            self._participants_generation += 1
+        else:
+            self._chat_members_cache.pop(chat_id, None)
+            self._participants_refreshes.pop(chat_id, None)
+            self._participants_chats_generations[chat_id] = self._participants_chats_generations.get(chat_id, 0) + 1
+
+        self.participants_cache_stats['invalidations'] += 1
+
+    def _get_members_generation(self, chat_id: int) -> tuple:
+        return self._participants_generation, self._participants_chats_generations.get(chat_id, 0)
+
+    def _refresh_dialog_members(self, entity) -> MembersRefresh:
+        # Одновременные промахи по одному чату ждут один и тот же запрос участников
+        refresh = self._participants_refreshes.get(entity.id)
+
+        if refresh:
+            self.participants_cache_stats['coalesced'] += 1
+        else:
+            refresh = MembersRefresh()
+            refresh.generation = self._get_members_generation(entity.id)
+            # Пустой контекст, чтобы задача не унаследовала соединение транзакции вызывающего кода
+            refresh.task = Context().run(self.loop.create_task, self._fetch_dialog_members(entity, refresh))
+            refresh.task.add_done_callback(lambda task: self._finish_members_refresh(entity.id, refresh))
+            self._participants_refreshes[entity.id] = refresh
+
+        return refresh
+
+    def _finish_members_refresh(self, chat_id: int, refresh: MembersRefresh):
+        # После сброса кеша под этим чатом может быть уже другое обновление
+        if self._participants_refreshes.get(chat_id) is refresh:
+            self._participants_refreshes.pop(chat_id)
+
+        if not refresh.task.cancelled() and refresh.task.exception():
+            self.logger.error(f"{chat_id}: participants refresh failed: {refresh.task.exception()!r}")
+
+    async def _fetch_dialog_members(self, entity, refresh: MembersRefresh) -> list:
+        try:
+            async for member in self._stream_participants(entity, refresh.generation):
+                refresh.append(member)
+        except BaseException as ex:
+            refresh.finish(ex)
+            raise
+
+        refresh.finish()
+
+        return refresh.members
+
+    async def _stream_participants(self, entity, generation: tuple):
+        # Постранично обходит всех участников чата любого размера. Список небольших чатов
+        # по ходу собирается и попадает в кеш, от больших чатов в кеше остаётся только набор id
+        members = []
+        members_ids = set()
+        bots_ids = set()
+        completed = False
+        self.participants_cache_stats['fetches'] += 1
+
+        try:
+            async for member in self._client.iter_participants(entity, aggressive=False):
+                if member.username == self._current_user.username:
+                    continue
+
+                if member.bot:
+                    bots_ids.add(member.id)
+                else:
+                    members_ids.add(member.id)
+
+                if members is not None:
+                    members.append(member)
 
-    def _get_db_entity(self, telegram_id: Union[str, int]) -> Union[TelegramEntity]:
-        db_entity = Chat.get_by_telegram_id(telegram_id)
+                    if len(members) > self.PARTICIPANTS_CACHE_MEMBERS_LIMIT:
+                        members = None
+
+                yield member
+
+            completed = True
+        except BadRequestError as ex:
+            db_entity = await self._get_db_entity(entity.id)
+
+            if db_entity:
+                await self._bad_request_handle(db_entity, ex)
+                completed = True
+            else:
+                raise ex
+        finally:
+            if completed and generation == self._get_members_generation(entity.id):
+                self._cache_dialog_members(entity.id, members, frozenset(members_ids), frozenset(bots_ids))
+
+    def _cache_dialog_members(self, chat_id: int, members: Union[list, None], members_ids: frozenset,
+                              bots_ids: frozenset):
+        self._chat_members_cache[chat_id] = {
+            'time': monotonic(),
+            'members': members,
+            'ids': members_ids,
+            'bots': bots_ids,
+        }
+        self._chat_members_cache.move_to_end(chat_id)
+
+        while len(self._chat_members_cache) > self._participants_cache_size:
+            self._chat_members_cache.popitem(last=False)
+            self.participants_cache_stats['evictions'] += 1
+
+        if members is None:
+            return
+
+        # Участники уже получены целиком, дальнейшие get_entity по ним не пойдут в api
+        for member in members:
+            self._cache_entity(member)
+
+        self.entity_cache_stats['seeded'] += len(members)
+
+    async def _get_db_entity(self, telegram_id: Union[str, int]) -> Union[TelegramEntity]:
+        db_entity = await Chat.aio_get_by_telegram_id(telegram_id)
 
         if not db_entity:
-            db_entity = User.get_by_telegram_id(telegram_id)
+            db_entity = await User.aio_get_by_telegram_id(telegram_id)
 
         return db_entity
 
-    def _bad_request_handle(self, db_entity, exception):
+    @staticmethod
+    async def _bad_request_handle(db_entity, exception):
         if not db_entity.is_deleted():
-            db_entity.mark_as_deleted(repr(exception))
-            db_entity.save()
+            if isinstance(db_entity, Chat):
+                await db_entity.aio_mark_as_deleted(repr(exception))
+            else:
+                db_entity.mark_as_deleted(repr(exception))
+                await db_entity.aio_save()
@@ -0,0 +1,211 @@
+# !/usr/bin/env python
+
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import os
+import re
+from datetime import datetime
+from time import monotonic
+
+from telethon import utils
+from telethon.events import Raw
+from telethon.extensions import BinaryReader
+from telethon.tl import types
+from telethon.tl.tlobject import TLObject
+
+from fsb.config import config
+from fsb.db.models import Role
+from fsb.telegram.client import TelegramApiClient
+
+
+class UpdateRecorder:
+    RECORDED_UPDATES = (
+        types.UpdateNewMessage,
+        types.UpdateNewChannelMessage,
+        types.UpdateShortMessage,
+        types.UpdateShortChatMessage,
+        types.UpdateBotCallbackQuery,
+        types.UpdateChatParticipantAdd,
+        types.UpdateChatParticipantDelete,
+        types.UpdateChannelParticipant,
+    )
+    ENTITY_TYPES = (types.User, types.Chat, types.ChatForbidden, types.Channel, types.ChannelForbidden)
+    ID_FIELDS = {
+        'user_id', 'chat_id', 'channel_id', 'from_id', 'inviter_id', 'actor_id', 'kicked_by', 'promoted_by',
+        'via_bot_id', 'access_hash', 'chat_instance',
+    }
+    WORD_PATTERN = re.compile(r'\S+')
+    MENTION_PATTERN = re.compile(r'@([^\s@]+)')
+
+    def __init__(self, client: TelegramApiClient, keep_mentions: set = None):
+        self.client = client
+        self.keep_mentions = set(keep_mentions or ())
+        self.keep_text = bool(config.update_recorder.keep_text)
+        self.logger = logging.getLogger('main')
+        # Соль своя у каждой записи: id внутри файла согласованы, но между записями не связываются
+        self._salt = os.urandom(16)
+        self._started = None
+        self._file = None
+        self._path = None
+
+    def listen(self):
+        folder = os.path.abspath(config.update_recorder.folder or os.path.join(
+            config.get('LOG_FOLDER', default_value=config.ROOT_FOLDER + '/logs'), 'recordings'
+        ))
+        os.makedirs(folder, exist_ok=True)
+        self._path = os.path.join(folder, f"updates-{datetime.now().strftime('%Y%m%d-%H%M%S')}.jsonl")
+        self._file = open(self._path, 'a', buffering=1, encoding='utf8')
+        self._started = monotonic()
+        me = self.client._current_user
+        self._write({
+            'header': True,
+            'self_id': self.anonymize_id(me.id),
+            'bot_username': me.username,
+            'started_at': datetime.now().isoformat(),
+        })
+        self.client.add_event_handler(self.record, Raw(types=list(self.RECORDED_UPDATES)))
+        self.logger.info(f"Recording updates to {self._path}")
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    async def record(self, update):
+        try:
+            entities = list(getattr(update, '_entities', {}).values())
+            # Копия через сериализацию, чтобы обезличивание не задело обрабатываемый апдейт
+            update = self._copy(update)
+            entities = [self._copy(entity) for entity in entities]
+            keep_mentions = self.keep_mentions | set(await self._get_chat_triggers(update))
+
+            self._anonymize(update, keep_mentions)
+
+            for entity in entities:
+                self._anonymize(entity, keep_mentions)
+
+            self._write({
+                't': round(monotonic() - self._started, 3),
+                'type': update.__class__.__name__,
+                'update': base64.b64encode(bytes(update)).decode(),
+                'entities': [base64.b64encode(bytes(entity)).decode() for entity in entities],
+            })
+        except Exception as ex:
+            self.logger.warning(f"Update was not recorded: {ex!r}")
+
+    def anonymize_id(self, id: int) -> int:
+        digest = hmac.new(self._salt, str(id).encode(), hashlib.sha256).digest()
+        # 31 бит, чтобы id помещался и в поля int, и в поля long
+        return int.from_bytes(digest[:4], 'big') >> 1 or 1
+
+    def anonymize_username(self, username: str) -> str:
+        return 'u' + hmac.new(self._salt, username.lower().encode(), hashlib.sha256).hexdigest()[:12]
+
+    async def _get_chat_triggers(self, update) -> list:
+        message = getattr(update, 'message', None)
+
+        if not isinstance(message, types.Message) or not message.message or '@' not in message.message:
+            return []
+
+        mentions = self.MENTION_PATTERN.findall(message.message)
+
+        return await Role.aio_find_triggers(utils.resolve_id(utils.get_peer_id(message.peer_id))[0], mentions)
+
+    def _anonymize(self, obj, keep_mentions: set, seen: set = None):
+        seen = set() if seen is None else seen
+
+        if isinstance(obj, list):
+            return [self._anonymize(item, keep_mentions, seen) for item in obj]
+
+        # Один объект может быть доступен по нескольким полям, обезличивается он один раз
+        if not isinstance(obj, TLObject) or id(obj) in seen:
+            return obj
+
+        seen.add(id(obj))
+        is_self = isinstance(obj, types.User) and obj.is_self
+
+        for name, value in list(obj.__dict__.items()):
+            # Приватные поля patched-объектов (_chat_peer и т.п.) не сериализуются
+            if name.startswith('_') or isinstance(value, bool):
+                continue
+            elif name in self.ID_FIELDS and isinstance(value, int):
+                value = self.anonymize_id(value)
+            elif name == 'id' and isinstance(obj, self.ENTITY_TYPES):
+                value = self.anonymize_id(value)
+            elif name == 'users' and isinstance(obj, types.MessageActionChatAddUser):
+                value = [self.anonymize_id(user_id) for user_id in value]
+            elif name == 'username' and value and not is_self:
+                value = self.anonymize_username(value)
+            elif name == 'title' and isinstance(value, str):
+                value = 'Chat'
+            elif name == 'first_name' and value:
+                value = 'User'
+            elif name in ('last_name', 'phone', 'photo', 'status', 'post_author', 'from_name') and value is not None:
+                value = types.ChatPhotoEmpty() if name == 'photo' and not isinstance(obj, types.User) else None
+            elif name == 'media' and value is not None:
+                value = None
+            elif name == 'message' and isinstance(value, str):
+                text = self._anonymize_text(value, keep_mentions)
+
+                if text != value:
+                    obj.entities = None
+
+                value = text
+            else:
+                value = self._anonymize(value, keep_mentions, seen)
+
+            setattr(obj, name, value)
+
+        return obj
+
+    def _anonymize_text(self, text: str, keep_mentions: set) -> str:
+        if self.keep_text:
+            return text
+
+        command_start = len(text) - len(text.lstrip())
+
+        def replace_word(match) -> str:
+            word = match.group()
+
+            # Команды и упоминания ролей и триггеров нужны для маршрутизации при воспроизведении
+            if word.startswith('/') and match.start() == command_start:
+                return word
+            elif word.startswith('@'):
+                mention = word[1:]
+                return word if mention in keep_mentions else '@' + self.anonymize_username(mention)
+
+            return 'x' * len(word)
+
+        # Аргументы команд тоже могут быть личными данными, поэтому сохраняется только сама команда
+        return self.WORD_PATTERN.sub(replace_word, text)
+
+    @staticmethod
+    def _copy(obj: TLObject) -> TLObject:
+        with BinaryReader(bytes(obj)) as reader:
+            return reader.tgread_object()
+
+    def _write(self, data: dict):
+        self._file.write(json.dumps(data, ensure_ascii=False) + '\n')
+
+    @staticmethod
+    def read(path: str):
+        with open(path, encoding='utf8') as file:
+            for line in file:
+                if not line.strip():
+                    continue
+
+                data = json.loads(line)
+
+                if not data.get('header'):
+                    data['update'] = UpdateRecorder._load(data['update'])
+                    data['entities'] = [UpdateRecorder._load(entity) for entity in data['entities']]
+
+                yield data
+
+    @staticmethod
+    def _load(data: str) -> TLObject:
+        with BinaryReader(base64.b64decode(data)) as reader:
+            return reader.tgread_object()
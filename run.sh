@@ -1,12 +1,15 @@
 #!/bin/sh
 printenv | grep -v "no_proxy" >> /etc/environment
 
-if [ "$FOOL_DAY" = "True" ]; then
-  crontab /etc/cron.d/fool.cron
-else
-  crontab /etc/cron.d/cron
-fi
+# Плановые задачи выполняет сам бот (system_jobs в config.yml), cron запускается только как запасной вариант
+if [ "$CRON_FALLBACK" = "True" ]; then
+  if [ "$FOOL_DAY" = "True" ]; then
+    crontab /etc/cron.d/fool.cron
+  else
+    crontab /etc/cron.d/cron
+  fi
 
-cron -L /var/log/cron.log
+  cron -L /var/log/cron.log
+fi
 pipenv run cli migrator migrate -y
 pipenv run python -m fsb